@@ -1,16 +1,28 @@
 import os
+import hmac
+import json
+import base64
 import psycopg
-from flask import Flask, render_template, request, redirect, url_for, session, flash, Response, send_file
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from io import BytesIO, StringIO
+from flask import Flask, render_template, request, redirect, url_for, session, flash, Response, send_file, jsonify, make_response
 from datetime import datetime
-import time
 import pytz
-from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
 import logging
-import csv  # Aggiunto import csv
+import itertools
+import functools
+from db import get_db_connection, release_db_connection, pool_stats
+import metriche
+from cache import scarta, invalida_liste, versione_dati, report_in_cache, salva_report, etag_report
+from esportazione import esporta_report_csv, comprimi_gzip, scrivi_backup, nuovo_file_backup, BACKUP_DIR
+from migrazioni import applica_migrazioni
+from pianificatore import avvia_pianificatore, e_leader, storico
+from jobs import avvia_lavoro, stato_lavoro
+from lotto_visite import inserisci_lotto, VISITE_LOTTO_MAX
+from ripristino import ripristina_backup
+from pulizia import lavoro_pulizia
+from ricerca import RICERCHE, cerca
+from query_visite import ORDINAMENTI, INSERISCI_VISITA, CONTA_VISITE_ASSISTITO, filtro_visite, leggi_visite, parametri_visita, errore_modulo_visita, messaggio_chiave_mancante
+from statistiche import statistiche_vuote, statistiche_giornaliere, statistiche_da_righe
 
 # Configura il logging
 logging.basicConfig(filename='backup.log', level=logging.INFO)
@@ -19,88 +31,31 @@ load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'default_secret_key')
+metriche.installa(app)
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
 if not ADMIN_PASSWORD:
     raise ValueError("ADMIN_PASSWORD non definita nel file .env")
 
-# Connessione al database PostgreSQL
-def get_db_connection():
+# Le migrazioni si applicano al deploy con "python migrazioni.py applica", prima di
+# avviare gunicorn: una migrazione lunga all'import supererebbe il timeout di avvio
+# dei worker. MIGRAZIONI_ALL_AVVIO=1 le applica anche qui, per lo sviluppo locale:
+# con più worker le applica solo il primo (vedi migrazioni.py). Se il database non
+# risponde l'app parte comunque.
+if os.getenv('MIGRAZIONI_ALL_AVVIO', '0') == '1':
+    conn = None
     try:
-        conn = psycopg.connect(os.getenv('DATABASE_URL'))
-        conn.execute("SET TIME ZONE 'Europe/Rome'")
-        return conn
-    except psycopg.OperationalError as e:
-        logging.error(f"Errore di connessione al database: {e}")
-        raise
-
-# Backup automatico
-def backup_automatico():
-    logging.info(f"Inizio backup automatico alle: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    for attempt in range(3):
-        conn = None
-        cur = None
-        try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT v.volontario_email, v.assistito_nome, v.accoglienza, v.data_visita, v.necessita, v.cosa_migliorare,
-                       vol.cognome, vol.nome, ass.citta
-                FROM visite v
-                JOIN volontari vol ON v.volontario_email = vol.email
-                JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
-            """)
-            visite = cur.fetchall()
-
-            cur.execute("SELECT email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione FROM volontari")
-            volontari = cur.fetchall()
-
-            cur.execute("SELECT nome_sigla, citta FROM assistiti")
-            assistiti = cur.fetchall()
-
-            base_path = os.path.join(os.path.dirname(__file__), 'backups')
-            os.makedirs(base_path, exist_ok=True)
-            filename = os.path.join(base_path, f"backup_dati_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
-            
-            with open(filename, 'w', newline='', encoding='utf-8') as output_file:
-                writer = csv.writer(output_file, lineterminator='\n')
-                writer.writerow(['--- Visite ---'])
-                writer.writerow(['Volontario Email', 'Cognome', 'Nome', 'Assistito', 'Città', 'Accoglienza', 'Data Visita', 'Necessità', 'Cosa Migliorare'])
-                for visita in visite:
-                    writer.writerow([visita[0], visita[7], visita[6], visita[1], visita[8], visita[2], visita[3], visita[4] or '', visita[5] or ''])
-
-                writer.writerow(['--- Volontari ---'])
-                writer.writerow(['Email', 'Cognome', 'Nome', 'Telefono', 'Competenze', 'Disponibilità', 'Data Iscrizione'])
-                for volontario in volontari:
-                    writer.writerow([volontario[0], volontario[1], volontario[2], volontario[3] or '', volontario[4] or '', volontario[5] or '', volontario[6] or ''])
-
-                writer.writerow(['--- Assistiti ---'])
-                writer.writerow(['Nome Sigla', 'Città'])
-                for assistito in assistiti:
-                    writer.writerow([assistito[0], assistito[1]])
-            
-            logging.info(f"Backup creato: {filename}")
-
-            now = datetime.now()
-            for file in os.listdir(base_path):
-                file_path = os.path.join(base_path, file)
-                if os.path.isfile(file_path):
-                    file_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-                    if (now - file_time).days > 7:
-                        os.remove(file_path)
-                        logging.info(f"Eliminato backup vecchio: {file}")
-            break
-        except psycopg.OperationalError as e:
-            logging.error(f"Tentativo {attempt + 1} fallito: {e}")
-            time.sleep(5)
-        finally:
-            if cur:
-                cur.close()
-            if conn:
-                conn.close()
+        conn = get_db_connection()
+        applicate = applica_migrazioni(conn)
+        if applicate:
+            logging.info(f"Migrazioni applicate all'avvio: {applicate}")
+    except psycopg.Error as e:
+        logging.error(f"Migrazioni all'avvio non applicate: {e}")
+    finally:
+        if conn:
+            release_db_connection(conn)
 
-scheduler = BackgroundScheduler(timezone="Europe/Rome")
-scheduler.add_job(backup_automatico, 'cron', hour=2, minute=0)
-scheduler.start()
+# Backup notturno e altri lavori pianificati: uno solo dei worker li esegue (vedi pianificatore.py)
+avvia_pianificatore()
 
 @app.route('/')
 def home():
@@ -129,129 +84,125 @@ def admin_login():
         logging.error(f"Errore in /admin_login: {e}")
         raise
 
+# Paginazione del report (colonne ordinabili in query_visite.ORDINAMENTI)
+REPORT_PAGE_SIZE = int(os.getenv('REPORT_PAGE_SIZE', 50))
+REPORT_PAGE_SIZE_MAX = 500
+
+# Il cursore è la coppia (valore della colonna di ordinamento, id) dell'ultima riga vista
+def codifica_cursore(visita, campo):
+    return base64.urlsafe_b64encode(json.dumps([str(getattr(visita, campo)), visita.id]).encode()).decode()
+
+def decodifica_cursore(cursore):
+    valore, id_visita = json.loads(base64.urlsafe_b64decode(cursore.encode()))
+    return valore, int(id_visita)
+
 @app.route('/report', methods=['GET', 'POST'])
 def report():
     if not session.get('logged_in', False):
         return redirect(url_for('admin_login'))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    volontario_email = request.form.get('volontario_email', '')
-    data_inizio = request.form.get('data_inizio', '')
-    data_fine = request.form.get('data_fine', '')
+    volontario_email = request.values.get('volontario_email', '')
+    data_inizio = request.values.get('data_inizio', '')
+    data_fine = request.values.get('data_fine', '')
+    ordina = request.values.get('ordina', 'data')
+    if ordina not in ORDINAMENTI:
+        ordina = 'data'
+    verso = 'asc' if request.values.get('verso') == 'asc' else 'desc'
+    dopo = request.values.get('dopo', '')
+    prima = request.values.get('prima', '')
 
     logging.info(f"volontario_email: {volontario_email}, data_inizio: {data_inizio}, data_fine: {data_fine}")
 
     try:
+        per_pagina = min(max(int(request.values.get('per_pagina', REPORT_PAGE_SIZE)), 1), REPORT_PAGE_SIZE_MAX)
         if data_inizio:
             datetime.strptime(data_inizio, '%Y-%m-%d')
         if data_fine:
             datetime.strptime(data_fine, '%Y-%m-%d')
             data_fine = f"{data_fine} 23:59:59"
+        cursore = decodifica_cursore(dopo or prima) if dopo or prima else None
     except ValueError as e:
-        flash(f"Formato data non valido: {e}", "error")
-        return render_template('report.html', visite=[], statistiche={'totale_visite': 0, 'accoglienza': {'Buona': 0, 'Media': 0, 'Scarsa': 0}, 'visite_per_citta': {}}, volontari=[], filtro_volontario='', data_inizio='', data_fine='')
-
-    query = """
-        SELECT v.volontario_email, v.assistito_nome, v.accoglienza, v.data_visita, v.necessita, v.cosa_migliorare,
-               vol.cognome, vol.nome, ass.citta
-        FROM visite v
-        JOIN volontari vol ON v.volontario_email = vol.email
-        JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
-        WHERE 1=1
-    """
-    params = []
-    
-    if volontario_email:
-        query += " AND v.volontario_email = %s"
-        params.append(volontario_email)
-    if data_inizio:
-        query += " AND v.data_visita >= %s"
-        params.append(data_inizio)
-    if data_fine:
-        query += " AND v.data_visita <= %s"
-        params.append(data_fine)
+        flash(f"Parametri del report non validi: {e}", "error")
+        return render_template('report.html', visite=[], statistiche=statistiche_vuote(), filtro_volontario='', data_inizio='', data_fine='')
+
+    filtro = filtro_visite(volontario_email, data_inizio, data_fine)
+    campo = ORDINAMENTI[ordina][1]
+    indietro = bool(prima)
+    # All'indietro si legge nel verso opposto e poi si rovescia la pagina
+    crescente = (verso == 'desc') == indietro
+
+    session['report_filters'] = {
+        'volontario_email': volontario_email,
+        'data_inizio': data_inizio,
+        'data_fine': data_fine if not data_fine.endswith('23:59:59') else data_fine[:10]
+    }
+    chiave = (volontario_email, data_inizio, data_fine, ordina, verso, dopo, prima, per_pagina)
 
+    conn = get_db_connection()
+    cur = conn.cursor()
     try:
-        cur.execute(query, params)
-        visite = cur.fetchall()
-    
-        count_query = "SELECT COUNT(*) FROM visite WHERE 1=1"
-        if params:
-            if volontario_email:
-                count_query += " AND volontario_email = %s"
-            if data_inizio:
-                count_query += " AND data_visita >= %s"
-            if data_fine:
-                count_query += " AND data_visita <= %s"
-        cur.execute(count_query, params)
-        totale_visite = cur.fetchone()[0]
-
-        accoglienza_query = "SELECT accoglienza, COUNT(*) FROM visite WHERE 1=1"
-        if params:
-            if volontario_email:
-                accoglienza_query += " AND volontario_email = %s"
-            if data_inizio:
-                accoglienza_query += " AND data_visita >= %s"
-            if data_fine:
-                accoglienza_query += " AND data_visita <= %s"
-        accoglienza_query += " GROUP BY accoglienza"
-        cur.execute(accoglienza_query, params)
-        accoglienza_rows = cur.fetchall()
-        accoglienza = {'Buona': 0, 'Media': 0, 'Scarsa': 0}
-        for row in accoglienza_rows:
-            accoglienza[row[0]] = row[1]
-
-        citta_query = """
-            SELECT ass.citta, COUNT(*) 
-            FROM visite v 
-            JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
-            WHERE 1=1
-        """
-        if params:
-            if volontario_email:
-                citta_query += " AND v.volontario_email = %s"
-            if data_inizio:
-                citta_query += " AND v.data_visita >= %s"
-            if data_fine:
-                citta_query += " AND v.data_visita <= %s"
-        citta_query += " GROUP BY ass.citta"
-        cur.execute(citta_query, params)
-        visite_per_citta = dict(cur.fetchall())
-
-        cur.execute("SELECT email, cognome, nome FROM volontari ORDER BY cognome, nome")
-        volontari = cur.fetchall()
-
-        statistiche = {
-            'totale_visite': totale_visite,
-            'accoglienza': accoglienza,
-            'visite_per_citta': visite_per_citta
-        }
-    
-        session['report_filters'] = {
-            'volontario_email': volontario_email,
-            'data_inizio': data_inizio,
-            'data_fine': data_fine if not data_fine.endswith('23:59:59') else data_fine[:10]
-        }
+        # La versione cambia a ogni scrittura su visite, volontari o assistiti
+        versione, modificata = versione_dati(cur)
+        etag = etag_report(chiave, versione)
+        # Il browser ha già questa pagina: basta un 304 (se non ci sono messaggi da mostrare)
+        if request.method == 'GET' and '_flashes' not in session and etag in request.if_none_match:
+            risposta = Response(status=304)
+            risposta.set_etag(etag)
+            risposta.cache_control.private = True
+            risposta.cache_control.no_cache = True
+            return risposta
+
+        risultato = report_in_cache(chiave, versione)
+        if risultato is None:
+            visite = leggi_visite(conn, filtro, ordina=ordina, crescente=crescente, cursore=cursore, limite=per_pagina + 1)
+            altre = len(visite) > per_pagina
+            visite = visite[:per_pagina]
+            if indietro:
+                visite.reverse()
+
+            # Se la pagina contiene tutte le visite filtrate le statistiche si ricavano dalle righe
+            if not cursore and not altre:
+                statistiche = statistiche_da_righe(visite)
+            else:
+                statistiche = statistiche_giornaliere(cur, volontario_email, data_inizio, data_fine)
+            risultato = (visite, altre, statistiche)
+            salva_report(chiave, versione, risultato)
+        visite, altre, statistiche = risultato
     
     except psycopg.OperationalError as e:
         logging.error(f"Errore SQL: {e}")
         flash(f"Errore nel database: {e}", "error")
-        return render_template('report.html', visite=[], statistiche={'totale_visite': 0, 'accoglienza': {'Buona': 0, 'Media': 0, 'Scarsa': 0}, 'visite_per_citta': {}}, volontari=[], filtro_volontario='', data_inizio='', data_fine='')
+        return render_template('report.html', visite=[], statistiche=statistiche_vuote(), filtro_volontario='', data_inizio='', data_fine='')
     except Exception as e:
         logging.error(f"Errore generico: {e}")
         flash(f"Errore imprevisto: {e}", "error")
-        return render_template('report.html', visite=[], statistiche={'totale_visite': 0, 'accoglienza': {'Buona': 0, 'Media': 0, 'Scarsa': 0}, 'visite_per_citta': {}}, volontari=[], filtro_volontario='', data_inizio='', data_fine='')
+        return render_template('report.html', visite=[], statistiche=statistiche_vuote(), filtro_volontario='', data_inizio='', data_fine='')
     finally:
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_db_connection(conn)
+
+    data_fine = data_fine[:10] if data_fine and data_fine.endswith('23:59:59') else data_fine
+    paginazione = {
+        'successiva': codifica_cursore(visite[-1], campo) if visite and (altre or indietro) else None,
+        'precedente': codifica_cursore(visite[0], campo) if visite and (cursore and not indietro or altre and indietro) else None,
+        'parametri': {
+            'volontario_email': volontario_email, 'data_inizio': data_inizio, 'data_fine': data_fine,
+            'ordina': ordina, 'verso': verso, 'per_pagina': per_pagina,
+        },
+    }
     
-    return render_template('report.html', visite=visite, statistiche=statistiche, 
-                          volontari=volontari, filtro_volontario=volontario_email, 
-                          data_inizio=data_inizio, data_fine=data_fine[:10] if data_fine and data_fine.endswith('23:59:59') else data_fine)
+    risposta = make_response(render_template('report.html', visite=visite, statistiche=statistiche, 
+                          filtro_volontario=volontario_email, 
+                          data_inizio=data_inizio, data_fine=data_fine, paginazione=paginazione))
+    # Il browser deve sempre chiedere conferma, ma può ricevere un 304 invece della pagina
+    if request.method == 'GET':
+        risposta.set_etag(etag)
+        risposta.last_modified = modificata
+        risposta.cache_control.private = True
+        risposta.cache_control.no_cache = True
+    return risposta
 
 @app.route('/download_pdf')
 def download_pdf():
@@ -263,67 +214,25 @@ def download_pdf():
     data_inizio = filters.get('data_inizio', '')
     data_fine = filters.get('data_fine', '')
 
-    if data_fine:
-        try:
+    # Con data_visita di tipo DATE una data malformata farebbe fallire la query
+    try:
+        if data_inizio:
+            datetime.strptime(data_inizio, '%Y-%m-%d')
+        if data_fine:
             datetime.strptime(data_fine, '%Y-%m-%d')
             data_fine = f"{data_fine} 23:59:59"
-        except ValueError:
-            flash("Formato data non valido.", "error")
-            return redirect(url_for('report'))
+    except ValueError:
+        flash("Formato data non valido.", "error")
+        return redirect(url_for('report'))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    # La versione dei dati fa parte dei parametri del lavoro: dopo una modifica lo
+    # stesso filtro genera un PDF nuovo invece di riusare quello già pronto
+    conn = None
+    cur = None
     try:
-        query = """
-            SELECT v.volontario_email, v.assistito_nome, v.accoglienza, v.data_visita, v.necessita, v.cosa_migliorare,
-                   vol.cognome, vol.nome, ass.citta
-            FROM visite v
-            JOIN volontari vol ON v.volontario_email = vol.email
-            JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
-            WHERE 1=1
-        """
-        params = []
-        
-        if volontario_email:
-            query += " AND v.volontario_email = %s"
-            params.append(volontario_email)
-        if data_inizio:
-            query += " AND v.data_visita >= %s"
-            params.append(data_inizio)
-        if data_fine:
-            query += " AND v.data_visita <= %s"
-            params.append(data_fine)
-
-        cur.execute(query, params)
-        visite = cur.fetchall()
-
-        pdf_output = BytesIO()
-        pdf = canvas.Canvas(pdf_output, pagesize=A4)
-        pdf.setFont("Helvetica", 12)
-        pdf.drawString(100, 800, "Report Visite")
-        
-        y = 780
-        for visita in visite:
-            pdf.drawString(50, y, f"Volontario: {visita[7]} {visita[6]} ({visita[0]})")
-            y -= 20
-            pdf.drawString(50, y, f"Assistito: {visita[1]} ({visita[8]})")
-            y -= 20
-            pdf.drawString(50, y, f"Accoglienza: {visita[2]}")
-            y -= 20
-            pdf.drawString(50, y, f"Data: {visita[3]}")
-            y -= 20
-            pdf.drawString(50, y, f"Necessità: {visita[4] or 'Nessuna'}")
-            y -= 20
-            pdf.drawString(50, y, f"Miglioramenti: {visita[5] or 'Nessuno'}")
-            y -= 40
-            if y < 50:
-                pdf.showPage()
-                y = 800
-
-        pdf.save()
-        pdf_output.seek(0)
-        
-        return send_file(pdf_output, download_name="report_visite.pdf", as_attachment=True)
+        conn = get_db_connection()
+        cur = conn.cursor()
+        versione, _ = versione_dati(cur)
     except psycopg.OperationalError as e:
         flash(f"Errore nel database: {e}", "error")
         return redirect(url_for('report'))
@@ -331,7 +240,49 @@ def download_pdf():
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_db_connection(conn)
+
+    # Il PDF viene generato in background; la pagina di attesa controlla lo stato.
+    # reportlab viene caricato solo qui, non all'avvio del worker.
+    from report_pdf import genera_report_pdf
+    filtri = {'volontario_email': volontario_email, 'data_inizio': data_inizio, 'data_fine': data_fine}
+    try:
+        job_id = avvia_lavoro('report_pdf', dict(filtri, versione_dati=versione), 'pdf', functools.partial(genera_report_pdf, filtri))
+    except OSError as e:
+        flash(f"Errore nell'avvio della generazione del PDF: {e}", "error")
+        return redirect(url_for('report'))
+    return redirect(url_for('stato_pdf', job_id=job_id))
+
+@app.route('/report_pdf/<job_id>')
+def stato_pdf(job_id):
+    if not session.get('logged_in', False):
+        return redirect(url_for('admin_login'))
+
+    if not stato_lavoro(job_id):
+        flash("Generazione del PDF non trovata o scaduta.", "error")
+        return redirect(url_for('report'))
+    return render_template('report_pdf.html', job_id=job_id)
+
+@app.route('/report_pdf/<job_id>/stato')
+def stato_pdf_json(job_id):
+    if not session.get('logged_in', False):
+        return jsonify({'errore': 'non autorizzato'}), 401
+
+    stato = stato_lavoro(job_id)
+    if not stato:
+        return jsonify({'stato': 'sconosciuto'}), 404
+    return jsonify({k: stato.get(k) for k in ('stato', 'fatti', 'totale', 'errore', 'durata')})
+
+@app.route('/report_pdf/<job_id>/scarica')
+def scarica_pdf(job_id):
+    if not session.get('logged_in', False):
+        return redirect(url_for('admin_login'))
+
+    stato = stato_lavoro(job_id)
+    if not stato or stato['stato'] != 'completato' or not os.path.exists(stato['file']):
+        flash("Il PDF non è ancora pronto.", "error")
+        return redirect(url_for('stato_pdf', job_id=job_id) if stato else url_for('report'))
+    return send_file(stato['file'], download_name="report_visite.pdf", as_attachment=True)
 
 @app.route('/download_csv')
 def download_csv():
@@ -342,59 +293,55 @@ def download_csv():
     volontario_email = filters.get('volontario_email', '')
     data_inizio = filters.get('data_inizio', '')
     data_fine = filters.get('data_fine', '')
+    compresso = request.args.get('gzip') == '1'
 
-    if data_fine:
-        try:
+    # Con data_visita di tipo DATE una data malformata farebbe fallire la query
+    try:
+        if data_inizio:
+            datetime.strptime(data_inizio, '%Y-%m-%d')
+        if data_fine:
             datetime.strptime(data_fine, '%Y-%m-%d')
             data_fine = f"{data_fine} 23:59:59"
-        except ValueError:
-            flash("Formato data non valido.", "error")
-            return redirect(url_for('report'))
+    except ValueError:
+        flash("Formato data non valido.", "error")
+        return redirect(url_for('report'))
 
+    where, params = filtro_visite(volontario_email, data_inizio, data_fine)
     conn = get_db_connection()
     cur = conn.cursor()
+
+    blocchi = esporta_report_csv(cur, where, params)
+
+    # La connessione torna al pool solo quando il server ha finito di inviare la risposta.
+    # Se il client si è disconnesso a metà, chiudere il generatore fa uscire il COPY dal
+    # suo blocco with: psycopg lo termina e la connessione torna al pool riutilizzabile.
+    def chiudi():
+        try:
+            blocchi.close()
+            cur.close()
+        except psycopg.Error:
+            pass
+        release_db_connection(conn)
+
+    # Il primo blocco viene letto subito: gli errori del COPY arrivano qui e non a metà download.
+    # Qualunque errore chiude il generatore e restituisce la connessione al pool.
     try:
-        query = """
-            SELECT v.volontario_email, v.assistito_nome, v.accoglienza, v.data_visita, v.necessita, v.cosa_migliorare,
-                   vol.cognome, vol.nome, ass.citta
-            FROM visite v
-            JOIN volontari vol ON v.volontario_email = vol.email
-            JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
-            WHERE 1=1
-        """
-        params = []
-        
-        if volontario_email:
-            query += " AND v.volontario_email = %s"
-            params.append(volontario_email)
-        if data_inizio:
-            query += " AND v.data_visita >= %s"
-            params.append(data_inizio)
-        if data_fine:
-            query += " AND v.data_visita <= %s"
-            params.append(data_fine)
-
-        cur.execute(query, params)
-        visite = cur.fetchall()
-
-        output = StringIO()
-        writer = csv.writer(output, lineterminator='\n')
-        writer.writerow(['Volontario Email', 'Cognome', 'Nome', 'Assistito', 'Città', 'Accoglienza', 'Data Visita', 'Necessità', 'Cosa Migliorare'])
-        
-        for visita in visite:
-            writer.writerow([visita[0], visita[7], visita[6], visita[1], visita[8], visita[2], visita[3], visita[4] or 'Nessuna', visita[5] or 'Nessuno'])
-
-        csv_output = output.getvalue().encode('utf-8')
-        output.close()
-        return Response(csv_output, mimetype='text/csv', headers={"Content-Disposition": "attachment;filename=report_visite.csv"})
-    except psycopg.OperationalError as e:
+        primi = [next(blocchi), next(blocchi, b'')]
+    except psycopg.Error as e:
+        chiudi()
         flash(f"Errore nel database: {e}", "error")
         return redirect(url_for('report'))
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+    except Exception:
+        chiudi()
+        raise
+    corpo = itertools.chain(primi, blocchi)
+
+    if compresso:
+        response = Response(comprimi_gzip(corpo), mimetype='application/gzip', headers={"Content-Disposition": "attachment;filename=report_visite.csv.gz"})
+    else:
+        response = Response(corpo, mimetype='text/csv', headers={"Content-Disposition": "attachment;filename=report_visite.csv"})
+    response.call_on_close(chiudi)
+    return response
 
 @app.route('/backup')
 def backup():
@@ -404,42 +351,7 @@ def backup():
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            SELECT v.volontario_email, v.assistito_nome, v.accoglienza, v.data_visita, v.necessita, v.cosa_migliorare,
-                   vol.cognome, vol.nome, ass.citta
-            FROM visite v
-            JOIN volontari vol ON v.volontario_email = vol.email
-            JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
-        """)
-        visite = cur.fetchall()
-
-        cur.execute("SELECT email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione FROM volontari")
-        volontari = cur.fetchall()
-
-        cur.execute("SELECT nome_sigla, citta FROM assistiti")
-        assistiti = cur.fetchall()
-
-        base_path = os.path.join(os.path.dirname(__file__), 'backups')
-        os.makedirs(base_path, exist_ok=True)
-        filename = os.path.join(base_path, f"backup_dati_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
-        
-        with open(filename, 'w', newline='', encoding='utf-8') as output_file:
-            writer = csv.writer(output_file, lineterminator='\n')
-            writer.writerow(['--- Visite ---'])
-            writer.writerow(['Volontario Email', 'Cognome', 'Nome', 'Assistito', 'Città', 'Accoglienza', 'Data Visita', 'Necessità', 'Cosa Migliorare'])
-            for visita in visite:
-                writer.writerow([visita[0], visita[7], visita[6], visita[1], visita[8], visita[2], visita[3], visita[4] or '', visita[5] or ''])
-
-            writer.writerow(['--- Volontari ---'])
-            writer.writerow(['Email', 'Cognome', 'Nome', 'Telefono', 'Competenze', 'Disponibilità', 'Data Iscrizione'])
-            for volontario in volontari:
-                writer.writerow([volontario[0], volontario[1], volontario[2], volontario[3] or '', volontario[4] or '', volontario[5] or '', volontario[6] or ''])
-
-            writer.writerow(['--- Assistiti ---'])
-            writer.writerow(['Nome Sigla', 'Città'])
-            for assistito in assistiti:
-                writer.writerow([assistito[0], assistito[1]])
-        
+        filename = scrivi_backup(cur, nuovo_file_backup())
         logging.info(f"Backup manuale creato: {filename}")
         flash("Backup creato con successo sul server!", "success")
         return redirect(url_for('report'))
@@ -450,7 +362,7 @@ def backup():
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_db_connection(conn)
 
 @app.route('/restore', methods=['GET', 'POST'])
 def restore():
@@ -459,9 +371,8 @@ def restore():
 
     backup_files = []
     try:
-        base_path = os.path.join(os.path.dirname(__file__), 'backups')
-        if os.path.exists(base_path):
-            backup_files = [f for f in os.listdir(base_path) if f.startswith('backup_dati_') and f.endswith('.csv')]
+        if os.path.exists(BACKUP_DIR):
+            backup_files = [f for f in os.listdir(BACKUP_DIR) if f.startswith('backup_dati_') and f.endswith('.csv')]
     except Exception as e:
         flash(f"Errore nella lettura dei backup: {e}", "error")
 
@@ -474,71 +385,21 @@ def restore():
         selected_file = request.form.get('backup_file_select')
         if selected_file:
             conn = None
-            cur = None
             try:
                 conn = get_db_connection()
-                cur = conn.cursor()
-
-                cur.execute("DELETE FROM visite")
-                cur.execute("DELETE FROM volontari")
-                cur.execute("DELETE FROM assistiti")
-                conn.commit()
-
-                file_path = os.path.join(base_path, selected_file)
-                with open(file_path, 'r', encoding='utf-8-sig') as f:
-                    content = f.read().splitlines()
-                if not content:
-                    raise Exception("Il file CSV è vuoto.")
-                reader = csv.reader(content)
-                section = None
-                assistiti = []
-                volontari = []
-                visite = []
-
-                for i, row in enumerate(reader):
-                    if not row or not any(row):
-                        continue
-                    if row[0].startswith('---'):
-                        section = row[0]
-                        continue
-                    if section == '--- Visite ---' and row[0] != 'Volontario Email':
-                        if len(row) < 9:
-                            continue
-                        visite.append((row[0], row[3], row[5], row[6], row[7] or None, row[8] or None))
-                    elif section == '--- Volontari ---' and row[0] != 'Email':
-                        if len(row) < 7:
-                            continue
-                        volontari.append((row[0], row[1], row[2], row[3] or None, row[4] or None, row[5] or None, row[6] or None))
-                    elif section == '--- Assistiti ---' and row[0] != 'Nome Sigla':
-                        if len(row) < 2:
-                            continue
-                        assistiti.append((row[0], row[1]))
-
-                for assistito in assistiti:
-                    cur.execute("INSERT INTO assistiti (nome_sigla, citta) VALUES (%s, %s)", assistito)
-                for volontario in volontari:
-                    cur.execute("""
-                        INSERT INTO volontari (email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    """, volontario)
-                for visita in visite:
-                    cur.execute("""
-                        INSERT INTO visite (volontario_email, assistito_nome, accoglienza, data_visita, necessita, cosa_migliorare)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, visita)
-
-                conn.commit()
-                flash(f"Backup {selected_file} ripristinato con successo!", "success")
+                conteggi = ripristina_backup(conn, os.path.join(BACKUP_DIR, os.path.basename(selected_file)))
+                logging.info(f"Backup {selected_file} ripristinato: {conteggi}")
+                flash(f"Backup {selected_file} ripristinato con successo! "
+                      f"({conteggi.get('--- Visite ---', 0)} visite, {conteggi.get('--- Volontari ---', 0)} volontari, "
+                      f"{conteggi.get('--- Assistiti ---', 0)} assistiti)", "success")
                 return redirect(url_for('report'))
             except psycopg.OperationalError as e:
                 flash(f"Errore nel ripristino: {e}", "error")
             except Exception as e:
                 flash(f"Errore generico nel ripristino: {e}", "error")
             finally:
-                if cur:
-                    cur.close()
                 if conn:
-                    conn.close()
+                    release_db_connection(conn)
 
     return render_template('restore.html', backup_files=backup_files)
 
@@ -557,41 +418,19 @@ def clean():
     data_inizio = filters.get('data_inizio', '')
     data_fine = filters.get('data_fine', '')
 
-    if data_fine:
-        try:
+    # Con data_visita di tipo DATE una data malformata farebbe fallire la query
+    try:
+        if data_inizio:
+            datetime.strptime(data_inizio, '%Y-%m-%d')
+        if data_fine:
             datetime.strptime(data_fine, '%Y-%m-%d')
             data_fine = f"{data_fine} 23:59:59"
-        except ValueError:
-            flash("Formato data non valido.", "error")
-            return redirect(url_for('report'))
+    except ValueError:
+        flash("Formato data non valido.", "error")
+        return redirect(url_for('report'))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        query = "DELETE FROM visite"
-        params = []
-        if volontario_email or data_inizio or data_fine:
-            query += " WHERE 1=1"
-            if volontario_email:
-                query += " AND volontario_email = %s"
-                params.append(volontario_email)
-            if data_inizio:
-                query += " AND data_visita >= %s"
-                params.append(data_inizio)
-            if data_fine:
-                query += " AND data_visita <= %s"
-                params.append(data_fine)
-        cur.execute(query, params)
-        conn.commit()
-        flash("Visite eliminate con successo!", "success")
-    except psycopg.OperationalError as e:
-        flash(f"Errore nel database: {e}", "error")
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
-    return redirect(url_for('report'))
+    filtri = {'volontario_email': volontario_email, 'data_inizio': data_inizio, 'data_fine': data_fine}
+    return avvia_pulizia(filtri)
 
 @app.route('/clean_volontari', methods=['POST'])
 def clean_volontari():
@@ -603,22 +442,39 @@ def clean_volontari():
         flash("Password errata per la pulizia completa.", "error")
         return redirect(url_for('report'))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    return avvia_pulizia(None)
+
+# L'eliminazione gira in background a lotti (vedi pulizia.py): il modulo delle visite
+# resta libero. Un doppio invio mentre la pulizia è in corso ne riceve lo stato.
+def avvia_pulizia(filtri):
     try:
-        cur.execute("DELETE FROM visite")
-        cur.execute("DELETE FROM volontari")
-        cur.execute("DELETE FROM assistiti")
-        conn.commit()
-        flash("Tutti i dati sono stati eliminati!", "success")
-    except psycopg.OperationalError as e:
-        flash(f"Errore nel database: {e}", "error")
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
-    return redirect(url_for('report'))
+        job_id = avvia_lavoro('pulizia', {'filtri': filtri}, 'json', functools.partial(lavoro_pulizia, filtri),
+                              riusa_completati=False)
+    except OSError as e:
+        flash(f"Errore nell'avvio della pulizia: {e}", "error")
+        return redirect(url_for('report'))
+    return redirect(url_for('stato_pulizia', job_id=job_id))
+
+@app.route('/pulizia/<job_id>')
+def stato_pulizia(job_id):
+    if not session.get('logged_in', False):
+        return redirect(url_for('admin_login'))
+
+    stato = stato_lavoro(job_id)
+    if not stato or stato['tipo'] != 'pulizia':
+        flash("Pulizia non trovata o scaduta.", "error")
+        return redirect(url_for('report'))
+    return render_template('pulizia.html', job_id=job_id, completa=stato['parametri']['filtri'] is None)
+
+@app.route('/pulizia/<job_id>/stato')
+def stato_pulizia_json(job_id):
+    if not session.get('logged_in', False):
+        return jsonify({'errore': 'non autorizzato'}), 401
+
+    stato = stato_lavoro(job_id)
+    if not stato or stato['tipo'] != 'pulizia':
+        return jsonify({'stato': 'sconosciuto'}), 404
+    return jsonify({k: stato.get(k) for k in ('stato', 'fatti', 'totale', 'errore', 'durata')})
 
 @app.route('/manuale')
 def manuale():
@@ -635,7 +491,14 @@ def lista_volontari():
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione FROM volontari ORDER BY cognome, nome")
+        # Attività dal riepilogo tenuto aggiornato dai trigger (migrazione 8), senza leggere le visite
+        cur.execute("""
+            SELECT v.email, v.cognome, v.nome, v.telefono, v.competenze, v.disponibilita, v.data_iscrizione,
+                   COALESCE(r.visite, 0), r.ultima_visita, COALESCE(r.assistiti, 0), COALESCE(r.accoglienza, '{}')
+            FROM volontari v
+            LEFT JOIN riepilogo_volontari r ON r.volontario_email = v.email
+            ORDER BY v.cognome, v.nome
+        """)
         volontari = cur.fetchall()
     except psycopg.OperationalError as e:
         flash(f"Errore nel caricamento dei volontari: {e}", "error")
@@ -644,7 +507,7 @@ def lista_volontari():
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_db_connection(conn)
     
     return render_template('volontari.html', volontari=volontari)
 
@@ -680,6 +543,7 @@ def aggiungi_volontario():
                 INSERT INTO volontari (email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione)
                 VALUES (%s, %s, %s, %s, %s, %s, %s)
             """, (email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione))
+            invalida_liste(cur, 'volontari')
             conn.commit()
             flash(f"Volontario {nome} {cognome} aggiunto con successo!", "success")
             return redirect(url_for('lista_volontari'))
@@ -689,7 +553,7 @@ def aggiungi_volontario():
             if cur:
                 cur.close()
             if conn:
-                conn.close()
+                release_db_connection(conn)
     
     return render_template('aggiungi_volontario.html')
 
@@ -698,9 +562,6 @@ def modifica_volontario(email):
     if not session.get('logged_in', False):
         return redirect(url_for('admin_login'))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     if request.method == 'POST':
         cognome = request.form.get('cognome')
         nome = request.form.get('nome')
@@ -715,12 +576,15 @@ def modifica_volontario(email):
                 'competenze': competenze, 'disponibilita': disponibilita
             })
 
+        conn = get_db_connection()
+        cur = conn.cursor()
         try:
             cur.execute("""
                 UPDATE volontari 
                 SET cognome = %s, nome = %s, telefono = %s, competenze = %s, disponibilita = %s
                 WHERE email = %s
             """, (cognome, nome, telefono, competenze, disponibilita, email))
+            invalida_liste(cur, 'volontari')
             conn.commit()
             flash(f"Volontario {nome} {cognome} aggiornato con successo!", "success")
             return redirect(url_for('lista_volontari'))
@@ -730,8 +594,10 @@ def modifica_volontario(email):
             if cur:
                 cur.close()
             if conn:
-                conn.close()
+                release_db_connection(conn)
 
+    conn = get_db_connection()
+    cur = conn.cursor()
     try:
         cur.execute("SELECT email, cognome, nome, telefono, competenze, disponibilita FROM volontari WHERE email = %s", (email,))
         volontario = cur.fetchone()
@@ -745,7 +611,7 @@ def modifica_volontario(email):
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_db_connection(conn)
 
     return render_template('modifica_volontario.html', volontario=volontario)
 
@@ -757,22 +623,27 @@ def elimina_volontario(email):
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT COUNT(*) FROM visite WHERE volontario_email = %s", (email,))
-        visite_count = cur.fetchone()[0]
-        if visite_count > 0:
+        cur.execute("SELECT visite FROM riepilogo_volontari WHERE volontario_email = %s", (email,))
+        riga = cur.fetchone()
+        if riga and riga[0] > 0:
             flash("Impossibile eliminare: il volontario ha visite associate.", "error")
             return redirect(url_for('lista_volontari'))
 
         cur.execute("DELETE FROM volontari WHERE email = %s", (email,))
+        invalida_liste(cur, 'volontari')
         conn.commit()
         flash("Volontario eliminato con successo!", "success")
+    except psycopg.errors.ForeignKeyViolation:
+        # Una visita inserita dopo il controllo: la chiave esterna impedisce comunque l'eliminazione
+        conn.rollback()
+        flash("Impossibile eliminare: il volontario ha visite associate.", "error")
     except psycopg.OperationalError as e:
         flash(f"Errore nell'eliminazione del volontario: {e}", "error")
     finally:
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_db_connection(conn)
     
     return redirect(url_for('lista_volontari'))
 
@@ -780,83 +651,84 @@ def elimina_volontario(email):
 def inserisci_visita():
     session['logged_in'] = False
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    try:
-        cur.execute("SELECT nome_sigla, citta FROM assistiti ORDER BY nome_sigla")
-        assistiti = cur.fetchall()
-        cur.execute("SELECT email, cognome, nome FROM volontari ORDER BY cognome, nome")
-        volontari = cur.fetchall()
-    except psycopg.OperationalError as e:
-        flash(f"Errore nel caricamento dei dati: {e}", "error")
-        assistiti = []
-        volontari = []
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
-        return render_template('inserisci_visita.html', assistiti=assistiti, volontari=volontari)
-    
-    if cur:
-        cur.close()
-    if conn:
-        conn.close()
-    
+    # Volontari e assistiti arrivano da /api/cerca mentre si scrive: la pagina non tocca il database
+    # Un modulo non valido viene ridisegnato con il messaggio e lo stato 400
     if request.method == 'POST':
-        volontario_email = request.form.get('volontario_email')
-        volontario_cognome = request.form.get('volontario_cognome')
-        volontario_nome = request.form.get('volontario_nome')
-        telefono = request.form.get('telefono')
-        competenze = request.form.get('competenze')
-        disponibilita = request.form.get('disponibilita')
-        assistito_nome = request.form.get('assistito_nome')
-        accoglienza = request.form.get('accoglienza')
-        data_visita = request.form.get('data_visita')
-        necessita = request.form.get('necessita')
-        cosa_migliorare = request.form.get('cosa_migliorare')
-
-        if not volontario_email or not assistito_nome or not accoglienza or not data_visita:
-            flash("Email, assistito, accoglienza e data visita sono obbligatori.", "error")
-            return render_template('inserisci_visita.html', assistiti=assistiti, volontari=volontari)
+        errore = errore_modulo_visita(request.form)
+        if errore:
+            flash(errore, "error")
+            return render_template('inserisci_visita.html', lotto_max=VISITE_LOTTO_MAX), 400
 
+        # Volontario (se nuovo) e visita in un'unica istruzione, vedi query_visite.INSERISCI_VISITA
         conn = get_db_connection()
         cur = conn.cursor()
         try:
-            cur.execute("SELECT email, cognome, nome FROM volontari WHERE email = %s", (volontario_email,))
-            existing_volontario = cur.fetchone()
-            if not existing_volontario and (not volontario_cognome or not volontario_nome):
-                flash("Cognome e nome sono obbligatori per un nuovo volontario.", "error")
-                if cur:
-                    cur.close()
-                if conn:
-                    conn.close()
-                return render_template('inserisci_visita.html', assistiti=assistiti, volontari=volontari)
-
-            if not existing_volontario:
-                cet = pytz.timezone('Europe/Rome')
-                data_iscrizione = datetime.now(cet)
-                cur.execute("""
-                    INSERT INTO volontari (email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """, (volontario_email, volontario_cognome, volontario_nome, telefono, competenze, disponibilita, data_iscrizione))
-
-            cur.execute("""
-                INSERT INTO visite (volontario_email, assistito_nome, accoglienza, data_visita, necessita, cosa_migliorare)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (volontario_email, assistito_nome, accoglienza, data_visita, necessita, cosa_migliorare))
+            cur.execute(INSERISCI_VISITA, parametri_visita(request.form), prepare=True)
+            _, volontario_nuovo = cur.fetchone()
             conn.commit()
+            if volontario_nuovo:
+                scarta('volontari')
             flash("Visita inserita con successo!", "success")
             return redirect(url_for('inserisci_visita'))
+        except psycopg.errors.ForeignKeyViolation as e:
+            conn.rollback()
+            flash(messaggio_chiave_mancante(e), "error")
+        except psycopg.DataError as e:
+            conn.rollback()
+            flash(f"Dati della visita non validi: {e}", "error")
+            return render_template('inserisci_visita.html', lotto_max=VISITE_LOTTO_MAX), 400
         except psycopg.OperationalError as e:
             flash(f"Errore nell'inserimento della visita: {e}", "error")
         finally:
             if cur:
                 cur.close()
             if conn:
-                conn.close()
+                release_db_connection(conn)
     
-    return render_template('inserisci_visita.html', assistiti=assistiti, volontari=volontari)
+    return render_template('inserisci_visita.html', lotto_max=VISITE_LOTTO_MAX)
+
+# Suggerimenti per i campi volontario e assistito (vedi ricerca.py). Come il modulo
+# delle visite non richiede il login.
+@app.route('/api/cerca', methods=['GET'])
+def api_cerca():
+    tipo = request.args.get('tipo', '')
+    if tipo not in RICERCHE:
+        return jsonify({'errore': "Tipo di ricerca non valido."}), 400
+    try:
+        risultati = cerca(tipo, request.args.get('q', '')[:100])
+    except psycopg.OperationalError as e:
+        logging.error(f"Errore nella ricerca di {tipo}: {e}")
+        return jsonify({'errore': "Database non raggiungibile, riprovare più tardi."}), 503
+    return jsonify({'risultati': risultati})
+
+# Visite accodate dal modulo senza connessione e inviate insieme (vedi lotto_visite.py).
+# Come il modulo non richiede il login. Su errori di connessione risponde 503 e il
+# browser ritenta più tardi con le stesse chiavi.
+@app.route('/api/visite/lotto', methods=['POST'])
+def inserisci_visite_lotto():
+    dati = request.get_json(silent=True)
+    voci = dati.get('visite') if isinstance(dati, dict) else None
+    if not isinstance(voci, list):
+        return jsonify({'errore': "Atteso un oggetto JSON con l'elenco 'visite'."}), 400
+    if len(voci) > VISITE_LOTTO_MAX:
+        return jsonify({'errore': f"Al massimo {VISITE_LOTTO_MAX} visite per invio."}), 413
+
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        risultati = inserisci_lotto(cur, voci)
+        conn.commit()
+        return jsonify({'risultati': risultati})
+    except psycopg.OperationalError as e:
+        logging.error(f"Errore nell'inserimento del lotto di visite: {e}")
+        return jsonify({'errore': "Database non raggiungibile, riprovare più tardi."}), 503
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            release_db_connection(conn)
 
 @app.route('/assistiti', methods=['GET'])
 def lista_assistiti():
@@ -875,7 +747,7 @@ def lista_assistiti():
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_db_connection(conn)
     
     return render_template('assistiti.html', assistiti=assistiti)
 
@@ -901,6 +773,7 @@ def aggiungi_assistito():
                 return render_template('aggiungi_assistito.html')
             
             cur.execute("INSERT INTO assistiti (nome_sigla, citta) VALUES (%s, %s)", (nome_sigla, citta))
+            invalida_liste(cur, 'assistiti')
             conn.commit()
             flash(f"Assistito {nome_sigla} aggiunto con successo!", "success")
             return redirect(url_for('lista_assistiti'))
@@ -910,7 +783,7 @@ def aggiungi_assistito():
             if cur:
                 cur.close()
             if conn:
-                conn.close()
+                release_db_connection(conn)
     
     return render_template('aggiungi_assistito.html')
 
@@ -919,17 +792,17 @@ def modifica_assistito(nome_sigla):
     if not session.get('logged_in', False):
         return redirect(url_for('admin_login'))
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     if request.method == 'POST':
         citta = request.form.get('citta')
         if not citta:
             flash("La città è obbligatoria.", "error")
             return render_template('modifica_assistito.html', assistito={'nome_sigla': nome_sigla, 'citta': citta})
 
+        conn = get_db_connection()
+        cur = conn.cursor()
         try:
             cur.execute("UPDATE assistiti SET citta = %s WHERE nome_sigla = %s", (citta, nome_sigla))
+            invalida_liste(cur, 'assistiti')
             conn.commit()
             flash(f"Assistito {nome_sigla} aggiornato con successo!", "success")
             return redirect(url_for('lista_assistiti'))
@@ -939,8 +812,10 @@ def modifica_assistito(nome_sigla):
             if cur:
                 cur.close()
             if conn:
-                conn.close()
+                release_db_connection(conn)
 
+    conn = get_db_connection()
+    cur = conn.cursor()
     try:
         cur.execute("SELECT nome_sigla, citta FROM assistiti WHERE nome_sigla = %s", (nome_sigla,))
         assistito = cur.fetchone()
@@ -954,7 +829,7 @@ def modifica_assistito(nome_sigla):
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_db_connection(conn)
 
     return render_template('modifica_assistito.html', assistito=assistito)
 
@@ -966,13 +841,14 @@ def elimina_assistito(nome_sigla):
     conn = get_db_connection()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT COUNT(*) FROM visite WHERE assistito_nome = %s", (nome_sigla,))
+        cur.execute(CONTA_VISITE_ASSISTITO, (nome_sigla,))
         visite_count = cur.fetchone()[0]
         if visite_count > 0:
             flash("Impossibile eliminare: l'assistito ha visite associate.", "error")
             return redirect(url_for('lista_assistiti'))
 
         cur.execute("DELETE FROM assistiti WHERE nome_sigla = %s", (nome_sigla,))
+        invalida_liste(cur, 'assistiti')
         conn.commit()
         flash(f"Assistito {nome_sigla} eliminato con successo!", "success")
     except psycopg.OperationalError as e:
@@ -981,10 +857,49 @@ def elimina_assistito(nome_sigla):
         if cur:
             cur.close()
         if conn:
-            conn.close()
+            release_db_connection(conn)
     
     return redirect(url_for('lista_assistiti'))
 
+@app.route('/pool_stats')
+def statistiche_pool():
+    if not session.get('logged_in', False):
+        return redirect(url_for('admin_login'))
+
+    return jsonify(pool_stats())
+
+# Metriche di questo worker in formato Prometheus (vedi metriche.py).
+# Un sistema di monitoraggio si autentica con "Authorization: Bearer <METRICHE_TOKEN>".
+@app.route('/metrics')
+def metrics():
+    token = metriche.METRICHE_TOKEN
+    autorizzazione = request.headers.get('Authorization', '').encode('utf-8')
+    if not session.get('logged_in', False) and not (token and hmac.compare_digest(autorizzazione, f"Bearer {token}".encode('utf-8'))):
+        return Response("non autorizzato\n", status=401, mimetype='text/plain')
+
+    stats = pool_stats()
+    extra = {
+        'scheda_pool_connessioni_in_uso': ("Connessioni del pool in uso", stats.get('in_uso', 0)),
+        'scheda_pool_connessioni': ("Connessioni aperte dal pool", stats.get('dimensione', 0)),
+        'scheda_pool_richieste_in_attesa': ("Richieste in coda per una connessione", stats.get('in_attesa', 0)),
+        'scheda_pool_richieste_scadute': ("Richieste scadute in attesa del pool, dall'avvio", stats.get('richieste_scadute', 0)),
+    }
+    return Response(metriche.testo_prometheus(extra), mimetype='text/plain; version=0.0.4')
+
+# Lavori pianificati: se questo worker è quello che li esegue e le ultime esecuzioni
+@app.route('/pianificatore')
+def stato_pianificatore():
+    if not session.get('logged_in', False):
+        return redirect(url_for('admin_login'))
+
+    conn = get_db_connection()
+    try:
+        return jsonify({'leader': e_leader(), 'storico': storico(conn)})
+    except psycopg.Error as e:
+        return jsonify({'leader': e_leader(), 'errore': str(e)}), 503
+    finally:
+        release_db_connection(conn)
+
 @app.route('/logout')
 def logout():
     session.pop('logged_in', None)
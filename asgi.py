@@ -0,0 +1,183 @@
+import os
+import time
+import logging
+from urllib.parse import parse_qs
+import psycopg
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from psycopg_pool import AsyncConnectionPool
+from werkzeug.http import parse_cookie
+from werkzeug.utils import redirect
+from app import app
+from cache import scarta
+from db import DB_CONNECT_KWARGS
+from metriche import METRICHE, CursoreMisuratoAsincrono, apri_richiesta, chiudi_richiesta, registra_attesa_pool
+from query_visite import INSERISCI_VISITA, parametri_visita, errore_modulo_visita, messaggio_chiave_mancante
+
+# Avvio asincrono dell'applicazione, per i picchi di inserimento delle visite
+# (tutti i volontari che compilano la scheda a fine turno):
+#
+#     uvicorn asgi:applicazione --host 0.0.0.0 --port $PORT --workers 2
+#
+# Il POST di /inserisci_visita è gestito qui con un pool di connessioni asincrone:
+# mentre una richiesta aspetta il database il processo ne serve altre, quindi pochi
+# processi reggono molti invii contemporanei. Tutte le altre richieste (compresa la
+# pagina del modulo, servita dalla cache degli elenchi) passano all'app Flask
+# invariata, eseguita in un thread. Sessione e messaggi flash usano lo stesso cookie
+# firmato di Flask, quindi le due parti si vedono a vicenda. Un modulo non valido
+# passa anch'esso all'app Flask, che lo ridisegna con il messaggio e lo stato 400.
+# Durata, query e attesa del pool finiscono nelle stesse metriche della route Flask.
+#
+# Il confronto con l'avvio sincrono (gunicorn app:app) è in load_test.py.
+
+ASYNC_POOL_MIN_SIZE = int(os.getenv('ASYNC_POOL_MIN_SIZE', 1))
+ASYNC_POOL_MAX_SIZE = int(os.getenv('ASYNC_POOL_MAX_SIZE', 10))
+ASYNC_POOL_TIMEOUT = float(os.getenv('ASYNC_POOL_TIMEOUT', 10))
+# Thread che eseguono le richieste passate all'app Flask
+ASGI_FLASK_THREADS = int(os.getenv('ASGI_FLASK_THREADS', 10))
+
+flask_asgi = WSGIMiddleware(app, workers=ASGI_FLASK_THREADS)
+_pool = None
+
+async def apri_pool():
+    global _pool
+    kwargs = dict(DB_CONNECT_KWARGS)
+    if METRICHE:
+        kwargs['cursor_factory'] = CursoreMisuratoAsincrono
+    _pool = AsyncConnectionPool(
+        os.getenv('DATABASE_URL'),
+        kwargs=kwargs,
+        min_size=ASYNC_POOL_MIN_SIZE,
+        max_size=ASYNC_POOL_MAX_SIZE,
+        timeout=ASYNC_POOL_TIMEOUT,
+        check=AsyncConnectionPool.check_connection,
+        name='scheda-volontari-async',
+        open=False,
+    )
+    await _pool.open(wait=False)
+
+async def chiudi_pool():
+    if _pool is not None:
+        await _pool.close()
+
+# Sessione Flask letta dal cookie della richiesta (come SecureCookieSessionInterface.open_session)
+def apri_sessione(scope):
+    interfaccia = app.session_interface
+    cookie = b'; '.join(valore for nome, valore in scope['headers'] if nome == b'cookie')
+    valore = parse_cookie(cookie.decode('latin-1')).get(interfaccia.get_cookie_name(app))
+    dati = {}
+    if valore:
+        try:
+            dati = interfaccia.get_signing_serializer(app).loads(
+                valore, max_age=int(app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            pass
+    return interfaccia.session_class(dati)
+
+def flash_sessione(sessione, messaggio, categoria):
+    sessione.setdefault('_flashes', []).append((categoria, messaggio))
+
+# receive per l'app Flask quando il corpo della richiesta è già stato letto qui
+def rileggi_corpo(corpo):
+    messaggi = [{'type': 'http.request', 'body': corpo, 'more_body': False}]
+
+    async def receive():
+        return messaggi.pop() if messaggi else {'type': 'http.disconnect'}
+    return receive
+
+async def leggi_corpo(receive):
+    corpo = b''
+    while True:
+        messaggio = await receive()
+        corpo += messaggio.get('body', b'')
+        if not messaggio.get('more_body'):
+            return corpo
+
+async def invia(send, risposta):
+    await send({
+        'type': 'http.response.start',
+        'status': risposta.status_code,
+        'headers': [(nome.lower().encode('latin-1'), valore.encode('latin-1'))
+                    for nome, valore in risposta.headers.to_wsgi_list()],
+    })
+    await send({'type': 'http.response.body', 'body': risposta.get_data()})
+
+# Stessa istruzione della route sincrona (query_visite.INSERISCI_VISITA), per un modulo
+# già controllato. Restituisce il messaggio flash e la sua categoria, None se i dati
+# sono stati rifiutati dal database (DataError) e il modulo va ridisegnato.
+async def salva_visita(modulo):
+    try:
+        inizio = time.perf_counter()
+        async with _pool.connection() as conn:
+            if METRICHE:
+                registra_attesa_pool(time.perf_counter() - inizio)
+            cur = await conn.execute(INSERISCI_VISITA, parametri_visita(modulo), prepare=True)
+            _, volontario_nuovo = await cur.fetchone()
+        # Il commit avviene all'uscita dal blocco della connessione
+        if volontario_nuovo:
+            scarta('volontari')
+        return "Visita inserita con successo!", "success"
+    except psycopg.errors.ForeignKeyViolation as e:
+        return messaggio_chiave_mancante(e), "error"
+    except psycopg.DataError:
+        return None
+    except psycopg.OperationalError as e:
+        logging.error(f"Errore nell'inserimento asincrono della visita: {e}")
+        return f"Errore nell'inserimento della visita: {e}", "error"
+
+# Dopo un inserimento, riuscito o rifiutato per volontario o assistito mancante, si
+# torna al modulo con un redirect e il messaggio flash. Un modulo non valido passa
+# all'app Flask, che lo ridisegna con lo stato 400 senza duplicare qui la pagina.
+async def inserisci_visita(scope, receive, send):
+    corpo = await leggi_corpo(receive)
+    modulo = {nome: valori[0] for nome, valori in parse_qs(corpo.decode('utf-8'), keep_blank_values=True).items()}
+    if errore_modulo_visita(modulo):
+        await flask_asgi(scope, rileggi_corpo(corpo), send)
+        return
+
+    stato = apri_richiesta(scope['path']) if METRICHE else None
+    codice = 500
+    try:
+        esito = await salva_visita(modulo)
+        if esito is None:
+            codice = None
+        else:
+            sessione = apri_sessione(scope)
+            sessione['logged_in'] = False
+            flash_sessione(sessione, *esito)
+            risposta = redirect(scope.get('root_path', '') + scope['path'])
+            app.session_interface.save_session(app, sessione, risposta)
+            if stato:
+                stato['byte'] = len(risposta.get_data())
+            await invia(send, risposta)
+            codice = risposta.status_code
+    finally:
+        if stato and codice:
+            chiudi_richiesta(stato, 'POST', codice, stato['token'])
+    # Dati rifiutati dal database: il modulo lo ridisegna la route Flask, che misura la richiesta
+    if codice is None:
+        await flask_asgi(scope, rileggi_corpo(corpo), send)
+
+def modulo_urlencoded(scope):
+    for nome, valore in scope['headers']:
+        if nome == b'content-type':
+            return valore.split(b';')[0].strip() == b'application/x-www-form-urlencoded'
+    return False
+
+async def applicazione(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            messaggio = await receive()
+            if messaggio['type'] == 'lifespan.startup':
+                await apri_pool()
+                await send({'type': 'lifespan.startup.complete'})
+            elif messaggio['type'] == 'lifespan.shutdown':
+                await chiudi_pool()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if (scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/inserisci_visita'
+            and _pool is not None and modulo_urlencoded(scope)):
+        await inserisci_visita(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
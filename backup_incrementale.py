@@ -0,0 +1,249 @@
+import os
+import gzip
+import json
+import shutil
+import logging
+import argparse
+import hashlib
+import psycopg
+from datetime import datetime
+from dotenv import load_dotenv
+from cache import invalida_liste
+from esportazione import BACKUP_DIR, copia_csv
+
+# Backup incrementali compressi.
+#
+# Ogni riga di visite, volontari e assistiti porta in backup_xid l'id della
+# transazione che l'ha scritta (trigger), le eliminazioni finiscono in
+# backup_eliminazioni. Ogni backup registra nel manifest lo xmin del proprio
+# snapshot: il backup successivo esporta solo le righe con backup_xid >= quel
+# valore. La sovrapposizione è voluta: il ripristino applica upsert idempotenti.
+# Un TRUNCATE (ripristino completo) lascia un segnale che forza uno snapshot completo.
+# Colonne, trigger e registro sono creati dalla migrazione 12.
+
+INCREMENTALI_DIR = os.path.join(BACKUP_DIR, 'incrementali')
+MANIFEST = os.path.join(INCREMENTALI_DIR, 'manifest.json')
+BACKUP_COMPLETO_OGNI_GIORNI = int(os.getenv('BACKUP_COMPLETO_OGNI_GIORNI', 7))
+BACKUP_CATENE_DA_TENERE = int(os.getenv('BACKUP_CATENE_DA_TENERE', 2))
+
+# Tabella, chiave usata per eliminazioni e upsert, colonne esportate
+TABELLE = [
+    ('assistiti', 'nome_sigla', ['nome_sigla', 'citta']),
+    ('volontari', 'email', ['email', 'cognome', 'nome', 'telefono', 'competenze', 'disponibilita', 'data_iscrizione']),
+    ('visite', 'id', ['id', 'volontario_email', 'assistito_nome', 'accoglienza', 'data_visita', 'necessita', 'cosa_migliorare']),
+]
+
+# Migrazione che crea backup_xid, i trigger e backup_eliminazioni (migrazioni.py)
+MIGRAZIONE_REGISTRO = 12
+
+_schema_pronto = False
+
+# Lo schema del registro arriva dalle migrazioni: qui si controlla solo che ci sia
+def assicura_schema(conn):
+    global _schema_pronto
+    if _schema_pronto:
+        return
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM schema_migrazioni WHERE versione = %s", (MIGRAZIONE_REGISTRO,))
+            pronto = cur.fetchone() is not None
+    except psycopg.errors.UndefinedTable:
+        pronto = False
+    conn.rollback()
+    if not pronto:
+        raise RuntimeError(f"Migrazione {MIGRAZIONE_REGISTRO} non applicata: eseguire \"python migrazioni.py applica\" prima dei backup incrementali.")
+    _schema_pronto = True
+
+def leggi_manifest():
+    if not os.path.exists(MANIFEST):
+        return {'backup': []}
+    with open(MANIFEST, encoding='utf-8') as f:
+        return json.load(f)
+
+def scrivi_manifest(manifest):
+    temporaneo = MANIFEST + '.tmp'
+    with open(temporaneo, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temporaneo, MANIFEST)
+
+def serve_completo(cur, manifest, forza_completo):
+    if forza_completo or not manifest['backup']:
+        return True
+    ultimo_completo = next(b for b in reversed(manifest['backup']) if b['tipo'] == 'completo')
+    if (datetime.now() - datetime.fromisoformat(ultimo_completo['creato'])).days >= BACKUP_COMPLETO_OGNI_GIORNI:
+        return True
+    # Un TRUNCATE dopo l'ultimo backup non lascia traccia riga per riga
+    cur.execute("SELECT EXISTS (SELECT 1 FROM backup_eliminazioni WHERE chiave IS NULL AND backup_xid >= %s::xid8)",
+                (manifest['backup'][-1]['xmin'],))
+    return cur.fetchone()[0]
+
+def sha256_file(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for dati in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(dati)
+    return sha.hexdigest()
+
+def scrivi_blocco(cur, filename, query, params=None):
+    with gzip.open(filename, 'wb') as f:
+        for blocco in copia_csv(cur, query, params):
+            f.write(blocco)
+    return {'file': os.path.basename(filename), 'righe': cur.rowcount, 'byte': os.path.getsize(filename), 'sha256': sha256_file(filename)}
+
+# Esegue un backup (completo o incrementale) e restituisce la voce aggiunta al manifest
+def esegui_backup_incrementale(conn, forza_completo=False):
+    assicura_schema(conn)
+    os.makedirs(INCREMENTALI_DIR, exist_ok=True)
+    manifest = leggi_manifest()
+    with conn.cursor() as cur:
+        # Tutte le tabelle vengono lette dallo stesso snapshot
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        completo = serve_completo(cur, manifest, forza_completo)
+        cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text")
+        xmin = cur.fetchone()[0]
+        da_xid = None if completo else manifest['backup'][-1]['xmin']
+
+        numero = manifest['backup'][-1]['numero'] + 1 if manifest['backup'] else 1
+        tipo = 'completo' if completo else 'incrementale'
+        nome = f"{numero:06d}_{tipo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        cartella = os.path.join(INCREMENTALI_DIR, nome)
+        os.makedirs(cartella)
+        try:
+            blocchi = {}
+            for tabella, _, colonne in TABELLE:
+                query = f"SELECT {', '.join(colonne)} FROM {tabella}"
+                params = None
+                if da_xid:
+                    query += " WHERE backup_xid >= %s::xid8"
+                    params = (da_xid,)
+                blocchi[tabella] = scrivi_blocco(cur, os.path.join(cartella, f"{tabella}.csv.gz"), query, params)
+            if da_xid:
+                blocchi['eliminazioni'] = scrivi_blocco(
+                    cur, os.path.join(cartella, 'eliminazioni.csv.gz'),
+                    "SELECT tabella, chiave FROM backup_eliminazioni WHERE chiave IS NOT NULL AND backup_xid >= %s::xid8 ORDER BY id",
+                    (da_xid,))
+        except BaseException:
+            shutil.rmtree(cartella, ignore_errors=True)
+            raise
+        finally:
+            conn.rollback()
+
+    voce = {'numero': numero, 'tipo': tipo, 'cartella': nome, 'creato': datetime.now().isoformat(timespec='seconds'),
+            'da_xid': da_xid, 'xmin': xmin, 'blocchi': blocchi}
+    manifest['backup'].append(voce)
+    scrivi_manifest(manifest)
+
+    # Le eliminazioni precedenti al nuovo punto di partenza non servono più
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM backup_eliminazioni WHERE backup_xid < %s::xid8", (xmin,))
+    conn.commit()
+    pulisci_catene(manifest)
+    logging.info(f"Backup {tipo} {nome} creato: " + ', '.join(f"{t} {b['righe']}" for t, b in blocchi.items()))
+    return voce
+
+# Mantiene solo le ultime BACKUP_CATENE_DA_TENERE catene (snapshot completo + incrementali)
+def pulisci_catene(manifest):
+    completi = [i for i, b in enumerate(manifest['backup']) if b['tipo'] == 'completo']
+    if len(completi) <= BACKUP_CATENE_DA_TENERE:
+        return
+    primo_da_tenere = completi[-BACKUP_CATENE_DA_TENERE]
+    for voce in manifest['backup'][:primo_da_tenere]:
+        shutil.rmtree(os.path.join(INCREMENTALI_DIR, voce['cartella']), ignore_errors=True)
+        logging.info(f"Eliminato backup vecchio: {voce['cartella']}")
+    manifest['backup'] = manifest['backup'][primo_da_tenere:]
+    scrivi_manifest(manifest)
+
+def carica_blocco(cur, filename, tabella, colonne):
+    with gzip.open(filename, 'rb') as f, cur.copy(f"COPY {tabella} ({', '.join(colonne)}) FROM STDIN WITH (FORMAT csv)") as copy:
+        for dati in iter(lambda: f.read(1024 * 1024), b''):
+            copy.write(dati)
+
+def applica_incremento(cur, cartella, voce):
+    if 'eliminazioni' in voce['blocchi']:
+        cur.execute("CREATE TEMP TABLE ripristino_eliminazioni (tabella TEXT, chiave TEXT) ON COMMIT DROP")
+        carica_blocco(cur, os.path.join(cartella, 'eliminazioni.csv.gz'), 'ripristino_eliminazioni', ['tabella', 'chiave'])
+        for tabella, chiave, _ in reversed(TABELLE):
+            tipo = '::integer' if chiave == 'id' else ''
+            cur.execute(f"DELETE FROM {tabella} WHERE {chiave} IN (SELECT chiave{tipo} FROM ripristino_eliminazioni WHERE tabella = %s)", (tabella,))
+        cur.execute("DROP TABLE ripristino_eliminazioni")
+    for tabella, chiave, colonne in TABELLE:
+        temporanea = f"ripristino_{tabella}"
+        elenco = ', '.join(colonne)
+        cur.execute(f"CREATE TEMP TABLE {temporanea} ON COMMIT DROP AS SELECT {elenco} FROM {tabella} WITH NO DATA")
+        carica_blocco(cur, os.path.join(cartella, voce['blocchi'][tabella]['file']), temporanea, colonne)
+        aggiorna = ', '.join(f"{c} = EXCLUDED.{c}" for c in colonne if c != chiave)
+        if chiave == 'id':
+            # Con visite partizionata non c'è un indice unico sul solo id (vedi
+            # partizioni.py): le righe vengono sostituite invece dell'upsert
+            cur.execute(f"DELETE FROM {tabella} WHERE id IN (SELECT id FROM {temporanea})")
+            cur.execute(f"INSERT INTO {tabella} ({elenco}) OVERRIDING SYSTEM VALUE SELECT {elenco} FROM {temporanea}")
+        else:
+            cur.execute(f"INSERT INTO {tabella} ({elenco}) SELECT {elenco} FROM {temporanea} "
+                        f"ON CONFLICT ({chiave}) DO UPDATE SET {aggiorna}")
+        cur.execute(f"DROP TABLE {temporanea}")
+
+# Ripristina l'ultimo snapshot completo fino al backup numero fino_a (o all'ultimo)
+# riapplicando in ordine gli incrementali, tutto in una transazione.
+def ripristina_incrementale(conn, fino_a=None):
+    assicura_schema(conn)
+    voci = leggi_manifest()['backup']
+    if fino_a is not None:
+        voci = [b for b in voci if b['numero'] <= fino_a]
+    completi = [i for i, b in enumerate(voci) if b['tipo'] == 'completo']
+    if not completi:
+        raise ValueError("Nessuno snapshot completo disponibile.")
+    catena = voci[completi[-1]:]
+    for voce in catena:
+        for blocco in voce['blocchi'].values():
+            if sha256_file(os.path.join(INCREMENTALI_DIR, voce['cartella'], blocco['file'])) != blocco['sha256']:
+                raise ValueError(f"Backup {voce['cartella']}: checksum di {blocco['file']} non valido.")
+    with conn.cursor() as cur:
+        try:
+            cur.execute("TRUNCATE visite, volontari, assistiti")
+            for voce in catena:
+                cartella = os.path.join(INCREMENTALI_DIR, voce['cartella'])
+                if voce['tipo'] == 'completo':
+                    for tabella, _, colonne in TABELLE:
+                        carica_blocco(cur, os.path.join(cartella, voce['blocchi'][tabella]['file']), tabella, colonne)
+                else:
+                    applica_incremento(cur, cartella, voce)
+                logging.info(f"Ripristino incrementale: applicato {voce['cartella']}")
+            cur.execute("SELECT setval(pg_get_serial_sequence('visite', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM visite")
+            invalida_liste(cur, 'volontari', 'assistiti')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return catena
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Backup incrementali di scheda-volontari")
+    sotto = parser.add_subparsers(dest='comando', required=True)
+    backup = sotto.add_parser('backup', help="esegue un backup (incrementale se possibile)")
+    backup.add_argument('--completo', action='store_true', help="forza uno snapshot completo")
+    ripristina = sotto.add_parser('ripristina', help="ripristina snapshot + incrementali")
+    ripristina.add_argument('--fino-a', type=int, help="numero dell'ultimo backup da applicare")
+    sotto.add_parser('elenco', help="mostra i backup nel manifest")
+    args = parser.parse_args()
+
+    if args.comando == 'elenco':
+        for voce in leggi_manifest()['backup']:
+            righe = ', '.join(f"{t} {b['righe']}" for t, b in voce['blocchi'].items())
+            print(f"{voce['numero']:6d}  {voce['tipo']:<12} {voce['creato']}  {righe}")
+        return
+
+    from db import get_db_connection, release_db_connection
+    conn = get_db_connection()
+    try:
+        if args.comando == 'backup':
+            voce = esegui_backup_incrementale(conn, forza_completo=args.completo)
+            print(f"Creato {voce['cartella']}")
+        else:
+            catena = ripristina_incrementale(conn, args.fino_a)
+            print(f"Ripristinati {len(catena)} backup, fino a {catena[-1]['cartella']}")
+    finally:
+        release_db_connection(conn)
+
+if __name__ == '__main__':
+    main()
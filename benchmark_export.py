@@ -0,0 +1,104 @@
+import os
+import csv
+import time
+import argparse
+import tempfile
+from io import StringIO
+import psycopg
+from dotenv import load_dotenv
+from seed_dati import crea_schema, svuota, popola
+from esportazione import esporta_report_csv, scrivi_backup
+
+# Righe al secondo dell'esportazione CSV: csv.writer riga per riga contro COPY ... TO STDOUT
+
+QUERY_VISITE = """
+    SELECT v.volontario_email, v.assistito_nome, v.accoglienza, v.data_visita, v.necessita, v.cosa_migliorare,
+           vol.cognome, vol.nome, ass.citta
+    FROM visite v
+    JOIN volontari vol ON v.volontario_email = vol.email
+    JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
+"""
+
+def csv_riga_per_riga(conn):
+    totale = 0
+    with conn.cursor(name='benchmark_export') as cur:
+        cur.itersize = 2000
+        cur.execute(QUERY_VISITE)
+        output = StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        while True:
+            visite = cur.fetchmany(2000)
+            if not visite:
+                break
+            output.seek(0)
+            output.truncate()
+            for visita in visite:
+                writer.writerow([visita[0], visita[7], visita[6], visita[1], visita[8], visita[2], visita[3], visita[4] or 'Nessuna', visita[5] or 'Nessuno'])
+            totale += len(output.getvalue().encode('utf-8'))
+    return totale
+
+def csv_copy(conn):
+    with conn.cursor() as cur:
+        return sum(len(blocco) for blocco in esporta_report_csv(cur, '', []))
+
+def backup_riga_per_riga(conn, filename):
+    with conn.cursor() as cur, open(filename, 'w', newline='', encoding='utf-8') as output_file:
+        writer = csv.writer(output_file, lineterminator='\n')
+        cur.execute(QUERY_VISITE)
+        for visita in cur.fetchall():
+            writer.writerow([visita[0], visita[7], visita[6], visita[1], visita[8], visita[2], visita[3], visita[4] or '', visita[5] or ''])
+        cur.execute("SELECT email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione FROM volontari")
+        for volontario in cur.fetchall():
+            writer.writerow([volontario[0], volontario[1], volontario[2], volontario[3] or '', volontario[4] or '', volontario[5] or '', volontario[6] or ''])
+        cur.execute("SELECT nome_sigla, citta FROM assistiti")
+        for assistito in cur.fetchall():
+            writer.writerow([assistito[0], assistito[1]])
+    return os.path.getsize(filename)
+
+def backup_copy(conn, filename):
+    with conn.cursor() as cur:
+        scrivi_backup(cur, filename)
+    return os.path.getsize(filename)
+
+def misura(conn, nome, funzione, righe, ripetizioni, *args):
+    migliore = None
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        byte = funzione(conn, *args)
+        durata = time.perf_counter() - inizio
+        conn.rollback()
+        migliore = durata if migliore is None else min(migliore, durata)
+    print(f"  {nome:<26} {migliore * 1000:9.1f} ms   {righe / migliore:12,.0f} righe/s   {byte / migliore / 1e6:7.1f} MB/s")
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Benchmark dell'esportazione CSV e dei backup")
+    parser.add_argument('--database-url', default=os.getenv('SEED_DATABASE_URL'))
+    parser.add_argument('--visite', type=int, default=0, help="se > 0 ripopola il database con questo numero di visite")
+    parser.add_argument('--ripetizioni', type=int, default=3)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("specificare --database-url o SEED_DATABASE_URL")
+
+    with psycopg.connect(args.database_url, options='-c TimeZone=Europe/Rome') as conn:
+        if args.visite:
+            crea_schema(conn)
+            svuota(conn)
+            popola(conn, n_visite=args.visite)
+            conn.execute("ANALYZE")
+            conn.commit()
+        righe = conn.execute("SELECT COUNT(*) FROM visite").fetchone()[0]
+        conn.rollback()
+
+        print(f"Download CSV ({righe} visite)")
+        misura(conn, 'csv.writer', csv_riga_per_riga, righe, args.ripetizioni)
+        misura(conn, 'COPY TO STDOUT', csv_copy, righe, args.ripetizioni)
+
+        with tempfile.TemporaryDirectory() as cartella:
+            filename = os.path.join(cartella, 'backup.csv')
+            print("Backup completo")
+            misura(conn, 'csv.writer', backup_riga_per_riga, righe, args.ripetizioni, filename)
+            misura(conn, 'COPY TO STDOUT', backup_copy, righe, args.ripetizioni, filename)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import os
+import re
+import time
+import argparse
+import tempfile
+import tracemalloc
+import psycopg
+from dotenv import load_dotenv
+from reportlab import rl_config
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+from seed_dati import crea_schema, svuota, popola
+from query_visite import filtro_visite, leggi_visite
+from report_pdf import disegna_pdf
+from statistiche import statistiche_da_righe
+
+# Visite al secondo, pagine al secondo, byte per visita e picco di memoria del PDF
+# del report: il vecchio canvas con drawString a coordinate fisse (riga "prima")
+# contro l'impaginazione in tabella di report_pdf (riga "report_pdf"). Il picco di
+# memoria è misurato con tracemalloc in un'esecuzione a parte, più lenta.
+
+# Il vecchio renderer, come era prima di report_pdf (con la codifica ASCII85 dei flussi)
+def canvas_drawstring(visite, filename, progresso):
+    pdf = canvas.Canvas(filename, pagesize=A4)
+    pdf.setFont("Helvetica", 12)
+    pdf.drawString(100, 800, "Report Visite")
+
+    y = 780
+    for visita in visite:
+        pdf.drawString(50, y, f"Volontario: {visita[7]} {visita[6]} ({visita[0]})")
+        y -= 20
+        pdf.drawString(50, y, f"Assistito: {visita[1]} ({visita[8]})")
+        y -= 20
+        pdf.drawString(50, y, f"Accoglienza: {visita[2]}")
+        y -= 20
+        pdf.drawString(50, y, f"Data: {visita[3]}")
+        y -= 20
+        pdf.drawString(50, y, f"Necessità: {visita[4] or 'Nessuna'}")
+        y -= 20
+        pdf.drawString(50, y, f"Miglioramenti: {visita[5] or 'Nessuno'}")
+        y -= 40
+        if y < 50:
+            pdf.showPage()
+            y = 800
+
+    useA85 = rl_config.useA85
+    rl_config.useA85 = 1
+    try:
+        pdf.save()
+    finally:
+        rl_config.useA85 = useA85
+
+def tabella_report_pdf(visite, filename, progresso):
+    disegna_pdf(visite, statistiche_da_righe(visite), filename, progresso)
+
+def conta_pagine(filename):
+    with open(filename, 'rb') as f:
+        return len(re.findall(rb'/Type /Page[^s]', f.read()))
+
+def misura(nome, funzione, visite, filename, ripetizioni):
+    migliore = None
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        funzione(visite, filename, lambda *a: None)
+        durata = time.perf_counter() - inizio
+        migliore = durata if migliore is None else min(migliore, durata)
+    pagine = conta_pagine(filename)
+    byte = os.path.getsize(filename)
+    tracemalloc.start()
+    funzione(visite, filename, lambda *a: None)
+    picco = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"  {nome:<12} {migliore:8.2f} s   {pagine:6} pagine   {pagine / migliore:8.1f} pagine/s   "
+          f"{len(visite) / migliore:9,.0f} visite/s   {byte / len(visite):6.0f} byte/visita   "
+          f"picco {picco / 2**20:6.1f} MB")
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Benchmark della generazione del PDF del report")
+    parser.add_argument('--database-url', default=os.getenv('SEED_DATABASE_URL'))
+    parser.add_argument('--visite', type=int, default=0, help="se > 0 ripopola il database con questo numero di visite")
+    parser.add_argument('--dimensioni', type=int, nargs='+', default=[10000, 100000], help="visite per report")
+    parser.add_argument('--ripetizioni', type=int, default=1)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("specificare --database-url o SEED_DATABASE_URL")
+
+    with psycopg.connect(args.database_url, options='-c TimeZone=Europe/Rome') as conn:
+        if args.visite:
+            crea_schema(conn)
+            svuota(conn)
+            popola(conn, n_visite=args.visite)
+            conn.execute("ANALYZE")
+            conn.commit()
+        visite = leggi_visite(conn, filtro_visite('', '', ''), ordina='data', limite=max(args.dimensioni))
+        conn.rollback()
+
+    with tempfile.TemporaryDirectory() as cartella:
+        filename = os.path.join(cartella, 'report.pdf')
+        for dimensione in args.dimensioni:
+            campione = visite[:dimensione]
+            print(f"Report PDF ({len(campione)} visite)")
+            misura('prima', canvas_drawstring, campione, filename, args.ripetizioni)
+            misura('report_pdf', tabella_report_pdf, campione, filename, args.ripetizioni)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import os
+import time
+import argparse
+import statistics as stats
+from datetime import date, timedelta
+import psycopg
+from dotenv import load_dotenv
+from seed_dati import crea_schema, svuota, popola
+from query_visite import filtro_visite, leggi_visite
+from statistiche import calcola_statistiche, statistiche_da_righe, statistiche_giornaliere
+
+# Confronta il vecchio report (riga per riga + tre query di conteggio) con le
+# statistiche in un solo passaggio, sul server o ricavate dalle righe lette,
+# e con la somma dei conteggi precalcolati in statistiche_giornaliere.
+
+QUERY_VISITE = """
+    SELECT v.volontario_email, v.assistito_nome, v.accoglienza, v.data_visita, v.necessita, v.cosa_migliorare,
+           vol.cognome, vol.nome, ass.citta
+    FROM visite v
+    JOIN volontari vol ON v.volontario_email = vol.email
+    JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
+"""
+
+def statistiche_quattro_query(cur, where, params):
+    cur.execute("SELECT COUNT(*) FROM visite v" + where, params)
+    totale = cur.fetchone()[0]
+    cur.execute("SELECT v.accoglienza, COUNT(*) FROM visite v" + where + " GROUP BY v.accoglienza", params)
+    accoglienza = dict(cur.fetchall())
+    cur.execute("SELECT ass.citta, COUNT(*) FROM visite v JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla" + where + " GROUP BY ass.citta", params)
+    citta = dict(cur.fetchall())
+    return {'totale_visite': totale, 'accoglienza': accoglienza, 'visite_per_citta': citta}
+
+def percorso_vecchio(cur, where, params):
+    cur.execute(QUERY_VISITE + where, params)
+    cur.fetchall()
+    return statistiche_quattro_query(cur, where, params)
+
+def percorso_server(cur, where, params):
+    cur.execute(QUERY_VISITE + where, params)
+    cur.fetchall()
+    return calcola_statistiche(cur, where, params)
+
+def percorso_righe(cur, where, params):
+    return statistiche_da_righe(leggi_visite(cur.connection, (where, params)))
+
+def solo_statistiche_vecchio(cur, where, params):
+    return statistiche_quattro_query(cur, where, params)
+
+def solo_statistiche_server(cur, where, params):
+    return calcola_statistiche(cur, where, params)
+
+def solo_statistiche_giornaliere(cur, where, params, filtro):
+    return statistiche_giornaliere(cur, *filtro)
+
+PERCORSI = [
+    ('4 query', percorso_vecchio),
+    ('righe + grouping sets', percorso_server),
+    ('righe + conteggio in Python', percorso_righe),
+    ('solo statistiche, 3 query', solo_statistiche_vecchio),
+    ('solo statistiche, grouping sets', solo_statistiche_server),
+    ('solo statistiche, giornaliere', solo_statistiche_giornaliere),
+]
+
+def misura(conn, funzione, filtro, ripetizioni):
+    where, params = filtro_visite(*filtro)
+    argomenti = (filtro,) if funzione is solo_statistiche_giornaliere else ()
+    tempi = []
+    with conn.cursor() as cur:
+        for _ in range(ripetizioni):
+            inizio = time.perf_counter()
+            funzione(cur, where, params, *argomenti)
+            tempi.append((time.perf_counter() - inizio) * 1000)
+            conn.rollback()
+    return tempi
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Benchmark delle statistiche del report")
+    parser.add_argument('--database-url', default=os.getenv('SEED_DATABASE_URL'))
+    parser.add_argument('--visite', type=int, default=0, help="se > 0 ripopola il database con questo numero di visite")
+    parser.add_argument('--ripetizioni', type=int, default=5)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("specificare --database-url o SEED_DATABASE_URL")
+
+    with psycopg.connect(args.database_url, options='-c TimeZone=Europe/Rome') as conn:
+        if args.visite:
+            crea_schema(conn)
+            svuota(conn)
+            popola(conn, n_visite=args.visite)
+            conn.execute("ANALYZE")
+            conn.commit()
+
+        email = conn.execute("SELECT volontario_email FROM visite LIMIT 1").fetchone()[0]
+        inizio_anno = (date.today() - timedelta(days=365)).isoformat()
+        filtri = [
+            ('nessun filtro', ('', '', '')),
+            ('ultimo anno', ('', inizio_anno, '')),
+            ('un volontario', (email, '', '')),
+        ]
+
+        for nome_filtro, filtro in filtri:
+            where, params = filtro_visite(*filtro)
+            controllo = calcola_statistiche(conn.cursor(), where, params)
+            assert controllo == statistiche_da_righe(leggi_visite(conn, (where, params)))
+            assert controllo == statistiche_giornaliere(conn.cursor(), *filtro)
+            conn.rollback()
+            print(f"\n{nome_filtro} ({controllo['totale_visite']} visite)")
+            for nome, funzione in PERCORSI:
+                tempi = misura(conn, funzione, filtro, args.ripetizioni)
+                print(f"  {nome:<34} mediana {stats.median(tempi):9.1f} ms   min {min(tempi):9.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,453 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import random
+import platform
+import resource
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from datetime import date, datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+import psycopg
+from dotenv import load_dotenv
+from seed_dati import crea_schema, svuota, popola
+from cache import QUERY_LISTE
+
+# Benchmark delle route vere: richieste al secondo, latenza (p50, p90, p99) e picco
+# di memoria (RSS) per ogni scenario, salvati in JSON per confrontare due commit.
+#
+#     python benchmark_routes.py --database-url postgresql://.../bench --visite 300000 --json prima.json
+#     python benchmark_routes.py --database-url postgresql://.../bench --json dopo.json --confronta prima.json
+#     python benchmark_routes.py --url http://127.0.0.1:8000 --pid <pid del worker> --solo report
+#
+# Senza --url l'app gira in questo processo e le richieste passano dal test client
+# di Flask; con --url vanno via HTTP a un server già avviato (stesso database). Gli
+# scenari scrivono: /inserisci_visita aggiunge visite, /backup scrive file di backup
+# e /restore sostituisce tutti i dati con l'ultimo backup. Va usato solo su un
+# database di prova.
+#
+# Con --visite il database viene svuotato e ripopolato con seed_dati (seme fisso):
+# a parità di parametri i dati, e quindi i risultati, sono confrontabili.
+
+FINO_AL = date(2026, 1, 1)
+
+def richieste_per_thread(totale, concorrenza):
+    return [totale // concorrenza + (1 if i < totale % concorrenza else 0) for i in range(concorrenza)]
+
+class ClientTest:
+    def __init__(self, app, cookie=True):
+        self.client = app.test_client(use_cookies=cookie)
+
+    def richiesta(self, metodo, percorso, dati=None):
+        risposta = self.client.open(percorso, method=metodo, data=dati)
+        corpo = risposta.get_data()
+        risposta.close()
+        return risposta.status_code, corpo, risposta.headers
+
+class ClientHttp:
+    def __init__(self, url, cookie=True):
+        parti = urlsplit(url)
+        self.host, self.porta = parti.hostname, parti.port or 80
+        self.cookie = cookie
+        self.sessione = None
+        self.conn = None
+
+    def richiesta(self, metodo, percorso, dati=None):
+        intestazioni = {}
+        corpo = None
+        if dati is not None:
+            corpo = urlencode(dati)
+            intestazioni['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.sessione:
+            intestazioni['Cookie'] = self.sessione
+        for tentativo in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.porta, timeout=300)
+            try:
+                self.conn.request(metodo, percorso, body=corpo, headers=intestazioni)
+                risposta = self.conn.getresponse()
+                contenuto = risposta.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # Connessione keep-alive chiusa dal server: si riapre una volta
+                self.conn.close()
+                self.conn = None
+                if tentativo:
+                    raise
+        if self.cookie:
+            for valore in risposta.headers.get_all('Set-Cookie') or []:
+                if valore.startswith('session='):
+                    self.sessione = valore.split(';', 1)[0]
+        return risposta.status, contenuto, risposta.headers
+
+    def chiudi(self):
+        if self.conn:
+            self.conn.close()
+
+def accedi(client, password):
+    stato, _, _ = client.richiesta('POST', '/admin_login', {'password': password})
+    if stato != 302:
+        sys.exit(f"Login non riuscito (HTTP {stato}): controllare ADMIN_PASSWORD")
+
+# --- Scenari: ognuno restituisce (stato HTTP, byte ricevuti) ---
+
+def modulo_visita(client, contesto, i):
+    stato, corpo, _ = client.richiesta('GET', '/inserisci_visita')
+    return stato, len(corpo)
+
+def invio_visita(client, contesto, i):
+    rnd = random.Random(i)
+    stato, corpo, _ = client.richiesta('POST', '/inserisci_visita', {
+        'volontario_email': rnd.choice(contesto['volontari']),
+        'assistito_nome': rnd.choice(contesto['assistiti']),
+        'accoglienza': rnd.choice(['Buona', 'Media', 'Scarsa']),
+        'data_visita': contesto['oggi'],
+        'necessita': 'Benchmark',
+        'cosa_migliorare': '',
+    })
+    return stato, len(corpo)
+
+# Le prime lettere di un volontario esistente, come mentre si scrive nel modulo
+def cerca_volontario(client, contesto, i):
+    testo = random.Random(i).choice(contesto['volontari'])[:3 + i % 5]
+    stato, corpo, _ = client.richiesta('GET', f"/api/cerca?{urlencode({'tipo': 'volontari', 'q': testo})}")
+    return stato, len(corpo)
+
+def report_con(parametri):
+    def scenario(client, contesto, i):
+        stato, corpo, _ = client.richiesta('GET', f"/report?{urlencode(parametri(contesto))}")
+        return stato, len(corpo)
+    return scenario
+
+def csv(client, contesto, i):
+    stato, corpo, _ = client.richiesta('GET', '/download_csv')
+    return stato, len(corpo)
+
+def csv_gzip(client, contesto, i):
+    stato, corpo, _ = client.richiesta('GET', '/download_csv?gzip=1')
+    return stato, len(corpo)
+
+# Ogni PDF ha filtri diversi (una data iniziale che non esclude nulla), altrimenti
+# il lavoro già completato verrebbe riusato invece di generare un nuovo file
+def filtro_pdf(client, contesto, i):
+    data_inizio = date(1990, 1, 1) + timedelta(days=contesto['turno'] + i)
+    client.richiesta('GET', f"/report?{urlencode({'data_inizio': data_inizio.isoformat()})}")
+
+def pdf(client, contesto, i):
+    stato, _, intestazioni = client.richiesta('GET', '/download_pdf')
+    trovato = re.search(r'/report_pdf/([0-9a-f]{20})', intestazioni.get('Location', ''))
+    if stato != 302 or not trovato:
+        return stato, 0
+    job_id = trovato.group(1)
+    while True:
+        stato, corpo, _ = client.richiesta('GET', f'/report_pdf/{job_id}/stato')
+        lavoro = json.loads(corpo) if stato == 200 else {}
+        if lavoro.get('stato') not in ('in_coda', 'in_corso'):
+            break
+        time.sleep(0.02)
+    stato, corpo, _ = client.richiesta('GET', f'/report_pdf/{job_id}/scarica')
+    return stato, len(corpo)
+
+def backup(client, contesto, i):
+    stato, corpo, _ = client.richiesta('GET', '/backup')
+    return stato, len(corpo)
+
+# Il backup da ripristinare è l'ultimo elencato da /restore (lo crea lo scenario backup)
+def scegli_backup(client, contesto, i):
+    if 'backup' not in contesto:
+        client.richiesta('GET', '/backup')
+        _, corpo, _ = client.richiesta('GET', '/restore')
+        elenco = re.findall(r'backup_dati_\d{8}_\d{6}\.csv', corpo.decode('utf-8'))
+        if not elenco:
+            sys.exit("Nessun backup disponibile per lo scenario restore")
+        contesto['backup'] = max(elenco)
+
+def ripristino(client, contesto, i):
+    stato, corpo, _ = client.richiesta('POST', '/restore', {
+        'password': contesto['password'], 'backup_file_select': contesto['backup'],
+    })
+    return stato, len(corpo)
+
+# Nome, funzione, preparazione (non misurata, prima di ogni richiesta), stato atteso,
+# utente ('anonimo' o 'admin') e se è pesante (poche richieste, una alla volta).
+# /inserisci_visita usa un client senza cookie: la route chiude la sessione admin.
+SCENARI = [
+    ('inserisci_visita', modulo_visita, None, 200, 'anonimo', False),
+    ('inserisci_visita_post', invio_visita, None, 302, 'anonimo', False),
+    ('cerca_volontario', cerca_volontario, None, 200, 'anonimo', False),
+    ('report', report_con(lambda c: {}), None, 200, 'admin', False),
+    ('report_ultimo_anno', report_con(lambda c: {'data_inizio': c['anno_fa']}), None, 200, 'admin', False),
+    ('report_volontario', report_con(lambda c: {'volontario_email': c['volontario']}), None, 200, 'admin', False),
+    ('report_per_citta', report_con(lambda c: {'ordina': 'citta', 'verso': 'asc', 'per_pagina': 500}), None, 200, 'admin', False),
+    ('download_csv', csv, None, 200, 'admin', True),
+    ('download_csv_gzip', csv_gzip, None, 200, 'admin', True),
+    ('download_pdf', pdf, filtro_pdf, 200, 'admin', True),
+    ('backup', backup, None, 302, 'admin', True),
+    ('restore', ripristino, scegli_backup, 302, 'admin', True),
+]
+
+# Picco di memoria residente del processo, azzerabile (Linux, /proc/<pid>/clear_refs)
+def azzera_picco(pid):
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def picco_rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for riga in f:
+                if riga.startswith('VmHWM:'):
+                    return round(int(riga.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if pid == os.getpid():
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return None
+
+def percentile(valori, p):
+    ordinati = sorted(valori)
+    return ordinati[min(len(ordinati) - 1, int(len(ordinati) * p / 100))]
+
+def esegui_scenario(scenario, crea_client, contesto, richieste, concorrenza, riscaldamento, pid):
+    nome, funzione, prepara, atteso, utente, _ = scenario
+    client = crea_client(utente)
+    for i in range(riscaldamento):
+        if prepara:
+            prepara(client, contesto, -1 - i)
+        funzione(client, contesto, -1 - i)
+    contesto['turno'] += 1000
+
+    latenze, errori, byte, occupato = [], [], [], []
+    lock = threading.Lock()
+    client_thread = [client] + [crea_client(utente) for _ in range(concorrenza - 1)]
+
+    def lavora(client, indici):
+        tempo = 0.0
+        for i in indici:
+            if prepara:
+                prepara(client, contesto, i)
+            inizio = time.perf_counter()
+            try:
+                stato, dimensione = funzione(client, contesto, i)
+            except Exception as e:
+                stato, dimensione = repr(e), 0
+            durata = time.perf_counter() - inizio
+            tempo += durata
+            with lock:
+                latenze.append(durata * 1000)
+                byte.append(dimensione)
+                if stato != atteso:
+                    errori.append(stato)
+        with lock:
+            occupato.append(tempo)
+
+    indici = iter(range(richieste))
+    thread = [threading.Thread(target=lavora, args=(c, [next(indici) for _ in range(n)]))
+              for c, n in zip(client_thread, richieste_per_thread(richieste, concorrenza))]
+    azzera_picco(pid)
+    inizio = time.perf_counter()
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    durata = time.perf_counter() - inizio
+    # Con una preparazione per richiesta conta solo il tempo misurato di ogni thread
+    if prepara:
+        durata = max(occupato)
+    for c in client_thread:
+        if hasattr(c, 'chiudi'):
+            c.chiudi()
+
+    return {
+        'richieste': richieste,
+        'concorrenza': concorrenza,
+        'errori': len(errori),
+        'esempi_errori': sorted({str(e) for e in errori})[:5],
+        'durata_s': round(durata, 3),
+        'richieste_al_secondo': round(richieste / durata, 2) if durata else None,
+        'latenza_ms': {
+            'media': round(sum(latenze) / len(latenze), 2),
+            'p50': round(percentile(latenze, 50), 2),
+            'p90': round(percentile(latenze, 90), 2),
+            'p99': round(percentile(latenze, 99), 2),
+            'max': round(max(latenze), 2),
+        },
+        'byte_medi': round(sum(byte) / len(byte)),
+        'rss_picco_mb': picco_rss_mb(pid) if pid else None,
+    }
+
+def versione_codice():
+    cartella = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=cartella,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        modifiche = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cartella,
+                                   capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-modificato" if modifiche else commit
+
+def leggi_contesto(database_url):
+    with psycopg.connect(database_url) as conn:
+        volontari = [riga[0] for riga in conn.execute(QUERY_LISTE['volontari'])]
+        assistiti = [riga[0] for riga in conn.execute(QUERY_LISTE['assistiti'])]
+        riga = conn.execute("""
+            SELECT volontario_email FROM visite GROUP BY volontario_email ORDER BY count(*) DESC, volontario_email LIMIT 1
+        """).fetchone()
+        conteggi = {tabella: conn.execute(f"SELECT count(*) FROM {tabella}").fetchone()[0]
+                    for tabella in ('visite', 'volontari', 'assistiti')}
+    if not volontari or not assistiti or riga is None:
+        sys.exit("Il database non contiene visite: popolarlo con --visite o con seed_dati.py")
+    return {
+        'volontari': volontari,
+        'assistiti': assistiti,
+        'volontario': riga[0],
+        'oggi': date.today().isoformat(),
+        'anno_fa': (date.today() - timedelta(days=365)).isoformat(),
+        'turno': 0,
+    }, conteggi
+
+def stampa(nome, risultato):
+    latenza = risultato['latenza_ms']
+    rss = f"{risultato['rss_picco_mb']:8.1f} MB" if risultato['rss_picco_mb'] is not None else '       -'
+    errori = f"  {risultato['errori']} errori {risultato['esempi_errori']}" if risultato['errori'] else ''
+    print(f"{nome:<24} {risultato['richieste']:>6} {risultato['richieste_al_secondo']:>9.1f}/s "
+          f"p50 {latenza['p50']:>9.1f}  p90 {latenza['p90']:>9.1f}  p99 {latenza['p99']:>9.1f} ms  "
+          f"{risultato['byte_medi']:>10} B  RSS {rss}{errori}")
+
+# Confronto con un file di risultati precedente: variazione di p50 e richieste al secondo.
+# Restituisce gli scenari con p50 peggiorato oltre la tolleranza (in percentuale).
+def confronta(risultati, precedente, tolleranza):
+    print(f"\nConfronto con {precedente.get('commit')} del {precedente.get('data')}")
+    peggiorati = []
+    for nome, risultato in risultati['scenari'].items():
+        prima = precedente.get('scenari', {}).get(nome)
+        if not prima:
+            continue
+        p50_prima, p50 = prima['latenza_ms']['p50'], risultato['latenza_ms']['p50']
+        variazione = (p50 - p50_prima) / p50_prima * 100 if p50_prima else 0
+        rps_prima, rps = prima['richieste_al_secondo'], risultato['richieste_al_secondo']
+        variazione_rps = (rps - rps_prima) / rps_prima * 100 if rps_prima else 0
+        segno = ''
+        if tolleranza is not None and variazione > tolleranza:
+            peggiorati.append(nome)
+            segno = '  PEGGIORATO'
+        print(f"{nome:<24} p50 {p50_prima:>9.1f} -> {p50:>9.1f} ms ({variazione:+6.1f}%)   "
+              f"{rps_prima:>9.1f} -> {rps:>9.1f}/s ({variazione_rps:+6.1f}%){segno}")
+    return peggiorati
+
+def main():
+    load_dotenv()
+    nomi = [scenario[0] for scenario in SCENARI]
+    parser = argparse.ArgumentParser(description="Benchmark delle route dell'app")
+    parser.add_argument('--database-url', default=os.getenv('SEED_DATABASE_URL'))
+    parser.add_argument('--url', help="server già avviato (altrimenti test client di Flask in questo processo)")
+    parser.add_argument('--pid', type=int, help="con --url: processo del server di cui misurare il picco di RSS")
+    parser.add_argument('--solo', nargs='+', choices=nomi, help="scenari da eseguire (predefinito tutti)")
+    parser.add_argument('--richieste', type=int, default=200, help="richieste per scenario")
+    parser.add_argument('--richieste-pesanti', type=int, default=5, help="richieste per gli scenari pesanti")
+    parser.add_argument('--concorrenza', type=int, default=4, help="thread per gli scenari non pesanti")
+    parser.add_argument('--riscaldamento', type=int, default=3, help="richieste non misurate prima di ogni scenario")
+    parser.add_argument('--cache-report', action='store_true',
+                        help="lascia attiva la cache dei risultati del report (senza --url)")
+    parser.add_argument('--visite', type=int, default=0, help="se > 0 ripopola il database con questo numero di visite")
+    parser.add_argument('--volontari', type=int, default=2000)
+    parser.add_argument('--assistiti', type=int, default=500)
+    parser.add_argument('--json', help="file in cui salvare i risultati")
+    parser.add_argument('--confronta', help="file di risultati precedente da confrontare")
+    parser.add_argument('--tolleranza', type=float,
+                        help="con --confronta: esce con errore se un p50 peggiora più di questa percentuale")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("specificare --database-url o SEED_DATABASE_URL")
+
+    if args.visite:
+        with psycopg.connect(args.database_url) as conn:
+            crea_schema(conn)
+            svuota(conn)
+            popola(conn, args.volontari, args.assistiti, args.visite, fino_al=FINO_AL)
+            conn.execute("ANALYZE")
+
+    contesto, conteggi = leggi_contesto(args.database_url)
+    cartella = None
+    if args.url:
+        password = os.getenv('ADMIN_PASSWORD')
+        if not password:
+            parser.error("con --url serve ADMIN_PASSWORD, la password del server")
+        nuovo_client = lambda utente: ClientHttp(args.url, cookie=utente == 'admin')
+        pid = args.pid
+    else:
+        # Backup, PDF e log in una cartella temporanea, non in quelle del progetto
+        cartella = tempfile.mkdtemp(prefix='benchmark_routes_')
+        os.environ.update(DATABASE_URL=args.database_url, BACKUP_DIR=os.path.join(cartella, 'backups'),
+                          JOB_DIR=os.path.join(cartella, 'jobs'), PIANIFICATORE_MODALITA='disattivato')
+        os.environ.setdefault('ADMIN_PASSWORD', 'benchmark')
+        if not args.cache_report:
+            os.environ['REPORT_CACHE_MAX'] = '0'
+        password = os.environ['ADMIN_PASSWORD']
+        os.makedirs(os.environ['JOB_DIR'], exist_ok=True)
+        args.json = args.json and os.path.abspath(args.json)
+        args.confronta = args.confronta and os.path.abspath(args.confronta)
+        os.chdir(cartella)
+        # L'app legge la configurazione all'import: va importata solo ora
+        from app import app
+        nuovo_client = lambda utente: ClientTest(app, cookie=utente == 'admin')
+        pid = os.getpid()
+
+    contesto['password'] = password
+    def crea_client(utente):
+        client = nuovo_client(utente)
+        if utente == 'admin':
+            accedi(client, password)
+        return client
+
+    risultati = {
+        'commit': versione_codice(),
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'modalita': 'http' if args.url else 'test_client',
+        'database': conteggi,
+        'parametri': {k: getattr(args, k) for k in ('richieste', 'richieste_pesanti', 'concorrenza', 'riscaldamento', 'cache_report')},
+        'scenari': {},
+    }
+    print(f"{conteggi['visite']} visite, {conteggi['volontari']} volontari, {conteggi['assistiti']} assistiti "
+          f"(commit {risultati['commit']}, {risultati['modalita']})")
+    try:
+        for scenario in SCENARI:
+            nome, pesante = scenario[0], scenario[5]
+            if args.solo and nome not in args.solo:
+                continue
+            risultato = esegui_scenario(
+                scenario, crea_client, contesto,
+                args.richieste_pesanti if pesante else args.richieste,
+                1 if pesante else args.concorrenza,
+                min(args.riscaldamento, 1) if pesante else args.riscaldamento,
+                pid,
+            )
+            risultati['scenari'][nome] = risultato
+            stampa(nome, risultato)
+    finally:
+        if cartella:
+            shutil.rmtree(cartella, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(risultati, f, indent=2)
+        print(f"Risultati salvati in {args.json}")
+
+    if args.confronta:
+        with open(args.confronta, encoding='utf-8') as f:
+            peggiorati = confronta(risultati, json.load(f), args.tolleranza)
+        if peggiorati:
+            sys.exit(f"Scenari peggiorati oltre il {args.tolleranza}%: {', '.join(peggiorati)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import urllib.request
+from dotenv import load_dotenv
+
+# Tempo di avvio di un worker: import di app.py misurato con "python -X importtime"
+# (totale e moduli più pesanti) e tempo dal lancio di gunicorn alla prima risposta
+# di /inserisci_visita, che legge dal database gli elenchi del modulo.
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__))
+
+# Righe di -X importtime: "import time: self [us] | cumulative | <rientro>modulo"
+def leggi_importtime(testo):
+    moduli = []
+    for riga in testo.splitlines():
+        if not riga.startswith('import time:') or 'self [us]' in riga:
+            continue
+        proprio, cumulato, nome = riga[len('import time:'):].split('|')
+        livello = (len(nome) - len(nome.lstrip(' ')) - 1) // 2
+        moduli.append((nome.strip(), livello, int(proprio), int(cumulato)))
+    return moduli
+
+def misura_import(ambiente):
+    inizio = time.perf_counter()
+    risultato = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=CARTELLA,
+                               env=ambiente, capture_output=True, text=True)
+    durata = time.perf_counter() - inizio
+    if risultato.returncode:
+        sys.exit(f"Import di app.py fallito:\n{risultato.stderr[-2000:]}")
+    moduli = leggi_importtime(risultato.stderr)
+    totale_app = next(cumulato for nome, livello, _, cumulato in moduli if nome == 'app' and livello == 0)
+    # Moduli importati direttamente da app.py, con il proprio sottoalbero
+    diretti = {nome: cumulato for nome, livello, _, cumulato in moduli if livello == 1}
+    return durata, totale_app, diretti
+
+def porta_libera():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def misura_prima_richiesta(ambiente, attesa=60):
+    porta = porta_libera()
+    inizio = time.perf_counter()
+    processo = subprocess.Popen(['gunicorn', 'app:app', '--workers', '1', '--bind', f'127.0.0.1:{porta}'],
+                                cwd=CARTELLA, env=ambiente, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - inizio < attesa:
+            if processo.poll() is not None:
+                sys.exit(f"gunicorn è terminato all'avvio (codice {processo.returncode})")
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{porta}/inserisci_visita', timeout=5) as risposta:
+                    risposta.read()
+                    return time.perf_counter() - inizio
+            except OSError:
+                time.sleep(0.01)
+        sys.exit("Nessuna risposta da gunicorn")
+    finally:
+        processo.terminate()
+        processo.wait()
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Benchmark dell'avvio dei worker")
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'))
+    parser.add_argument('--ripetizioni', type=int, default=5)
+    parser.add_argument('--moduli', type=int, default=10, help="moduli più pesanti da mostrare")
+    parser.add_argument('--senza-server', action='store_true', help="misura solo l'import")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("specificare --database-url o DATABASE_URL")
+    ambiente = dict(os.environ, DATABASE_URL=args.database_url)
+
+    # Il primo import compila i .pyc e scalda la cache dei file: non conta
+    misura_import(ambiente)
+    durate, totali, diretti = [], [], {}
+    for _ in range(args.ripetizioni):
+        durata, totale, moduli = misura_import(ambiente)
+        durate.append(durata)
+        totali.append(totale)
+        for nome, cumulato in moduli.items():
+            diretti.setdefault(nome, []).append(cumulato)
+
+    print(f"Import di app.py ({args.ripetizioni} ripetizioni, mediana)")
+    print(f"  processo python + import   {statistics.median(durate) * 1000:8.1f} ms")
+    print(f"  import app (importtime)    {statistics.median(totali) / 1000:8.1f} ms")
+    pesanti = sorted(((statistics.median(v), nome) for nome, v in diretti.items()), reverse=True)[:args.moduli]
+    for cumulato, nome in pesanti:
+        print(f"    {nome:<24} {cumulato / 1000:8.1f} ms")
+
+    if not args.senza_server:
+        prime = [misura_prima_richiesta(ambiente) for _ in range(args.ripetizioni)]
+        print(f"Da avvio di gunicorn alla prima risposta: {statistics.median(prime) * 1000:8.1f} ms "
+              f"(min {min(prime) * 1000:.1f}, max {max(prime) * 1000:.1f})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import psycopg
+from db import get_db_connection, release_db_connection, DB_POOL_MAX_SIZE
+
+# Cache in memoria degli elenchi di volontari e assistiti usati nei menu a tendina.
+#
+# Ogni worker tiene la propria copia per CACHE_LISTE_TTL secondi. Le route che
+# modificano volontari o assistiti chiamano invalida_liste() nella stessa
+# transazione: la copia locale viene scartata subito e un NOTIFY, consegnato da
+# PostgreSQL solo al commit, avvisa gli altri worker (e questo stesso, così una
+# lettura fatta prima del commit non resta in cache). L'ascolto è uno per
+# processo, con una connessione presa dal pool. Se non è attivo vale comunque la
+# scadenza.
+
+CACHE_LISTE_TTL = int(os.getenv('CACHE_LISTE_TTL', 300))
+CACHE_LISTEN = os.getenv('CACHE_LISTEN', '1') == '1'
+CANALE_LISTE = 'scheda_liste'
+
+QUERY_LISTE = {
+    'assistiti': "SELECT nome_sigla, citta FROM assistiti ORDER BY nome_sigla",
+    'volontari': "SELECT email, cognome, nome FROM volontari ORDER BY cognome, nome",
+}
+
+_cache = {}
+# Incrementata a ogni invalidazione: un caricamento iniziato prima non viene salvato
+_generazione = {nome: 0 for nome in QUERY_LISTE}
+_lock = threading.Lock()
+_ascolto = None
+
+def scarta(*nomi):
+    with _lock:
+        for nome in nomi or QUERY_LISTE:
+            _cache.pop(nome, None)
+            _generazione[nome] += 1
+
+# Elenco in cache, ricaricato dal database se assente o scaduto.
+# Con cur (cursore già aperto dalla route) non serve un'altra connessione dal pool.
+def lista(nome, cur=None):
+    avvia_ascolto()
+    with _lock:
+        voce = _cache.get(nome)
+        if voce and voce[0] > time.monotonic():
+            return voce[1]
+        generazione = _generazione[nome]
+
+    if cur is not None:
+        cur.execute(QUERY_LISTE[nome])
+        righe = tuple(cur.fetchall())
+    else:
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as c:
+                c.execute(QUERY_LISTE[nome])
+                righe = tuple(c.fetchall())
+        finally:
+            release_db_connection(conn)
+
+    with _lock:
+        if _generazione[nome] == generazione:
+            _cache[nome] = (time.monotonic() + CACHE_LISTE_TTL, righe)
+    return righe
+
+# Da chiamare prima del commit di ogni scrittura su volontari o assistiti
+def invalida_liste(cur, *nomi):
+    scarta(*nomi)
+    for nome in nomi:
+        cur.execute("SELECT pg_notify(%s, %s)", (CANALE_LISTE, nome))
+
+# L'ascolto usa una connessione del pool per tutta la vita del processo (vedi db.py)
+def ascolta():
+    attesa = 1
+    while True:
+        conn = None
+        try:
+            conn = get_db_connection()
+            conn.autocommit = True
+            conn.execute(f"LISTEN {CANALE_LISTE}")
+            # Le notifiche perse mentre non si ascoltava non sono recuperabili
+            scarta()
+            attesa = 1
+            logging.info(f"In ascolto delle modifiche agli elenchi sul canale {CANALE_LISTE}")
+            for notifica in conn.notifies():
+                if notifica.payload in QUERY_LISTE:
+                    scarta(notifica.payload)
+                else:
+                    scarta()
+        except psycopg.Error as e:
+            logging.error(f"Ascolto delle modifiche agli elenchi interrotto: {e}")
+        finally:
+            if conn:
+                # Torna nel pool come le altre: senza LISTEN e con le transazioni
+                try:
+                    conn.execute("UNLISTEN *")
+                    conn.autocommit = False
+                except psycopg.Error:
+                    conn.close()
+                release_db_connection(conn)
+        time.sleep(attesa)
+        attesa = min(attesa * 2, 60)
+
+# Il thread parte al primo uso, quindi in ogni worker dopo il fork di gunicorn.
+# Con un pool da una sola connessione l'ascolto la terrebbe per sé: vale la scadenza.
+def avvia_ascolto():
+    global _ascolto
+    if not CACHE_LISTEN or DB_POOL_MAX_SIZE < 2 or _ascolto is not None:
+        return
+    with _lock:
+        if _ascolto is None:
+            _ascolto = threading.Thread(target=ascolta, name='cache-liste', daemon=True)
+            _ascolto.start()
+
+# Cache dei risultati del report, per filtri e pagina.
+#
+# La chiave comprende la versione dei dati (somma dei contatori di versione_dati,
+# incrementata dai trigger della migrazione 10 a ogni transazione che scrive su
+# visite, volontari o assistiti),
+# quindi qualunque modifica, da qualunque worker o script, rende vecchie le voci
+# senza bisogno di notifiche. Leggere la versione costa una query minima.
+
+REPORT_CACHE_MAX = int(os.getenv('REPORT_CACHE_MAX', 64))
+
+_report = OrderedDict()
+_report_versione = None
+_report_lock = threading.Lock()
+
+def versione_dati(cur):
+    cur.execute("SELECT sum(versione)::bigint, max(modificata) FROM versione_dati")
+    return cur.fetchone()
+
+def report_in_cache(chiave, versione):
+    global _report_versione
+    with _report_lock:
+        if _report_versione is None or versione > _report_versione:
+            # I dati sono cambiati: nessuna voce è più valida
+            _report.clear()
+            _report_versione = versione
+            return None
+        if versione < _report_versione:
+            return None
+        risultato = _report.get(chiave)
+        if risultato is not None:
+            _report.move_to_end(chiave)
+        return risultato
+
+def salva_report(chiave, versione, risultato):
+    if REPORT_CACHE_MAX <= 0:
+        return
+    with _report_lock:
+        if versione != _report_versione:
+            return
+        _report[chiave] = risultato
+        _report.move_to_end(chiave)
+        while len(_report) > REPORT_CACHE_MAX:
+            _report.popitem(last=False)
+
+def etag_report(chiave, versione):
+    return hashlib.sha1(repr((chiave, versione)).encode('utf-8')).hexdigest()[:20]
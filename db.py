@@ -0,0 +1,107 @@
+import os
+import time
+import atexit
+import logging
+import threading
+import psycopg
+from psycopg_pool import ConnectionPool
+from metriche import METRICHE, CursoreMisurato, registra_attesa_pool
+
+# Pool di connessioni per processo: con gunicorn ogni worker ha il proprio pool,
+# quindi le connessioni totali sono al massimo workers * DB_POOL_MAX_SIZE (più
+# DB_POOL_MAX_SIZE per "pianificatore.py avvia", se separato, e ASYNC_POOL_MAX_SIZE
+# per processo con asgi.py). Nessun thread dell'app apre connessioni proprie, ma
+# due restano prese a lungo dal pool:
+#   - l'ascolto delle modifiche agli elenchi (cache.py, CACHE_LISTEN), una per
+#     processo per tutta la sua vita;
+#   - il lock del pianificatore (pianificatore.py), solo nel processo leader.
+# Alle richieste restano quindi DB_POOL_MAX_SIZE - 1 connessioni, una in meno nel
+# leader: DB_POOL_MAX_SIZE va dimensionato tenendone conto.
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 4))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_MAX_WAITING = int(os.getenv('DB_POOL_MAX_WAITING', 20))
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 1800))
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', 300))
+
+# Il fuso orario viene passato come parametro di connessione: nessun
+# "SET TIME ZONE" a ogni richiesta.
+DB_CONNECT_KWARGS = {'options': '-c TimeZone=Europe/Rome'}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                kwargs = dict(DB_CONNECT_KWARGS)
+                if METRICHE:
+                    # Tutte le query delle route passano da qui (vedi metriche.py)
+                    kwargs['cursor_factory'] = CursoreMisurato
+                pool = ConnectionPool(
+                    os.getenv('DATABASE_URL'),
+                    kwargs=kwargs,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_waiting=DB_POOL_MAX_WAITING,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    check=ConnectionPool.check_connection,
+                    name='scheda-volontari',
+                    open=False,
+                )
+                pool.open(wait=False)
+                atexit.register(pool.close)
+                _pool = pool
+    return _pool
+
+# Connessione al database PostgreSQL presa dal pool
+def get_db_connection():
+    try:
+        inizio = time.perf_counter()
+        conn = get_pool().getconn()
+        if METRICHE:
+            registra_attesa_pool(time.perf_counter() - inizio)
+        return conn
+    except psycopg.OperationalError as e:
+        logging.error(f"Errore di connessione al database: {e}")
+        raise
+
+# Restituisce la connessione al pool annullando eventuali transazioni lasciate aperte
+# (le letture non fanno commit, come succedeva chiudendo la connessione). Una
+# connessione già chiusa viene scartata dal pool.
+def release_db_connection(conn):
+    try:
+        if not conn.closed and conn.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            conn.rollback()
+    except psycopg.Error as e:
+        logging.error(f"Errore nel rilascio della connessione: {e}")
+    get_pool().putconn(conn)
+
+# Statistiche del pool per il monitoraggio
+def pool_stats():
+    if _pool is None:
+        return {}
+    stats = _pool.get_stats()
+    size = stats.get('pool_size', 0)
+    available = stats.get('pool_available', 0)
+    requests_num = stats.get('requests_num', 0)
+    wait_ms = stats.get('requests_wait_ms', 0)
+    return {
+        'in_uso': size - available,
+        'inattive': available,
+        'dimensione': size,
+        'min': stats.get('pool_min', DB_POOL_MIN_SIZE),
+        'max': stats.get('pool_max', DB_POOL_MAX_SIZE),
+        'in_attesa': stats.get('requests_waiting', 0),
+        'richieste': requests_num,
+        'richieste_in_coda': stats.get('requests_queued', 0),
+        'richieste_scadute': stats.get('requests_timeouts', 0),
+        'attesa_totale_ms': wait_ms,
+        'attesa_media_ms': round(wait_ms / requests_num, 2) if requests_num else 0,
+        'errori_connessione': stats.get('connections_errors', 0),
+        'connessioni_perse': stats.get('connections_lost', 0),
+    }
@@ -0,0 +1,74 @@
+import os
+import zlib
+from datetime import datetime
+from query_visite import FROM_VISITE
+
+# Esportazione con COPY ... TO STDOUT: il CSV lo produce PostgreSQL e qui si
+# raccolgono solo i blocchi di byte, senza passare riga per riga da Python.
+
+BLOCCO_COPY = int(os.getenv('EXPORT_BLOCCO_BYTES', 64 * 1024))
+BACKUP_DIR = os.getenv('BACKUP_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups'))
+
+INTESTAZIONE_VISITE = ['Volontario Email', 'Cognome', 'Nome', 'Assistito', 'Città', 'Accoglienza', 'Data Visita', 'Necessità', 'Cosa Migliorare']
+INTESTAZIONE_VOLONTARI = ['Email', 'Cognome', 'Nome', 'Telefono', 'Competenze', 'Disponibilità', 'Data Iscrizione']
+INTESTAZIONE_ASSISTITI = ['Nome Sigla', 'Città']
+
+# Le colonne seguono l'ordine dei file già prodotti con csv.writer (nome prima del cognome)
+QUERY_CSV_REPORT = """
+    SELECT v.volontario_email, vol.nome, vol.cognome, v.assistito_nome, ass.citta, v.accoglienza, v.data_visita,
+           COALESCE(NULLIF(v.necessita, ''), 'Nessuna'), COALESCE(NULLIF(v.cosa_migliorare, ''), 'Nessuno')
+""" + FROM_VISITE
+
+QUERY_BACKUP_VISITE = """
+    SELECT v.volontario_email, vol.nome, vol.cognome, v.assistito_nome, ass.citta, v.accoglienza, v.data_visita,
+           v.necessita, v.cosa_migliorare
+""" + FROM_VISITE
+QUERY_BACKUP_VOLONTARI = "SELECT email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione FROM volontari"
+QUERY_BACKUP_ASSISTITI = "SELECT nome_sigla, citta FROM assistiti"
+
+def riga_csv(valori):
+    return (','.join(valori) + '\n').encode('utf-8')
+
+# Blocchi di CSV prodotti dal server; libpq restituisce una riga alla volta,
+# quindi le righe vengono raccolte in blocchi da BLOCCO_COPY byte.
+def copia_csv(cur, query, params=None):
+    buffer = bytearray()
+    with cur.copy(f"COPY ({query}) TO STDOUT WITH (FORMAT csv)", params) as copy:
+        for dati in copy:
+            buffer += dati
+            if len(buffer) >= BLOCCO_COPY:
+                yield bytes(buffer)
+                buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+def esporta_report_csv(cur, where, params):
+    yield riga_csv(INTESTAZIONE_VISITE)
+    yield from copia_csv(cur, QUERY_CSV_REPORT + where, params)
+
+def comprimi_gzip(blocchi):
+    compressore = zlib.compressobj(wbits=31)
+    for blocco in blocchi:
+        dati = compressore.compress(blocco)
+        if dati:
+            yield dati
+    yield compressore.flush()
+
+def nuovo_file_backup():
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    return os.path.join(BACKUP_DIR, f"backup_dati_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+
+# Backup completo nel formato a sezioni letto da /restore
+def scrivi_backup(cur, filename):
+    sezioni = [
+        ('--- Visite ---', INTESTAZIONE_VISITE, QUERY_BACKUP_VISITE),
+        ('--- Volontari ---', INTESTAZIONE_VOLONTARI, QUERY_BACKUP_VOLONTARI),
+        ('--- Assistiti ---', INTESTAZIONE_ASSISTITI, QUERY_BACKUP_ASSISTITI),
+    ]
+    with open(filename, 'wb') as output_file:
+        for titolo, intestazione, query in sezioni:
+            output_file.write(riga_csv([titolo]))
+            output_file.write(riga_csv(intestazione))
+            for blocco in copia_csv(cur, query):
+                output_file.write(blocco)
+    return filename
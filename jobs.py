@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Lavori in background: generazione dei PDF del report e pulizia delle visite.
+#
+# Lo stato di ogni lavoro è un file JSON nella cartella JOB_DIR, così qualunque
+# worker gunicorn può rispondere al polling o servire il file finito, non solo
+# quello che ha avviato il lavoro. L'id dipende dai parametri: richieste uguali
+# riusano il lavoro in corso o già completato finché non scade. Chi avvia un
+# lavoro che legge i dati mette nei parametri anche la versione dei dati, così
+# un risultato non viene riusato dopo una modifica.
+#
+# Ogni tipo di lavoro ha il proprio executor con JOB_WORKERS thread: una pulizia
+# lunga non fa aspettare i PDF, né il contrario.
+
+JOB_DIR = os.getenv('JOB_DIR', os.path.join(tempfile.gettempdir(), 'scheda_volontari_jobs'))
+# Thread per ogni tipo di lavoro
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 1))
+JOB_TTL = int(os.getenv('JOB_TTL', 1800))
+# Un lavoro "in_corso" che non aggiorna lo stato da così tanto è considerato perso
+JOB_TIMEOUT_INATTIVITA = int(os.getenv('JOB_TIMEOUT_INATTIVITA', 120))
+# Ogni quanti secondi un lavoro in corso riscrive lo stato anche senza avanzamenti
+JOB_BATTITO = max(JOB_TIMEOUT_INATTIVITA / 4, 1)
+
+_executors = {}
+_executor_lock = threading.Lock()
+
+def get_executor(tipo):
+    with _executor_lock:
+        executor = _executors.get(tipo)
+        if executor is None:
+            executor = _executors[tipo] = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix=f'job-{tipo}')
+    return executor
+
+def id_lavoro(tipo, parametri):
+    chiave = json.dumps({'tipo': tipo, 'parametri': parametri}, sort_keys=True)
+    return hashlib.sha256(chiave.encode('utf-8')).hexdigest()[:20]
+
+def percorso_stato(job_id):
+    return os.path.join(JOB_DIR, f"{job_id}.json")
+
+def percorso_risultato(job_id, estensione):
+    return os.path.join(JOB_DIR, f"{job_id}.{estensione}")
+
+def scrivi_stato(job_id, stato):
+    stato['aggiornato'] = time.time()
+    temporaneo = f"{percorso_stato(job_id)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporaneo, 'w', encoding='utf-8') as f:
+        json.dump(stato, f)
+    os.replace(temporaneo, percorso_stato(job_id))
+
+def stato_lavoro(job_id):
+    if not re.fullmatch(r'[0-9a-f]{20}', job_id):
+        return None
+    try:
+        with open(percorso_stato(job_id), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def riutilizzabile(stato, completati=True):
+    if not stato:
+        return False
+    eta = time.time() - stato['aggiornato']
+    if stato['stato'] == 'in_coda':
+        return eta < JOB_TTL
+    if stato['stato'] == 'in_corso':
+        return eta < JOB_TIMEOUT_INATTIVITA
+    if stato['stato'] == 'completato':
+        return completati and eta < JOB_TTL and os.path.exists(stato['file'])
+    return False
+
+def elimina_lavoro(job_id, stato):
+    for percorso in (stato.get('file'), percorso_stato(job_id)):
+        if percorso and os.path.exists(percorso):
+            os.remove(percorso)
+
+def pulisci_scaduti():
+    adesso = time.time()
+    for nome in os.listdir(JOB_DIR):
+        if not nome.endswith('.json'):
+            continue
+        job_id = nome[:-5]
+        stato = stato_lavoro(job_id)
+        if stato and stato['stato'] not in ('in_coda', 'in_corso') and adesso - stato['aggiornato'] > JOB_TTL:
+            elimina_lavoro(job_id, stato)
+            logging.info(f"Lavoro {job_id} scaduto ed eliminato")
+
+# Il file temporaneo è di questa esecuzione: se un lavoro creduto perso viene avviato
+# di nuovo, le due esecuzioni non scrivono sullo stesso file. Il battito tiene fresco
+# lo stato anche nelle fasi senza avanzamenti (come il save() finale del PDF), così
+# un lavoro vivo non sembra perso a chi ripete la richiesta.
+def esegui(job_id, stato, funzione):
+    temporaneo = f"{stato['file']}.{os.getpid()}.{threading.get_ident()}.tmp"
+    stato_lock = threading.Lock()
+    finito = threading.Event()
+
+    def aggiorna():
+        with stato_lock:
+            scrivi_stato(job_id, stato)
+
+    def progresso(fatti, totale=None):
+        with stato_lock:
+            stato['fatti'] = fatti
+            if totale is not None:
+                stato['totale'] = totale
+            scrivi_stato(job_id, stato)
+
+    def battito():
+        while not finito.wait(JOB_BATTITO):
+            aggiorna()
+
+    stato['stato'] = 'in_corso'
+    aggiorna()
+    threading.Thread(target=battito, name=f'job-{job_id}-battito', daemon=True).start()
+    inizio = time.time()
+    try:
+        funzione(temporaneo, progresso)
+        os.replace(temporaneo, stato['file'])
+        finale = {'stato': 'completato', 'durata': round(time.time() - inizio, 2)}
+        logging.info(f"Lavoro {job_id} ({stato['tipo']}) completato in {finale['durata']} s")
+    except Exception as e:
+        logging.error(f"Lavoro {job_id} ({stato['tipo']}) fallito: {e}")
+        finale = {'stato': 'errore', 'errore': str(e)}
+        if os.path.exists(temporaneo):
+            os.remove(temporaneo)
+    finito.set()
+    with stato_lock:
+        stato.update(finale)
+        scrivi_stato(job_id, stato)
+
+# Avvia funzione(percorso_output, progresso) in background, oppure restituisce
+# l'id del lavoro già in corso o completato con gli stessi parametri. Con
+# riusa_completati=False un lavoro completato viene rieseguito (per i lavori che
+# modificano i dati, come la pulizia).
+def avvia_lavoro(tipo, parametri, estensione, funzione, riusa_completati=True):
+    os.makedirs(JOB_DIR, exist_ok=True)
+    pulisci_scaduti()
+    job_id = id_lavoro(tipo, parametri)
+    stato = stato_lavoro(job_id)
+    if riutilizzabile(stato, riusa_completati):
+        return job_id
+
+    # La prenotazione con O_EXCL evita che due worker avviino lo stesso lavoro
+    try:
+        os.close(os.open(percorso_stato(job_id) + '.lock', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        lock = percorso_stato(job_id) + '.lock'
+        if time.time() - os.path.getmtime(lock) < JOB_TIMEOUT_INATTIVITA:
+            return job_id
+        os.utime(lock)
+    try:
+        stato = stato_lavoro(job_id)
+        if riutilizzabile(stato, riusa_completati):
+            return job_id
+        if stato:
+            elimina_lavoro(job_id, stato)
+        stato = {'id': job_id, 'tipo': tipo, 'parametri': parametri, 'stato': 'in_coda', 'fatti': 0, 'totale': None,
+                 'creato': time.time(), 'file': percorso_risultato(job_id, estensione)}
+        scrivi_stato(job_id, stato)
+    finally:
+        os.remove(percorso_stato(job_id) + '.lock')
+    get_executor(tipo).submit(esegui, job_id, stato, funzione)
+    return job_id
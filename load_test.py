@@ -0,0 +1,270 @@
+import os
+import sys
+import time
+import uuid
+import random
+import socket
+import asyncio
+import argparse
+import threading
+import subprocess
+import http.client
+from datetime import date
+from urllib.parse import urlencode, urlsplit
+import psycopg
+from dotenv import load_dotenv
+from cache import QUERY_LISTE
+
+# Carico sul POST di /inserisci_visita: richieste al secondo e latenza (p50, p99)
+# dell'avvio sincrono (gunicorn app:app) contro quello asincrono (uvicorn asgi:applicazione).
+# Inserisce visite vere: va usato su un database di prova.
+#
+#     python load_test.py --database-url postgresql://.../bench --concorrenza 50
+#     python load_test.py --url http://127.0.0.1:8000 --concorrenza 50   (server già avviato)
+#     python load_test.py --database-url ... --primi-invii 20   (correttezza, vedi verifica_primi_invii)
+#
+# Con il database sulla stessa macchina ogni query costa pochi microsecondi e conta
+# solo la CPU; --ritardo-db interpone un proxy TCP che ritarda ogni pacchetto, come
+# un database raggiungibile in rete (il caso in produzione).
+
+SERVER = {
+    'sync': lambda porta, workers: ['gunicorn', 'app:app', '--workers', str(workers), '--bind', f'127.0.0.1:{porta}'],
+    'async': lambda porta, workers: ['uvicorn', 'asgi:applicazione', '--workers', str(workers),
+                                     '--host', '127.0.0.1', '--port', str(porta), '--log-level', 'warning'],
+}
+
+def moduli_visita(database_url, nuovi):
+    with psycopg.connect(database_url) as conn:
+        volontari = [riga[0] for riga in conn.execute(QUERY_LISTE['volontari'])]
+        assistiti = [riga[0] for riga in conn.execute(QUERY_LISTE['assistiti'])]
+    if not volontari or not assistiti:
+        sys.exit("Il database non contiene volontari o assistiti: popolarlo con seed_dati.py")
+
+    def modulo():
+        dati = {
+            'volontario_email': random.choice(volontari),
+            'assistito_nome': random.choice(assistiti),
+            'accoglienza': random.choice(['Buona', 'Media', 'Scarsa']),
+            'data_visita': date.today().isoformat(),
+            'necessita': 'Prova di carico',
+            'cosa_migliorare': '',
+        }
+        if random.random() < nuovi:
+            dati.update(volontario_email=f"carico-{uuid.uuid4().hex[:12]}@esempio.it",
+                        volontario_cognome='Carico', volontario_nome='Prova')
+        return urlencode(dati)
+    return modulo
+
+def connessione(url):
+    parti = urlsplit(url)
+    return http.client.HTTPConnection(parti.hostname, parti.port or 80, timeout=60)
+
+# Un POST del modulo; l'esito è lo stato HTTP (302 se accettato) o il nome dell'eccezione
+def invia_modulo(conn, corpo):
+    try:
+        conn.request('POST', '/inserisci_visita', corpo, {'Content-Type': 'application/x-www-form-urlencoded'})
+        risposta = conn.getresponse()
+        risposta.read()
+        return risposta.status
+    except (OSError, http.client.HTTPException) as e:
+        conn.close()
+        return type(e).__name__
+
+def carico(url, modulo, richieste, concorrenza):
+    latenze = []
+    errori = []
+    contatore = iter(range(richieste))
+    lock = threading.Lock()
+
+    def client():
+        conn = connessione(url)
+        while True:
+            with lock:
+                if next(contatore, None) is None:
+                    break
+                corpo = modulo()
+            inizio = time.perf_counter()
+            esito = invia_modulo(conn, corpo)
+            durata = time.perf_counter() - inizio
+            with lock:
+                if esito == 302:
+                    latenze.append(durata)
+                else:
+                    errori.append(esito)
+        conn.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concorrenza)]
+    inizio = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - inizio, sorted(latenze), errori
+
+# Correttezza sotto concorrenza: per ognuna di "volontari" email nuove, "concorrenza"
+# client inviano insieme la prima visita. Ogni invio deve riuscire e alla fine devono
+# esserci un solo volontario e "concorrenza" visite per email.
+def verifica_primi_invii(url, database_url, volontari, concorrenza):
+    with psycopg.connect(database_url) as conn:
+        assistito = conn.execute(QUERY_LISTE['assistiti']).fetchone()[0]
+    prefisso = f"primo-{uuid.uuid4().hex[:8]}-"
+    esiti = []
+    barriera = threading.Barrier(concorrenza)
+
+    def client():
+        conn = connessione(url)
+        for i in range(volontari):
+            corpo = urlencode({
+                'volontario_email': f"{prefisso}{i}@esempio.it", 'volontario_cognome': 'Primo',
+                'volontario_nome': f"Invio {i}", 'assistito_nome': assistito, 'accoglienza': 'Buona',
+                'data_visita': date.today().isoformat(),
+            })
+            barriera.wait()
+            esiti.append(invia_modulo(conn, corpo))
+        conn.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concorrenza)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with psycopg.connect(database_url) as conn:
+        righe = conn.execute("""
+            SELECT vol.email, count(DISTINCT vol.id), count(v.id)
+            FROM volontari vol LEFT JOIN visite v ON v.volontario_email = vol.email
+            WHERE vol.email LIKE %s GROUP BY vol.email
+        """, (prefisso + '%',)).fetchall()
+    problemi = [f"{email}: {n_volontari} volontari, {n_visite} visite" for email, n_volontari, n_visite in righe
+                if n_volontari != 1 or n_visite != concorrenza]
+    if len(righe) != volontari:
+        problemi.append(f"volontari creati {len(righe)} su {volontari}")
+    errori = [esito for esito in esiti if esito != 302]
+    if errori:
+        problemi.append(f"{len(errori)} invii rifiutati, primi: {errori[:5]}")
+    return problemi
+
+# Proxy TCP verso il database che ritarda ogni blocco di dati di ritardo secondi.
+# Restituisce l'URL del database da usare al posto di quello originale.
+def avvia_proxy_lento(database_url, ritardo):
+    originale = psycopg.conninfo.conninfo_to_dict(database_url)
+    host, porta = originale.get('host') or '127.0.0.1', int(originale.get('port') or 5432)
+    pronto = threading.Event()
+    indirizzo = []
+
+    async def inoltra(lettore, scrittore):
+        try:
+            while dati := await lettore.read(65536):
+                await asyncio.sleep(ritardo)
+                scrittore.write(dati)
+                await scrittore.drain()
+        finally:
+            scrittore.close()
+
+    async def collega(client_r, client_w):
+        if host.startswith('/'):
+            server_r, server_w = await asyncio.open_unix_connection(f'{host}/.s.PGSQL.{porta}')
+        else:
+            server_r, server_w = await asyncio.open_connection(host, porta)
+        await asyncio.gather(inoltra(client_r, server_w), inoltra(server_r, client_w), return_exceptions=True)
+
+    async def servi():
+        server = await asyncio.start_server(collega, '127.0.0.1', 0)
+        indirizzo.append(server.sockets[0].getsockname()[1])
+        pronto.set()
+        await server.serve_forever()
+
+    threading.Thread(target=asyncio.run, args=(servi(),), daemon=True).start()
+    pronto.wait()
+    return psycopg.conninfo.make_conninfo(database_url, host='127.0.0.1', port=str(indirizzo[0]))
+
+def percentile(valori, p):
+    if not valori:
+        return float('nan')
+    return valori[min(len(valori) - 1, int(len(valori) * p))]
+
+def stampa(nome, durata, latenze, errori):
+    print(f"  {nome:<8} {len(latenze) / durata:8.1f} richieste/s   p50 {percentile(latenze, 0.50) * 1000:7.1f} ms   "
+          f"p99 {percentile(latenze, 0.99) * 1000:7.1f} ms   errori {len(errori)}")
+    if errori:
+        print(f"           primi errori: {errori[:5]}")
+
+def attendi_porta(porta, processo, attesa=30):
+    limite = time.monotonic() + attesa
+    while time.monotonic() < limite:
+        if processo.poll() is not None:
+            sys.exit(f"Il server è terminato all'avvio (codice {processo.returncode})")
+        try:
+            socket.create_connection(('127.0.0.1', porta), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    processo.terminate()
+    sys.exit(f"Il server non risponde sulla porta {porta}")
+
+def avvia_e_misura(nome, args, database_url, misura):
+    ambiente = dict(os.environ, DATABASE_URL=database_url, MIGRAZIONI_ALL_AVVIO='0')
+    processo = subprocess.Popen(SERVER[nome](args.porta, args.workers), env=ambiente,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        attendi_porta(args.porta, processo)
+        url = f'http://127.0.0.1:{args.porta}'
+        return misura(url)
+    finally:
+        processo.terminate()
+        processo.wait()
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Prova di carico dell'inserimento visite, sincrono contro asincrono")
+    parser.add_argument('--database-url', default=os.getenv('SEED_DATABASE_URL'))
+    parser.add_argument('--url', help="misura solo un server già avviato a questo indirizzo")
+    parser.add_argument('--modalita', nargs='+', choices=list(SERVER), default=list(SERVER))
+    parser.add_argument('--richieste', type=int, default=2000)
+    parser.add_argument('--concorrenza', type=int, default=50, help="client contemporanei")
+    parser.add_argument('--workers', type=int, default=2, help="processi di ogni server")
+    parser.add_argument('--porta', type=int, default=8765)
+    parser.add_argument('--nuovi', type=float, default=0.0, help="frazione di invii con un volontario nuovo")
+    parser.add_argument('--ritardo-db', type=float, default=0.0, help="ms aggiunti a ogni pacchetto verso e dal database")
+    parser.add_argument('--primi-invii', type=int, default=0, metavar='VOLONTARI',
+                        help="invece del carico, verifica i primi invii contemporanei per questo numero di volontari nuovi")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("specificare --database-url o SEED_DATABASE_URL")
+
+    if args.primi_invii:
+        print(f"Primi invii contemporanei ({args.primi_invii} volontari nuovi, {args.concorrenza} client ciascuno)")
+
+        def misura(url):
+            return verifica_primi_invii(url, args.database_url, args.primi_invii, args.concorrenza)
+
+        def stampa_esito(nome, problemi):
+            print(f"  {nome:<8} {'FALLITA' if problemi else 'ok'}")
+            for problema in problemi[:10]:
+                print(f"           {problema}")
+            return not problemi
+    else:
+        modulo = moduli_visita(args.database_url, args.nuovi)
+        print(f"Inserimento visite ({args.richieste} richieste, {args.concorrenza} client, {args.workers} processi, "
+              f"ritardo database {args.ritardo_db} ms)")
+
+        def misura(url):
+            # Riscaldamento: connessioni del pool e cache degli elenchi
+            carico(url, modulo, args.concorrenza * 2, args.concorrenza)
+            return carico(url, modulo, args.richieste, args.concorrenza)
+
+        def stampa_esito(nome, risultato):
+            stampa(nome, *risultato)
+            return not risultato[2]
+
+    if args.url:
+        riusciti = [stampa_esito('server', misura(args.url))]
+    else:
+        database_url = args.database_url
+        if args.ritardo_db > 0:
+            database_url = avvia_proxy_lento(database_url, args.ritardo_db / 1000)
+        riusciti = [stampa_esito(nome, avvia_e_misura(nome, args, database_url, misura)) for nome in args.modalita]
+    sys.exit(0 if all(riusciti) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import os
+import uuid
+from datetime import date
+from cache import CANALE_LISTE, scarta
+
+# Inserimento in lotto delle visite accodate dal modulo quando la connessione manca.
+#
+# Ogni visita porta una chiave generata dal browser (colonna visite.chiave_invio,
+# migrazione 6): se la risposta a un invio va persa il browser ripete lo stesso lotto
+# e le visite già inserite vengono riconosciute invece di essere duplicate. L'unicità
+# della chiave è garantita da invii_visite (migrazione 11), non partizionata: con
+# visite partizionata l'indice unico su visite comprende data_visita e non
+# fermerebbe un invio ripetuto con la data corretta nel frattempo.
+# Tutto il lotto è scritto in una transazione con poche istruzioni su array
+# (unnest), indipendenti dal numero di visite: una per i volontari nuovi, una per
+# le visite, una per riconoscere le chiavi già viste solo se qualcosa manca.
+# L'esito è riportato per ogni visita.
+
+VISITE_LOTTO_MAX = int(os.getenv('VISITE_LOTTO_MAX', 200))
+
+CAMPI_VOLONTARIO = ['volontario_email', 'volontario_cognome', 'volontario_nome', 'telefono', 'competenze', 'disponibilita']
+CAMPI_VISITA = ['volontario_email', 'assistito_nome', 'accoglienza', 'data_visita', 'necessita', 'cosa_migliorare']
+
+# Volontari nuovi del lotto; la notifica alla cache degli elenchi parte solo se ne è stato creato qualcuno
+INSERISCI_VOLONTARI = """
+    WITH nuovi AS (
+        INSERT INTO volontari (email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione)
+        SELECT n.email, n.cognome, n.nome, n.telefono, n.competenze, n.disponibilita, now()
+        FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::text[], %s::text[])
+             AS n(email, cognome, nome, telefono, competenze, disponibilita)
+        ON CONFLICT (email) DO NOTHING
+        RETURNING email
+    ), avviso AS (
+        SELECT pg_notify(%s, 'volontari') WHERE EXISTS (SELECT 1 FROM nuovi)
+    )
+    SELECT count(*) FROM avviso
+"""
+
+# Le visite con volontario o assistito inesistente vengono saltate (e segnalate)
+# invece di far fallire l'intero lotto sulla chiave esterna. Una visita viene
+# inserita solo se la sua chiave entra in invii_visite nella stessa istruzione: con
+# due invii concorrenti della stessa chiave il secondo aspetta il commit del primo
+# e poi la salta.
+INSERISCI_VISITE = """
+    WITH valide AS (
+        SELECT n.*
+        FROM unnest(%s::text[], %s::text[], %s::text[], %s::date[], %s::text[], %s::text[], %s::uuid[])
+             AS n(volontario_email, assistito_nome, accoglienza, data_visita, necessita, cosa_migliorare, chiave)
+        JOIN volontari vol ON vol.email = n.volontario_email
+        JOIN assistiti ass ON ass.nome_sigla = n.assistito_nome
+    ), nuove AS (
+        INSERT INTO invii_visite (chiave_invio)
+        SELECT chiave FROM valide
+        ON CONFLICT (chiave_invio) DO NOTHING
+        RETURNING chiave_invio
+    )
+    INSERT INTO visite (volontario_email, assistito_nome, accoglienza, data_visita, necessita, cosa_migliorare, chiave_invio)
+    SELECT v.volontario_email, v.assistito_nome, v.accoglienza, v.data_visita, v.necessita, v.cosa_migliorare, v.chiave
+    FROM valide v JOIN nuove ON nuove.chiave_invio = v.chiave
+    RETURNING chiave_invio, id
+"""
+
+# Chiavi già ricevute (da un invio precedente) e volontari esistenti tra quelli
+# mancanti. L'id manca se la visita è stata eliminata dopo l'invio.
+CONTROLLA_MANCANTI = """
+    SELECT 'visita', i.chiave_invio::text, v.id
+    FROM invii_visite i LEFT JOIN visite v ON v.chiave_invio = i.chiave_invio
+    WHERE i.chiave_invio = ANY(%s::uuid[])
+    UNION ALL
+    SELECT 'volontario', email, NULL FROM volontari WHERE email = ANY(%s::text[])
+"""
+
+def testo(voce, campo):
+    valore = voce.get(campo)
+    if valore is None:
+        return None
+    return str(valore).strip()
+
+# Controlla una voce del lotto: restituisce (chiave, visita) oppure (chiave, messaggio di errore)
+def valida_voce(voce):
+    if not isinstance(voce, dict):
+        return None, "Voce non valida."
+    try:
+        chiave = uuid.UUID(str(voce.get('chiave')))
+    except ValueError:
+        return None, "Chiave mancante o non valida."
+    visita = {campo: testo(voce, campo) for campo in set(CAMPI_VOLONTARIO + CAMPI_VISITA)}
+    if not visita['volontario_email'] or not visita['assistito_nome'] or not visita['accoglienza'] or not visita['data_visita']:
+        return chiave, "Email, assistito, accoglienza e data visita sono obbligatori."
+    try:
+        visita['data_visita'] = date.fromisoformat(visita['data_visita'][:10])
+    except ValueError:
+        return chiave, "Data visita non valida."
+    return chiave, visita
+
+def colonne(righe, campi):
+    return [[riga[campo] for riga in righe] for campo in campi]
+
+# Inserisce le visite del lotto con il cursore della route (il commit lo fa la route)
+# e restituisce un risultato per voce, nello stesso ordine:
+#   {'chiave', 'esito': 'inserita' | 'gia_inserita' | 'errore', 'id' o 'errore'}
+def inserisci_lotto(cur, voci):
+    risultati = []
+    da_inserire = {}
+    for voce in voci:
+        chiave, visita = valida_voce(voce)
+        if isinstance(visita, str):
+            risultati.append({'chiave': str(chiave) if chiave else None, 'esito': 'errore', 'errore': visita})
+        else:
+            risultati.append({'chiave': str(chiave)})
+            # Una chiave ripetuta nello stesso lotto vale una sola visita
+            da_inserire.setdefault(chiave, visita)
+
+    if da_inserire:
+        volontari = {}
+        for visita in da_inserire.values():
+            if visita['volontario_cognome'] and visita['volontario_nome']:
+                volontari.setdefault(visita['volontario_email'], visita)
+        if volontari:
+            cur.execute(INSERISCI_VOLONTARI, colonne(volontari.values(), CAMPI_VOLONTARIO) + [CANALE_LISTE], prepare=True)
+            if cur.fetchone()[0]:
+                scarta('volontari')
+
+        chiavi = list(da_inserire)
+        cur.execute(INSERISCI_VISITE, colonne(da_inserire.values(), CAMPI_VISITA) + [chiavi], prepare=True)
+        esiti = {str(chiave): {'esito': 'inserita', 'id': id_visita} for chiave, id_visita in cur.fetchall()}
+
+        mancanti = [chiave for chiave in chiavi if str(chiave) not in esiti]
+        if mancanti:
+            cur.execute(CONTROLLA_MANCANTI, (mancanti, list({da_inserire[c]['volontario_email'] for c in mancanti})))
+            esistenti = set()
+            for tipo, valore, id_visita in cur.fetchall():
+                if tipo == 'visita':
+                    esiti[valore] = {'esito': 'gia_inserita', 'id': id_visita}
+                else:
+                    esistenti.add(valore)
+            for chiave in mancanti:
+                if str(chiave) in esiti:
+                    continue
+                if da_inserire[chiave]['volontario_email'] not in esistenti:
+                    errore = "Cognome e nome sono obbligatori per un nuovo volontario."
+                else:
+                    errore = "Assistito non trovato."
+                esiti[str(chiave)] = {'esito': 'errore', 'errore': errore}
+
+        for risultato in risultati:
+            if 'esito' not in risultato:
+                risultato.update(esiti[risultato['chiave']])
+    return risultati
@@ -0,0 +1,233 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+import psycopg
+
+# Metriche delle richieste e delle query, esposte in formato testo Prometheus su /metrics.
+#
+# Per ogni route: durata (fino alla fine dell'invio, anche per le risposte in
+# streaming come le esportazioni), dimensione della risposta, numero e tempo delle
+# query SQL e attesa di una connessione dal pool. Le query sono misurate da
+# CursoreMisurato, il cursore di tutte le connessioni del pool: nessuna route va
+# modificata. Con METRICHE_QUERY_LENTA_MS > 0 le query più lente finiscono nel log.
+#
+# I valori sono per processo: con più worker gunicorn ogni worker espone i propri,
+# distinti dall'etichetta "pid".
+
+METRICHE = os.getenv('METRICHE', '1') == '1'
+METRICHE_TOKEN = os.getenv('METRICHE_TOKEN')
+METRICHE_QUERY_LENTA_MS = float(os.getenv('METRICHE_QUERY_LENTA_MS', 0))
+
+BUCKET_SECONDI = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BUCKET_BYTE = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+BUCKET_QUERY = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+DESCRIZIONI = {
+    'scheda_richiesta_durata_secondi': ('histogram', "Durata delle richieste, fino alla fine della risposta"),
+    'scheda_risposta_byte': ('histogram', "Dimensione del corpo delle risposte"),
+    'scheda_richieste_totale': ('counter', "Richieste per route, metodo e stato HTTP"),
+    'scheda_sql_query_per_richiesta': ('histogram', "Query SQL eseguite da ogni richiesta"),
+    'scheda_sql_query_totale': ('counter', "Query SQL eseguite"),
+    'scheda_sql_durata_secondi_totale': ('counter', "Tempo totale passato nelle query SQL"),
+    'scheda_sql_query_lente_totale': ('counter', "Query SQL sopra METRICHE_QUERY_LENTA_MS"),
+    'scheda_pool_attesa_secondi': ('histogram', "Attesa di una connessione dal pool"),
+}
+
+FUORI_RICHIESTA = 'fuori_richiesta'
+
+_istogrammi = {}
+_contatori = {}
+_lock = threading.Lock()
+# Stato della richiesta in corso nel thread: route, inizio, query eseguite e byte inviati
+_richiesta = contextvars.ContextVar('metriche_richiesta', default=None)
+
+def osserva(nome, etichette, valore, bucket):
+    chiave = (nome, tuple(sorted(etichette.items())))
+    with _lock:
+        voce = _istogrammi.get(chiave)
+        if voce is None:
+            voce = _istogrammi[chiave] = [bucket, [0] * len(bucket), 0.0, 0]
+        for i, limite in enumerate(bucket):
+            if valore <= limite:
+                voce[1][i] += 1
+        voce[2] += valore
+        voce[3] += 1
+
+def incrementa(nome, etichette, valore=1):
+    chiave = (nome, tuple(sorted(etichette.items())))
+    with _lock:
+        _contatori[chiave] = _contatori.get(chiave, 0) + valore
+
+def route_corrente():
+    stato = _richiesta.get()
+    return stato['route'] if stato else FUORI_RICHIESTA
+
+def testo_query(query, cur):
+    if isinstance(query, (str, bytes)):
+        testo = query.decode('utf-8', 'replace') if isinstance(query, bytes) else query
+    else:
+        try:
+            testo = query.as_string(cur)
+        except (psycopg.Error, AttributeError):
+            testo = str(query)
+    return ' '.join(testo.split())
+
+def registra_query(query, durata, cur):
+    stato = _richiesta.get()
+    route = stato['route'] if stato else FUORI_RICHIESTA
+    if stato:
+        stato['query'] += 1
+    incrementa('scheda_sql_query_totale', {'route': route})
+    incrementa('scheda_sql_durata_secondi_totale', {'route': route}, durata)
+    if METRICHE_QUERY_LENTA_MS and durata * 1000 >= METRICHE_QUERY_LENTA_MS:
+        incrementa('scheda_sql_query_lente_totale', {'route': route})
+        logging.warning(f"Query lenta ({durata * 1000:.0f} ms) in {route}: {testo_query(query, cur)[:500]}")
+
+# Chiamata da db.get_db_connection con il tempo passato ad aspettare il pool
+def registra_attesa_pool(durata):
+    osserva('scheda_pool_attesa_secondi', {'route': route_corrente()}, durata, BUCKET_SECONDI)
+
+# Cursore delle connessioni del pool: misura execute, executemany e copy.
+# La query vuota con cui il pool controlla le connessioni non viene contata.
+class CursoreMisurato(psycopg.Cursor):
+    def execute(self, query, params=None, **kwargs):
+        if query == '':
+            return super().execute(query, params, **kwargs)
+        inizio = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            registra_query(query, time.perf_counter() - inizio, self)
+
+    def executemany(self, query, params_seq, **kwargs):
+        inizio = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            registra_query(query, time.perf_counter() - inizio, self)
+
+    # Per COPY il tempo comprende il trasferimento dei dati, letti o scritti dal chiamante
+    @contextmanager
+    def copy(self, statement, params=None, **kwargs):
+        inizio = time.perf_counter()
+        try:
+            with super().copy(statement, params, **kwargs) as copy:
+                yield copy
+        finally:
+            registra_query(statement, time.perf_counter() - inizio, self)
+
+# Lo stesso per le connessioni asincrone di asgi.py
+class CursoreMisuratoAsincrono(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        if query == '':
+            return await super().execute(query, params, **kwargs)
+        inizio = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            registra_query(query, time.perf_counter() - inizio, self)
+
+# Conta i byte delle risposte in streaming mentre vengono inviate
+def conta_byte(corpo, stato):
+    try:
+        for blocco in corpo:
+            stato['byte'] += len(blocco)
+            yield blocco
+    finally:
+        if hasattr(corpo, 'close'):
+            corpo.close()
+
+def apri_richiesta(route):
+    stato = {'route': route, 'inizio': time.perf_counter(), 'query': 0, 'byte': 0}
+    stato['token'] = _richiesta.set(stato)
+    return stato
+
+def chiudi_richiesta(stato, metodo, codice, token):
+    route = stato['route']
+    osserva('scheda_richiesta_durata_secondi', {'route': route, 'metodo': metodo},
+            time.perf_counter() - stato['inizio'], BUCKET_SECONDI)
+    osserva('scheda_risposta_byte', {'route': route}, stato['byte'], BUCKET_BYTE)
+    osserva('scheda_sql_query_per_richiesta', {'route': route}, stato['query'], BUCKET_QUERY)
+    incrementa('scheda_richieste_totale', {'route': route, 'metodo': metodo, 'stato': str(codice)})
+    try:
+        _richiesta.reset(token)
+    except ValueError:
+        _richiesta.set(None)
+
+def installa(app):
+    if not METRICHE:
+        return
+    from flask import request
+
+    @app.before_request
+    def inizio_richiesta():
+        apri_richiesta(request.url_rule.rule if request.url_rule else 'sconosciuta')
+
+    @app.after_request
+    def fine_richiesta(risposta):
+        stato = _richiesta.get()
+        if stato is None:
+            return risposta
+        if risposta.is_streamed and not risposta.direct_passthrough:
+            risposta.response = conta_byte(risposta.response, stato)
+        else:
+            stato['byte'] = risposta.calculate_content_length() or 0
+        metodo, codice = request.method, risposta.status_code
+        stato['risposta'] = True
+        risposta.call_on_close(lambda: chiudi_richiesta(stato, metodo, codice, stato['token']))
+        return risposta
+
+    # Eseguita sempre, anche quando la richiesta finisce con un'eccezione prima che
+    # fine_richiesta veda una risposta (eccezioni propagate, errori negli altri
+    # after_request): la richiesta viene registrata con lo stato 500
+    @app.teardown_request
+    def richiesta_interrotta(errore):
+        stato = _richiesta.get()
+        if stato is None or stato.get('risposta'):
+            return
+        chiudi_richiesta(stato, request.method, 500, stato['token'])
+
+def etichette_testo(etichette):
+    return ','.join(f'{nome}="{escape_etichetta(valore)}"' for nome, valore in etichette)
+
+def escape_etichetta(valore):
+    return str(valore).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatta_numero(valore):
+    return repr(float(valore)) if isinstance(valore, float) else str(valore)
+
+# Testo in formato Prometheus; extra sono gauge aggiuntive {nome: (descrizione, valore)}
+def testo_prometheus(extra=None):
+    pid = ('pid', str(os.getpid()))
+    righe = []
+    with _lock:
+        istogrammi = {chiave: (bucket, list(conteggi), somma, totale)
+                      for chiave, (bucket, conteggi, somma, totale) in _istogrammi.items()}
+        contatori = dict(_contatori)
+
+    for nome, (tipo, descrizione) in DESCRIZIONI.items():
+        righe.append(f"# HELP {nome} {descrizione}")
+        righe.append(f"# TYPE {nome} {tipo}")
+        if tipo == 'histogram':
+            for (n, etichette), (bucket, conteggi, somma, totale) in sorted(istogrammi.items()):
+                if n != nome:
+                    continue
+                base = list(etichette) + [pid]
+                for limite, conteggio in zip(bucket, conteggi):
+                    righe.append(f"{nome}_bucket{{{etichette_testo(base + [('le', limite)])}}} {conteggio}")
+                righe.append(f"{nome}_bucket{{{etichette_testo(base + [('le', '+Inf')])}}} {totale}")
+                righe.append(f"{nome}_sum{{{etichette_testo(base)}}} {formatta_numero(somma)}")
+                righe.append(f"{nome}_count{{{etichette_testo(base)}}} {totale}")
+        else:
+            for (n, etichette), valore in sorted(contatori.items()):
+                if n == nome:
+                    righe.append(f"{nome}{{{etichette_testo(list(etichette) + [pid])}}} {formatta_numero(valore)}")
+
+    for nome, (descrizione, valore) in (extra or {}).items():
+        righe.append(f"# HELP {nome} {descrizione}")
+        righe.append(f"# TYPE {nome} gauge")
+        righe.append(f"{nome}{{{etichette_testo([pid])}}} {formatta_numero(valore)}")
+    return '\n'.join(righe) + '\n'
@@ -0,0 +1,688 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import psycopg
+from dotenv import load_dotenv
+
+# Migrazioni dello schema, numerate e applicate in ordine.
+#
+# Le versioni applicate sono registrate in schema_migrazioni. Si applicano al deploy
+# con "python migrazioni.py applica", prima di avviare gunicorn. Con
+# MIGRAZIONI_ALL_AVVIO=1 anche ogni worker chiama applica_migrazioni() all'avvio:
+# un advisory lock fa sì che solo il primo le esegua, gli altri aspettano e trovano
+# lo schema già aggiornato. Ogni migrazione
+# gira nella propria transazione, quindi se fallisce lo schema resta alla versione
+# precedente. Le migrazioni già rilasciate non vanno modificate: se ne aggiunge una nuova.
+
+LOCK_MIGRAZIONI = 72150001
+
+SCHEMA_MIGRAZIONI = """
+CREATE TABLE IF NOT EXISTS schema_migrazioni (
+    versione INTEGER PRIMARY KEY,
+    descrizione TEXT NOT NULL,
+    applicata TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+# Schema di partenza: le tabelle come esistevano prima delle migrazioni
+SCHEMA_INIZIALE = """
+CREATE TABLE IF NOT EXISTS volontari (
+    id INTEGER PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    email TEXT NOT NULL UNIQUE,
+    cognome TEXT NOT NULL,
+    nome TEXT NOT NULL,
+    telefono TEXT,
+    competenze TEXT,
+    disponibilita TEXT,
+    data_iscrizione TIMESTAMPTZ
+);
+CREATE TABLE IF NOT EXISTS assistiti (
+    id INTEGER PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    nome_sigla TEXT NOT NULL UNIQUE,
+    citta TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS visite (
+    id INTEGER PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    volontario_email TEXT NOT NULL REFERENCES volontari(email) ON DELETE RESTRICT,
+    assistito_nome TEXT NOT NULL REFERENCES assistiti(nome_sigla) ON DELETE RESTRICT,
+    accoglienza TEXT NOT NULL,
+    data_visita TEXT NOT NULL,
+    necessita TEXT,
+    cosa_migliorare TEXT
+);
+"""
+
+# I valori esistenti sono date ISO scritte dal form (eventualmente con l'ora, che
+# viene scartata). Un valore non convertibile fa fallire la migrazione con il
+# messaggio di PostgreSQL che lo riporta, senza toccare la tabella.
+DATA_VISITA_DATE = """
+ALTER TABLE visite ALTER COLUMN data_visita TYPE DATE USING data_visita::date
+"""
+
+# (data_visita, id) serve sia i filtri per data sia l'ordinamento con paginazione a
+# cursore del report; (volontario_email, data_visita, id) il report per volontario,
+# il CSV, il PDF e la pulizia filtrata; assistito_nome il controllo prima di eliminare
+# un assistito. Il controllo sui volontari usa il prefisso del secondo indice.
+INDICI_VISITE = """
+CREATE INDEX IF NOT EXISTS visite_data_visita_idx ON visite (data_visita, id);
+CREATE INDEX IF NOT EXISTS visite_volontario_data_idx ON visite (volontario_email, data_visita, id);
+CREATE INDEX IF NOT EXISTS visite_assistito_idx ON visite (assistito_nome);
+ANALYZE visite;
+"""
+
+# Conteggi delle visite per giorno, volontario, città e accoglienza, tenuti
+# aggiornati da trigger a livello di istruzione su visite e assistiti: valgono
+# per ogni percorso di scrittura (form, pulizie, ripristini, COPY del seed).
+# La città è quella attuale dell'assistito, come nella join del report.
+STATISTICHE_GIORNALIERE = """
+CREATE TABLE IF NOT EXISTS statistiche_giornaliere (
+    giorno DATE NOT NULL,
+    volontario_email TEXT NOT NULL,
+    citta TEXT NOT NULL,
+    accoglienza TEXT NOT NULL,
+    visite INTEGER NOT NULL,
+    PRIMARY KEY (giorno, volontario_email, citta, accoglienza)
+);
+CREATE INDEX IF NOT EXISTS statistiche_giornaliere_volontario_idx ON statistiche_giornaliere (volontario_email, giorno);
+
+CREATE OR REPLACE FUNCTION statistiche_visite_delta() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE statistiche_giornaliere s SET visite = s.visite - d.visite
+        FROM (
+            SELECT o.data_visita AS giorno, o.volontario_email, a.citta, o.accoglienza, COUNT(*) AS visite
+            FROM vecchie o JOIN assistiti a ON a.nome_sigla = o.assistito_nome
+            GROUP BY 1, 2, 3, 4
+        ) d
+        WHERE s.giorno = d.giorno AND s.volontario_email = d.volontario_email
+          AND s.citta = d.citta AND s.accoglienza = d.accoglienza;
+        DELETE FROM statistiche_giornaliere s USING (SELECT DISTINCT data_visita, volontario_email FROM vecchie) o
+        WHERE s.giorno = o.data_visita AND s.volontario_email = o.volontario_email AND s.visite <= 0;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO statistiche_giornaliere (giorno, volontario_email, citta, accoglienza, visite)
+        SELECT n.data_visita, n.volontario_email, a.citta, n.accoglienza, COUNT(*)
+        FROM nuove n JOIN assistiti a ON a.nome_sigla = n.assistito_nome
+        GROUP BY 1, 2, 3, 4
+        ORDER BY 1, 2, 3, 4
+        ON CONFLICT (giorno, volontario_email, citta, accoglienza)
+        DO UPDATE SET visite = statistiche_giornaliere.visite + EXCLUDED.visite;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Cambio di città di un assistito: le sue visite passano alla nuova città
+CREATE OR REPLACE FUNCTION statistiche_assistiti_citta() RETURNS trigger AS $$
+BEGIN
+    UPDATE statistiche_giornaliere s SET visite = s.visite - d.visite
+    FROM (
+        SELECT v.data_visita AS giorno, v.volontario_email, o.citta, v.accoglienza, COUNT(*) AS visite
+        FROM vecchie o JOIN nuove n ON n.id = o.id JOIN visite v ON v.assistito_nome = n.nome_sigla
+        WHERE o.citta IS DISTINCT FROM n.citta
+        GROUP BY 1, 2, 3, 4
+    ) d
+    WHERE s.giorno = d.giorno AND s.volontario_email = d.volontario_email
+      AND s.citta = d.citta AND s.accoglienza = d.accoglienza;
+    DELETE FROM statistiche_giornaliere s USING vecchie o, nuove n
+    WHERE n.id = o.id AND o.citta IS DISTINCT FROM n.citta AND s.citta = o.citta AND s.visite <= 0;
+    INSERT INTO statistiche_giornaliere (giorno, volontario_email, citta, accoglienza, visite)
+    SELECT v.data_visita, v.volontario_email, n.citta, v.accoglienza, COUNT(*)
+    FROM vecchie o JOIN nuove n ON n.id = o.id JOIN visite v ON v.assistito_nome = n.nome_sigla
+    WHERE o.citta IS DISTINCT FROM n.citta
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1, 2, 3, 4
+    ON CONFLICT (giorno, volontario_email, citta, accoglienza)
+    DO UPDATE SET visite = statistiche_giornaliere.visite + EXCLUDED.visite;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION statistiche_svuota() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM statistiche_giornaliere;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER visite_statistiche_inserimento AFTER INSERT ON visite
+    REFERENCING NEW TABLE AS nuove FOR EACH STATEMENT EXECUTE FUNCTION statistiche_visite_delta();
+CREATE TRIGGER visite_statistiche_modifica AFTER UPDATE ON visite
+    REFERENCING OLD TABLE AS vecchie NEW TABLE AS nuove FOR EACH STATEMENT EXECUTE FUNCTION statistiche_visite_delta();
+CREATE TRIGGER visite_statistiche_eliminazione AFTER DELETE ON visite
+    REFERENCING OLD TABLE AS vecchie FOR EACH STATEMENT EXECUTE FUNCTION statistiche_visite_delta();
+CREATE TRIGGER visite_statistiche_truncate AFTER TRUNCATE ON visite
+    FOR EACH STATEMENT EXECUTE FUNCTION statistiche_svuota();
+CREATE TRIGGER assistiti_statistiche_citta AFTER UPDATE ON assistiti
+    REFERENCING OLD TABLE AS vecchie NEW TABLE AS nuove FOR EACH STATEMENT EXECUTE FUNCTION statistiche_assistiti_citta();
+
+INSERT INTO statistiche_giornaliere (giorno, volontario_email, citta, accoglienza, visite)
+SELECT v.data_visita, v.volontario_email, a.citta, v.accoglienza, COUNT(*)
+FROM visite v JOIN assistiti a ON a.nome_sigla = v.assistito_nome
+GROUP BY 1, 2, 3, 4;
+"""
+
+# Contatore delle modifiche ai dati, usato per invalidare la cache del report in
+# tutti i worker. È una riga normale, non una sequenza: il nuovo valore diventa
+# visibile solo al commit, quindi un report letto con la versione vecchia non può
+# essere salvato in cache con quella nuova. Così com'era qui, con una sola riga
+# aggiornata da ogni istruzione, il lock sulla riga restava fino al commit e metteva
+# in fila tutte le transazioni che scrivono: la migrazione 10 lo sostituisce.
+VERSIONE_DATI = """
+CREATE TABLE IF NOT EXISTS versione_dati (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    versione BIGINT NOT NULL,
+    modificata TIMESTAMPTZ NOT NULL
+);
+INSERT INTO versione_dati (versione, modificata) VALUES (1, now()) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION versione_dati_incrementa() RETURNS trigger AS $$
+BEGIN
+    UPDATE versione_dati SET versione = versione + 1, modificata = now();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER visite_versione_dati AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON visite
+    FOR EACH STATEMENT EXECUTE FUNCTION versione_dati_incrementa();
+CREATE TRIGGER volontari_versione_dati AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON volontari
+    FOR EACH STATEMENT EXECUTE FUNCTION versione_dati_incrementa();
+CREATE TRIGGER assistiti_versione_dati AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON assistiti
+    FOR EACH STATEMENT EXECUTE FUNCTION versione_dati_incrementa();
+"""
+
+# Chiave generata dal browser per ogni visita inviata in lotto (lotto_visite.py):
+# un invio ripetuto dopo una risposta persa non crea una seconda visita.
+# Le visite inserite dal modulo classico restano senza chiave.
+CHIAVE_INVIO = """
+ALTER TABLE visite ADD COLUMN IF NOT EXISTS chiave_invio UUID;
+CREATE UNIQUE INDEX IF NOT EXISTS visite_chiave_invio_idx ON visite (chiave_invio);
+"""
+
+# Storico dei lavori pianificati (pianificatore.py). La coppia (lavoro, pianificata)
+# è unica: un'esecuzione prevista viene registrata una volta sola anche se due
+# processi provano a eseguirla.
+JOB_STORICO = """
+CREATE TABLE IF NOT EXISTS job_storico (
+    id BIGINT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    lavoro TEXT NOT NULL,
+    pianificata TIMESTAMPTZ NOT NULL,
+    nodo TEXT NOT NULL,
+    inizio TIMESTAMPTZ NOT NULL DEFAULT now(),
+    fine TIMESTAMPTZ,
+    durata_ms INTEGER,
+    esito TEXT NOT NULL DEFAULT 'in_corso',
+    dettagli TEXT,
+    UNIQUE (lavoro, pianificata)
+);
+CREATE INDEX IF NOT EXISTS job_storico_inizio_idx ON job_storico (inizio);
+"""
+
+# Attività di ogni volontario (visite, ultima visita, assistiti distinti, visite
+# per accoglienza) per la pagina /volontari e il controllo prima di eliminarne uno.
+# Come per statistiche_giornaliere la tengono aggiornata trigger a livello di
+# istruzione su visite: riepilogo_volontari_assistiti conta le visite per
+# volontario, assistito e accoglienza con somme e sottrazioni; da questa (poche
+# righe per volontario) si contano gli assistiti distinti, mentre visite e
+# accoglienza di riepilogo_volontari ricevono le stesse somme. L'ultima visita si
+# rilegge da visite, una discesa nell'indice (volontario_email, data_visita, id),
+# solo quando viene tolta proprio quella.
+RIEPILOGO_VOLONTARI = """
+CREATE TABLE IF NOT EXISTS riepilogo_volontari_assistiti (
+    volontario_email TEXT NOT NULL,
+    assistito_nome TEXT NOT NULL,
+    accoglienza TEXT NOT NULL,
+    visite INTEGER NOT NULL,
+    PRIMARY KEY (volontario_email, assistito_nome, accoglienza)
+);
+CREATE TABLE IF NOT EXISTS riepilogo_volontari (
+    volontario_email TEXT PRIMARY KEY,
+    visite INTEGER NOT NULL DEFAULT 0,
+    assistiti INTEGER NOT NULL DEFAULT 0,
+    ultima_visita DATE,
+    accoglienza JSONB NOT NULL DEFAULT '{}'
+);
+
+-- Applica le variazioni (conteggi negativi per le visite tolte, giorno = data più
+-- recente del gruppo). Le righe dei volontari vengono bloccate per prime e in
+-- ordine: le istruzioni successive partono dopo i commit concorrenti sugli stessi
+-- volontari e li vedono, quindi somme e conteggi non perdono visite.
+CREATE OR REPLACE FUNCTION riepilogo_volontari_applica(emails TEXT[], assistiti_nomi TEXT[], accoglienze TEXT[], conteggi INTEGER[], giorni DATE[]) RETURNS void AS $$
+DECLARE
+    tolte BOOLEAN := EXISTS (SELECT 1 FROM unnest(conteggi) AS n WHERE n < 0);
+BEGIN
+    INSERT INTO riepilogo_volontari (volontario_email)
+    SELECT DISTINCT e FROM unnest(emails) AS e ORDER BY 1
+    ON CONFLICT DO NOTHING;
+    PERFORM 1 FROM riepilogo_volontari WHERE volontario_email = ANY(emails) ORDER BY volontario_email FOR UPDATE;
+
+    INSERT INTO riepilogo_volontari_assistiti AS r (volontario_email, assistito_nome, accoglienza, visite)
+    SELECT e, a, c, SUM(n) FROM unnest(emails, assistiti_nomi, accoglienze, conteggi) AS d (e, a, c, n)
+    GROUP BY 1, 2, 3
+    ORDER BY 1, 2, 3
+    ON CONFLICT (volontario_email, assistito_nome, accoglienza) DO UPDATE SET visite = r.visite + EXCLUDED.visite;
+    IF tolte THEN
+        DELETE FROM riepilogo_volontari_assistiti r USING unnest(emails, assistiti_nomi, accoglienze) AS d (e, a, c)
+        WHERE r.volontario_email = d.e AND r.assistito_nome = d.a AND r.accoglienza = d.c AND r.visite <= 0;
+    END IF;
+
+    UPDATE riepilogo_volontari r
+    SET visite = r.visite + d.visite,
+        assistiti = (SELECT COUNT(DISTINCT a.assistito_nome) FROM riepilogo_volontari_assistiti a WHERE a.volontario_email = r.volontario_email),
+        accoglienza = (
+            SELECT COALESCE(jsonb_object_agg(key, somma), '{}')
+            FROM (
+                SELECT key, SUM(value::integer) AS somma
+                FROM (SELECT * FROM jsonb_each_text(r.accoglienza) UNION ALL SELECT * FROM jsonb_each_text(d.accoglienza)) AS t
+                GROUP BY key
+                HAVING SUM(value::integer) > 0
+            ) s
+        ),
+        ultima_visita = GREATEST(r.ultima_visita, d.aggiunta)
+    FROM (
+        SELECT e, SUM(n) AS visite, jsonb_object_agg(c, n) AS accoglienza, MAX(aggiunta) AS aggiunta
+        FROM (SELECT e, c, SUM(n) AS n, MAX(g) FILTER (WHERE n > 0) AS aggiunta
+              FROM unnest(emails, accoglienze, conteggi, giorni) AS x (e, c, n, g)
+              GROUP BY 1, 2) AS p
+        GROUP BY e
+    ) d
+    WHERE r.volontario_email = d.e;
+
+    IF tolte THEN
+        -- L'ultima visita si rilegge solo se è stata tolta proprio quella
+        UPDATE riepilogo_volontari r
+        SET ultima_visita = (SELECT MAX(v.data_visita) FROM visite v WHERE v.volontario_email = r.volontario_email)
+        FROM (
+            SELECT e, MAX(g) AS tolta FROM unnest(emails, conteggi, giorni) AS x (e, n, g) WHERE n < 0 GROUP BY 1
+        ) d
+        WHERE r.volontario_email = d.e AND d.tolta >= r.ultima_visita;
+        DELETE FROM riepilogo_volontari WHERE volontario_email = ANY(emails) AND visite <= 0;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION riepilogo_volontari_delta() RETURNS trigger AS $$
+DECLARE
+    emails TEXT[];
+    assistiti_nomi TEXT[];
+    accoglienze TEXT[];
+    conteggi INTEGER[];
+    giorni DATE[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(e), array_agg(a), array_agg(c), array_agg(n), array_agg(g)
+        INTO emails, assistiti_nomi, accoglienze, conteggi, giorni
+        FROM (SELECT volontario_email, assistito_nome, accoglienza, COUNT(*)::integer, MAX(data_visita)
+              FROM nuove GROUP BY 1, 2, 3) AS d (e, a, c, n, g);
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(e), array_agg(a), array_agg(c), array_agg(n), array_agg(g)
+        INTO emails, assistiti_nomi, accoglienze, conteggi, giorni
+        FROM (SELECT volontario_email, assistito_nome, accoglienza, -COUNT(*)::integer, MAX(data_visita)
+              FROM vecchie GROUP BY 1, 2, 3) AS d (e, a, c, n, g);
+    ELSE
+        SELECT array_agg(e), array_agg(a), array_agg(c), array_agg(n), array_agg(g)
+        INTO emails, assistiti_nomi, accoglienze, conteggi, giorni
+        FROM (SELECT volontario_email, assistito_nome, accoglienza, -COUNT(*)::integer, MAX(data_visita)
+              FROM vecchie GROUP BY 1, 2, 3
+              UNION ALL
+              SELECT volontario_email, assistito_nome, accoglienza, COUNT(*)::integer, MAX(data_visita)
+              FROM nuove GROUP BY 1, 2, 3) AS d (e, a, c, n, g);
+    END IF;
+    IF emails IS NOT NULL THEN
+        PERFORM riepilogo_volontari_applica(emails, assistiti_nomi, accoglienze, conteggi, giorni);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION riepilogo_volontari_svuota() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM riepilogo_volontari_assistiti;
+    DELETE FROM riepilogo_volontari;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER visite_riepilogo_inserimento AFTER INSERT ON visite
+    REFERENCING NEW TABLE AS nuove FOR EACH STATEMENT EXECUTE FUNCTION riepilogo_volontari_delta();
+CREATE TRIGGER visite_riepilogo_modifica AFTER UPDATE ON visite
+    REFERENCING OLD TABLE AS vecchie NEW TABLE AS nuove FOR EACH STATEMENT EXECUTE FUNCTION riepilogo_volontari_delta();
+CREATE TRIGGER visite_riepilogo_eliminazione AFTER DELETE ON visite
+    REFERENCING OLD TABLE AS vecchie FOR EACH STATEMENT EXECUTE FUNCTION riepilogo_volontari_delta();
+CREATE TRIGGER visite_riepilogo_truncate AFTER TRUNCATE ON visite
+    FOR EACH STATEMENT EXECUTE FUNCTION riepilogo_volontari_svuota();
+
+INSERT INTO riepilogo_volontari_assistiti (volontario_email, assistito_nome, accoglienza, visite)
+SELECT volontario_email, assistito_nome, accoglienza, COUNT(*)
+FROM visite
+GROUP BY 1, 2, 3;
+INSERT INTO riepilogo_volontari (volontario_email, visite, assistiti, ultima_visita, accoglienza)
+SELECT a.volontario_email, SUM(a.visite), COUNT(DISTINCT a.assistito_nome),
+       (SELECT MAX(v.data_visita) FROM visite v WHERE v.volontario_email = a.volontario_email),
+       (SELECT jsonb_object_agg(c.accoglienza, c.visite)
+        FROM (SELECT accoglienza, SUM(visite) AS visite FROM riepilogo_volontari_assistiti
+              WHERE volontario_email = a.volontario_email GROUP BY 1) c)
+FROM riepilogo_volontari_assistiti a
+GROUP BY a.volontario_email;
+"""
+
+# Versione dei dati senza una riga condivisa da tutte le scritture. La versione è
+# la somma di VERSIONE_DATI_RIGHE contatori e ogni connessione incrementa quello
+# del proprio backend, quindi due transazioni si contendono una riga solo se i
+# loro backend cadono sullo stesso contatore. L'incremento avviene una volta per
+# transazione, al commit: i trigger sono constraint trigger differiti e il WHEN
+# mette in coda solo la prima riga modificata. Essendo l'ultimo lock preso dalla
+# transazione, non può formare stalli con i lock sulle righe presi dagli altri
+# trigger (statistiche, riepilogo) in ordini diversi. TRUNCATE non ha constraint
+# trigger: incrementa subito, ma ha già il lock esclusivo sulla tabella.
+VERSIONE_DATI_RIGHE = 64
+
+VERSIONE_DATI_CONTATORI = f"""
+DROP TRIGGER visite_versione_dati ON visite;
+DROP TRIGGER volontari_versione_dati ON volontari;
+DROP TRIGGER assistiti_versione_dati ON assistiti;
+
+ALTER TABLE versione_dati DROP COLUMN id;
+ALTER TABLE versione_dati ADD COLUMN contatore SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE versione_dati ALTER COLUMN contatore DROP DEFAULT;
+ALTER TABLE versione_dati ADD PRIMARY KEY (contatore);
+INSERT INTO versione_dati (contatore, versione, modificata)
+SELECT contatore, 0, now() FROM generate_series(1, {VERSIONE_DATI_RIGHE - 1}) AS contatore;
+
+CREATE OR REPLACE FUNCTION versione_dati_segna() RETURNS void AS $$
+    UPDATE versione_dati SET versione = versione + 1, modificata = now()
+    WHERE contatore = pg_backend_pid() % {VERSIONE_DATI_RIGHE};
+$$ LANGUAGE sql;
+
+-- Vero solo la prima volta nella transazione (il valore locale si annulla con
+-- la transazione o il savepoint che l'ha impostato)
+CREATE OR REPLACE FUNCTION versione_dati_da_segnare() RETURNS boolean AS $$
+BEGIN
+    IF current_setting('versione_dati.segnata', true) = 'si' THEN
+        RETURN false;
+    END IF;
+    PERFORM set_config('versione_dati.segnata', 'si', true);
+    RETURN true;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION versione_dati_incrementa() RETURNS trigger AS $$
+BEGIN
+    PERFORM versione_dati_segna();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE CONSTRAINT TRIGGER visite_versione_dati AFTER INSERT OR UPDATE OR DELETE ON visite
+    DEFERRABLE INITIALLY DEFERRED FOR EACH ROW WHEN (versione_dati_da_segnare()) EXECUTE FUNCTION versione_dati_incrementa();
+CREATE CONSTRAINT TRIGGER volontari_versione_dati AFTER INSERT OR UPDATE OR DELETE ON volontari
+    DEFERRABLE INITIALLY DEFERRED FOR EACH ROW WHEN (versione_dati_da_segnare()) EXECUTE FUNCTION versione_dati_incrementa();
+CREATE CONSTRAINT TRIGGER assistiti_versione_dati AFTER INSERT OR UPDATE OR DELETE ON assistiti
+    DEFERRABLE INITIALLY DEFERRED FOR EACH ROW WHEN (versione_dati_da_segnare()) EXECUTE FUNCTION versione_dati_incrementa();
+CREATE TRIGGER visite_versione_dati_truncate AFTER TRUNCATE ON visite
+    FOR EACH STATEMENT EXECUTE FUNCTION versione_dati_incrementa();
+CREATE TRIGGER volontari_versione_dati_truncate AFTER TRUNCATE ON volontari
+    FOR EACH STATEMENT EXECUTE FUNCTION versione_dati_incrementa();
+CREATE TRIGGER assistiti_versione_dati_truncate AFTER TRUNCATE ON assistiti
+    FOR EACH STATEMENT EXECUTE FUNCTION versione_dati_incrementa();
+"""
+
+# Chiavi di invio già ricevute, in una tabella a parte perché l'unicità valga su
+# tutte le visite anche con visite partizionata (vedi lotto_visite.py). Le chiavi
+# restano anche quando le visite vengono eliminate o la tabella svuotata: un invio
+# ripetuto più tardi dal browser non reinserisce una visita già ricevuta.
+INVII_VISITE = """
+CREATE TABLE IF NOT EXISTS invii_visite (
+    chiave_invio UUID PRIMARY KEY,
+    ricevuto TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+INSERT INTO invii_visite (chiave_invio)
+SELECT chiave_invio FROM visite WHERE chiave_invio IS NOT NULL
+ON CONFLICT DO NOTHING;
+"""
+
+# Registro per i backup incrementali (backup_incrementale.py): ogni riga di visite,
+# volontari e assistiti porta in backup_xid l'id della transazione che l'ha scritta,
+# eliminazioni e TRUNCATE finiscono in backup_eliminazioni. Prima lo schema veniva
+# creato dal primo backup incrementale: IF NOT EXISTS e DROP TRIGGER IF EXISTS
+# lasciano invariati i database dove esiste già.
+REGISTRO_BACKUP_TABELLE = [('assistiti', 'nome_sigla'), ('volontari', 'email'), ('visite', 'id')]
+
+REGISTRO_BACKUP = """
+CREATE TABLE IF NOT EXISTS backup_eliminazioni (
+    id BIGINT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    tabella TEXT NOT NULL,
+    chiave TEXT,
+    backup_xid XID8 NOT NULL DEFAULT pg_current_xact_id()
+);
+CREATE INDEX IF NOT EXISTS backup_eliminazioni_xid_idx ON backup_eliminazioni (backup_xid);
+
+CREATE OR REPLACE FUNCTION backup_segna_xid() RETURNS trigger AS $$
+BEGIN
+    NEW.backup_xid := pg_current_xact_id();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION backup_registra_eliminazioni() RETURNS trigger AS $$
+BEGIN
+    EXECUTE format('INSERT INTO backup_eliminazioni (tabella, chiave) SELECT %L, (%I)::text FROM eliminate', TG_TABLE_NAME, TG_ARGV[0]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION backup_registra_truncate() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO backup_eliminazioni (tabella, chiave) VALUES (TG_TABLE_NAME, NULL);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+""" + "".join(f"""
+ALTER TABLE {tabella} ADD COLUMN IF NOT EXISTS backup_xid XID8;
+CREATE INDEX IF NOT EXISTS {tabella}_backup_xid_idx ON {tabella} (backup_xid);
+DROP TRIGGER IF EXISTS {tabella}_backup_xid ON {tabella};
+CREATE TRIGGER {tabella}_backup_xid BEFORE INSERT OR UPDATE ON {tabella}
+    FOR EACH ROW EXECUTE FUNCTION backup_segna_xid();
+DROP TRIGGER IF EXISTS {tabella}_backup_eliminazioni ON {tabella};
+CREATE TRIGGER {tabella}_backup_eliminazioni AFTER DELETE ON {tabella}
+    REFERENCING OLD TABLE AS eliminate FOR EACH STATEMENT EXECUTE FUNCTION backup_registra_eliminazioni('{chiave}');
+DROP TRIGGER IF EXISTS {tabella}_backup_truncate ON {tabella};
+CREATE TRIGGER {tabella}_backup_truncate AFTER TRUNCATE ON {tabella}
+    FOR EACH STATEMENT EXECUTE FUNCTION backup_registra_truncate();
+""" for tabella, chiave in REGISTRO_BACKUP_TABELLE)
+
+# Indici a trigrammi per la ricerca con suggerimenti (ricerca.py), sulle stesse
+# espressioni usate dalle query. pg_trgm non c'è su ogni installazione e crearla può
+# richiedere privilegi che l'utente dell'app non ha: in quel caso la migrazione
+# riesce comunque senza indici e la ricerca usa l'indice in memoria. Se l'estensione
+# viene installata in seguito basta creare i due indici come qui sotto.
+INDICI_RICERCA = """
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm non disponibile (%): ricerca con l''indice in memoria', SQLERRM;
+END;
+$$;
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+        CREATE INDEX IF NOT EXISTS volontari_ricerca_idx ON volontari USING gin (lower(cognome || ' ' || nome || ' ' || email) gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS assistiti_ricerca_idx ON assistiti USING gin (lower(nome_sigla) gin_trgm_ops);
+    END IF;
+END;
+$$;
+"""
+
+# Indici per prefisso per le parole più corte di un trigramma (ricerca.py): l'indice
+# GIN non le può usare, quindi si cercano solo come inizio di un campo.
+# text_pattern_ops rende utilizzabile LIKE 'x%' con qualunque collation.
+INDICI_PREFISSI = """
+CREATE INDEX IF NOT EXISTS volontari_cognome_prefisso_idx ON volontari (lower(cognome) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS volontari_nome_prefisso_idx ON volontari (lower(nome) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS volontari_email_prefisso_idx ON volontari (lower(email) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS assistiti_prefisso_idx ON assistiti (lower(nome_sigla) text_pattern_ops);
+"""
+
+MIGRAZIONI = [
+    (1, "schema iniziale", SCHEMA_INIZIALE),
+    (2, "data_visita come DATE", DATA_VISITA_DATE),
+    (3, "indici su visite per report, esportazioni ed eliminazioni", INDICI_VISITE),
+    (4, "statistiche giornaliere aggiornate da trigger", STATISTICHE_GIORNALIERE),
+    (5, "versione dei dati per la cache del report", VERSIONE_DATI),
+    (6, "chiave di idempotenza delle visite inviate in lotto", CHIAVE_INVIO),
+    (7, "storico dei lavori pianificati", JOB_STORICO),
+    (8, "riepilogo dell'attività dei volontari aggiornato da trigger", RIEPILOGO_VOLONTARI),
+    (9, "indici a trigrammi per la ricerca di volontari e assistiti", INDICI_RICERCA),
+    (10, "versione dei dati su più contatori, incrementata al commit", VERSIONE_DATI_CONTATORI),
+    (11, "chiavi di invio delle visite uniche anche con visite partizionata", INVII_VISITE),
+    (12, "registro delle modifiche per i backup incrementali", REGISTRO_BACKUP),
+    (13, "indici per prefisso per la ricerca con parole brevi", INDICI_PREFISSI),
+]
+
+def versioni_applicate(conn):
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA_MIGRAZIONI)
+        cur.execute("SELECT versione FROM schema_migrazioni")
+        versioni = {riga[0] for riga in cur.fetchall()}
+    conn.commit()
+    return versioni
+
+# Controllo rapido, senza lock, per l'avvio dei worker: di solito non manca nulla
+def schema_aggiornato(conn):
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT versione FROM schema_migrazioni")
+            versioni = {riga[0] for riga in cur.fetchall()}
+    except psycopg.errors.UndefinedTable:
+        versioni = set()
+    conn.rollback()
+    return all(versione in versioni for versione, _, _ in MIGRAZIONI)
+
+# Applica le migrazioni mancanti e restituisce le versioni applicate in questa chiamata
+def applica_migrazioni(conn):
+    applicate = []
+    conn.commit()
+    if schema_aggiornato(conn):
+        return applicate
+    conn.execute("SELECT pg_advisory_lock(%s)", (LOCK_MIGRAZIONI,))
+    try:
+        gia_applicate = versioni_applicate(conn)
+        for versione, descrizione, sql in MIGRAZIONI:
+            if versione in gia_applicate:
+                continue
+            with conn.cursor() as cur:
+                try:
+                    cur.execute(sql)
+                    cur.execute("INSERT INTO schema_migrazioni (versione, descrizione) VALUES (%s, %s)", (versione, descrizione))
+                    conn.commit()
+                except psycopg.Error:
+                    conn.rollback()
+                    logging.error(f"Migrazione {versione} ({descrizione}) fallita")
+                    raise
+            logging.info(f"Migrazione {versione} ({descrizione}) applicata")
+            applicate.append(versione)
+    finally:
+        conn.execute("SELECT pg_advisory_unlock(%s)", (LOCK_MIGRAZIONI,))
+        conn.commit()
+    return applicate
+
+def stato_migrazioni(conn):
+    gia_applicate = versioni_applicate(conn)
+    return [(versione, descrizione, versione in gia_applicate) for versione, descrizione, _ in MIGRAZIONI]
+
+# Query su visite che devono usare un indice, con l'indice atteso. Sono costruite
+# con le stesse funzioni e costanti dell'app (query_visite.py, pulizia.py), così il
+# controllo segue le query che vengono davvero eseguite. Importate qui perché
+# servono solo a "verifica".
+def query_verifica():
+    from query_visite import filtro_visite, query_visite, CONTA_VISITE_ASSISTITO
+    from pulizia import ELIMINA_LOTTO, PULIZIA_LOTTO
+    # Come /report: REPORT_PAGE_SIZE righe più una, le più recenti per prime
+    pagina = {'ordina': 'data', 'crescente': False, 'limite': 51}
+    tutte = filtro_visite('', '', '')
+    where, params = filtro_visite('volontario@example.com', '', '2024-12-31 23:59:59')
+    return [
+        ("report, prima pagina", 'visite_data_visita_idx', *query_visite(tutte, **pagina)),
+        ("report per intervallo di date", 'visite_data_visita_idx',
+         *query_visite(filtro_visite('', '2024-01-01', '2024-01-31 23:59:59'), **pagina)),
+        ("report per volontario e date", 'visite_volontario_data_idx',
+         *query_visite(filtro_visite('volontario@example.com', '2024-01-01', '2024-12-31 23:59:59'), **pagina)),
+        ("pagina successiva (cursore)", 'visite_data_visita_idx', *query_visite(tutte, cursore=('2024-06-01', 1000), **pagina)),
+        ("pulizia per volontario, primo lotto", 'visite_volontario_data_idx',
+         ELIMINA_LOTTO.format(where=where), list(params) + [0, PULIZIA_LOTTO]),
+        # Sottoquery del riepilogo dei volontari (migrazione 8)
+        ("ultima visita di un volontario", 'visite_volontario_data_idx',
+         "SELECT MAX(v.data_visita) FROM visite v WHERE v.volontario_email = %s", ['volontario@example.com']),
+        ("visite di un assistito", 'visite_assistito_idx', CONTA_VISITE_ASSISTITO, ['ASS00001']),
+    ]
+
+def nodi_visite(piano):
+    nodi = []
+    tipo = piano.get('Node Type', '')
+    if tipo.endswith('Scan') and (piano.get('Relation Name', '').startswith('visite') or piano.get('Index Name', '').startswith('visite')):
+        nodi.append((piano['Node Type'], piano.get('Index Name')))
+    for figlio in piano.get('Plans', []):
+        nodi.extend(nodi_visite(figlio))
+    return nodi
+
+# Controlla con EXPLAIN che ogni query di query_verifica() legga visite tramite l'indice atteso.
+# Su tabelle piccole il planner preferisce giustamente la scansione sequenziale, quindi
+# di default la si scoraggia (solo nella transazione di verifica, poi annullata):
+# il controllo diventa "l'indice giusto esiste ed è quello scelto dal planner".
+def verifica_indici(conn, piano_reale=False):
+    risultati = []
+    with conn.cursor() as cur:
+        if not piano_reale:
+            cur.execute("SET LOCAL enable_seqscan = off")
+        for nome, atteso, query, params in query_verifica():
+            cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            piano = cur.fetchone()[0]
+            if isinstance(piano, str):
+                piano = json.loads(piano)
+            nodi = nodi_visite(piano[0]['Plan'])
+            # Con visite partizionata (partizioni.py) il piano usa gli indici delle
+            # partizioni: si confronta l'indice di visite da cui derivano
+            cur.execute("""
+                SELECT i.inhrelid::regclass::text, i.inhparent::regclass::text
+                FROM pg_inherits i WHERE i.inhrelid = ANY(%s::regclass[])
+            """, ([indice for _, indice in nodi if indice],))
+            indici_padre = dict(cur.fetchall())
+            ok = any(indici_padre.get(indice, indice) == atteso for _, indice in nodi)
+            risultati.append((nome, ok, nodi))
+    conn.rollback()
+    return risultati
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(description="Migrazioni dello schema")
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'))
+    comandi = parser.add_subparsers(dest='comando', required=True)
+    comandi.add_parser('applica', help="applica le migrazioni mancanti")
+    comandi.add_parser('stato', help="elenca le migrazioni e quali sono applicate")
+    verifica = comandi.add_parser('verifica', help="controlla con EXPLAIN che le query del report usino gli indici")
+    verifica.add_argument('--piano-reale', action='store_true', help="non scoraggia la scansione sequenziale")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("specificare --database-url o DATABASE_URL")
+
+    with psycopg.connect(args.database_url) as conn:
+        if args.comando == 'applica':
+            applicate = applica_migrazioni(conn)
+            print(f"Migrazioni applicate: {', '.join(map(str, applicate))}" if applicate else "Schema già aggiornato")
+        elif args.comando == 'stato':
+            for versione, descrizione, applicata in stato_migrazioni(conn):
+                print(f"{versione:4}  {'applicata' if applicata else 'mancante ':<10} {descrizione}")
+        else:
+            risultati = verifica_indici(conn, args.piano_reale)
+            for nome, ok, nodi in risultati:
+                dettagli = ', '.join(f"{tipo}{f' ({indice})' if indice else ''}" for tipo, indice in nodi)
+                print(f"{'OK   ' if ok else 'ERRORE'} {nome}: {dettagli}")
+            if not all(ok for _, ok, _ in risultati):
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
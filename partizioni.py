@@ -0,0 +1,355 @@
+import os
+import re
+import time
+import logging
+import argparse
+from datetime import date, timedelta
+import psycopg
+from dotenv import load_dotenv
+from db import get_db_connection, release_db_connection
+
+# Partizionamento mensile di visite per data_visita (facoltativo).
+#
+# Con visite partizionata i report filtrati per data leggono solo i mesi che
+# servono (partition pruning) e /clean su mesi interi elimina le partizioni invece
+# di cancellare le righe (vedi elimina_mesi). Il pianificatore crea ogni giorno le
+# partizioni dei prossimi PARTIZIONI_MESI_AVANTI mesi; le date fuori da ogni
+# partizione (per esempio un anno sbagliato nel modulo) finiscono in visite_default.
+#
+# La conversione di una tabella esistente si avvia a mano, "python partizioni.py
+# migra", e non ferma l'app: la nuova tabella partizionata viene creata accanto a
+# visite e tenuta allineata da un trigger, le righe esistenti vengono copiate a
+# lotti e solo lo scambio finale dei nomi prende un lock esclusivo, per un istante.
+#
+# Differenze della tabella partizionata: la chiave primaria è (id, data_visita) e
+# gli indici unici comprendono data_visita, come richiede PostgreSQL (l'unicità
+# delle chiavi di invio resta globale grazie a invii_visite); l'id viene
+# da una sequenza normale, perché prima di PostgreSQL 17 una tabella partizionata
+# non può avere colonne identity.
+
+PARTIZIONI_MESI_AVANTI = int(os.getenv('PARTIZIONI_MESI_AVANTI', 3))
+PARTIZIONI_LOTTO_COPIA = int(os.getenv('PARTIZIONI_LOTTO_COPIA', 10000))
+PARTIZIONI_LOCK_TIMEOUT = os.getenv('PARTIZIONI_LOCK_TIMEOUT', '5s')
+PARTIZIONI_TENTATIVI = 10
+
+NUOVA = 'visite_partizionata'
+PARTIZIONE_DEFAULT = 'visite_default'
+
+# Copia nella nuova tabella ogni modifica fatta su visite durante la migrazione
+SINCRONIZZA = f"""
+CREATE OR REPLACE FUNCTION visite_sincronizza_partizionata() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        TRUNCATE {NUOVA};
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM {NUOVA} WHERE id = OLD.id AND data_visita = OLD.data_visita;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO {NUOVA} SELECT NEW.* ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER visite_sincronizza AFTER INSERT OR UPDATE OR DELETE ON visite
+    FOR EACH ROW EXECUTE FUNCTION visite_sincronizza_partizionata();
+CREATE TRIGGER visite_sincronizza_truncate AFTER TRUNCATE ON visite
+    FOR EACH STATEMENT EXECUTE FUNCTION visite_sincronizza_partizionata();
+"""
+
+# FOR SHARE: una riga modificata durante la copia viene letta nella versione
+# confermata più recente, quella che il trigger ha già riportato nella nuova tabella
+COPIA_LOTTO = f"""
+    INSERT INTO {NUOVA} SELECT * FROM visite WHERE id > %s AND id <= %s FOR SHARE
+    ON CONFLICT DO NOTHING
+"""
+
+def partizionata(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('visite')")
+        riga = cur.fetchone()
+    return bool(riga and riga[0])
+
+def mese_successivo(giorno):
+    return (giorno.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def nome_partizione(mese):
+    return f"visite_{mese:%Y_%m}"
+
+# Partizioni con i loro limiti [da, a); la partizione di default ha limiti None
+def elenco_partizioni(cur, tabella='visite'):
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        ORDER BY 2
+    """, (tabella,))
+    partizioni = []
+    for nome, limiti, righe_stimate in cur.fetchall():
+        trovati = re.search(r"FROM \('([\d-]+)'\) TO \('([\d-]+)'\)", limiti)
+        da, a = (date.fromisoformat(trovati.group(1)), date.fromisoformat(trovati.group(2))) if trovati else (None, None)
+        partizioni.append((nome, da, a, max(righe_stimate, 0)))
+    return partizioni
+
+# Crea la partizione del mese che inizia con mese, se manca. Le visite di quel mese
+# già finite nella partizione di default vengono spostate nella nuova partizione.
+def crea_partizione(cur, mese, tabella='visite'):
+    nome = nome_partizione(mese)
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (nome,))
+    if cur.fetchone()[0]:
+        return False
+    fine = mese_successivo(mese)
+    cur.execute(f"SELECT EXISTS (SELECT 1 FROM {PARTIZIONE_DEFAULT} WHERE data_visita >= %s AND data_visita < %s)", (mese, fine))
+    if not cur.fetchone()[0]:
+        cur.execute(f"CREATE TABLE {nome} PARTITION OF {tabella} FOR VALUES FROM ('{mese}') TO ('{fine}')")
+        return True
+    # Le righe spostate restano le stesse visite: statistiche e versione dei dati non cambiano
+    cur.execute(f"CREATE TABLE {nome} (LIKE {tabella} INCLUDING DEFAULTS)")
+    cur.execute(f"""
+        WITH spostate AS (
+            DELETE FROM {PARTIZIONE_DEFAULT} WHERE data_visita >= %s AND data_visita < %s RETURNING *
+        )
+        INSERT INTO {nome} SELECT * FROM spostate
+    """, (mese, fine))
+    cur.execute(f"ALTER TABLE {tabella} ATTACH PARTITION {nome} FOR VALUES FROM ('{mese}') TO ('{fine}')")
+    return True
+
+# Lavoro pianificato: partizioni dal mese corrente a PARTIZIONI_MESI_AVANTI mesi avanti
+def crea_partizioni_future():
+    conn = get_db_connection()
+    try:
+        if not partizionata(conn):
+            conn.rollback()
+            return "visite non è partizionata"
+        create = []
+        mese = date.today().replace(day=1)
+        for _ in range(PARTIZIONI_MESI_AVANTI + 1):
+            with conn.cursor() as cur:
+                cur.execute("SELECT set_config('lock_timeout', %s, true)", (PARTIZIONI_LOCK_TIMEOUT,))
+                if crea_partizione(cur, mese):
+                    create.append(nome_partizione(mese))
+            conn.commit()
+            mese = mese_successivo(mese)
+        return f"partizioni create: {', '.join(create)}" if create else "nessuna partizione da creare"
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+# Toglie un mese e aggiorna i dati derivati, in una transazione. Conteggio, registro
+# dei backup e riepilogo vengono letti con la sola partizione bloccata in SHARE MODE:
+# le letture e le scritture sugli altri mesi continuano. visite viene bloccata in
+# modo esclusivo solo per DROP TABLE e per gli aggiornamenti brevi che seguono.
+def elimina_mese(cur, nome, da, a, registro_backup):
+    cur.execute("SELECT set_config('lock_timeout', %s, true)", (PARTIZIONI_LOCK_TIMEOUT,))
+    cur.execute(f"LOCK TABLE {nome} IN SHARE MODE")
+    cur.execute(f"SELECT count(*) FROM {nome}")
+    righe = cur.fetchone()[0]
+    if registro_backup:
+        cur.execute(f"INSERT INTO backup_eliminazioni (tabella, chiave) SELECT 'visite', id::text FROM {nome}")
+    cur.execute(f"""
+        SELECT array_agg(e), array_agg(a), array_agg(c), array_agg(n), array_agg(g)
+        FROM (SELECT volontario_email, assistito_nome, accoglienza, -COUNT(*)::integer, MAX(data_visita)
+              FROM {nome} GROUP BY 1, 2, 3) AS d (e, a, c, n, g)
+    """)
+    tolte = cur.fetchone()
+    # DROP TABLE di una partizione blocca comunque anche visite
+    cur.execute("LOCK TABLE visite IN ACCESS EXCLUSIVE MODE")
+    cur.execute("DELETE FROM statistiche_giornaliere WHERE giorno >= %s AND giorno < %s", (da, a))
+    cur.execute(f"DROP TABLE {nome}")
+    # Dopo il DROP, perché l'ultima visita dei volontari viene riletta da visite
+    if tolte[0]:
+        cur.execute("SELECT riepilogo_volontari_applica(%s::text[], %s::text[], %s::text[], %s::integer[], %s::date[])", tolte)
+    # Ultimo lock della transazione, come nei trigger della versione dei dati
+    cur.execute("SELECT versione_dati_segna()")
+    return righe
+
+# Elimina le partizioni dei mesi interamente compresi tra data_inizio e data_fine
+# (date 'AAAA-MM-GG', vuote = senza limite) e restituisce le visite eliminate.
+# DROP TABLE non attiva i trigger delle eliminazioni: statistiche giornaliere,
+# riepilogo dei volontari, versione dei dati e registro dei backup incrementali
+# vengono aggiornati in elimina_mese, nella stessa transazione. Chi scrive sul mese
+# mentre viene tolto tiene già il lock su visite e aspetta quello sulla partizione:
+# lo stallo o la scadenza del lock annullano la transazione, che viene ripetuta.
+def elimina_mesi(conn, data_inizio='', data_fine=''):
+    inizio = date.fromisoformat(data_inizio) if data_inizio else None
+    fine = date.fromisoformat(data_fine[:10]) if data_fine else None
+    with conn.cursor() as cur:
+        mesi = [(nome, da, a) for nome, da, a, _ in elenco_partizioni(cur)
+                if da and (inizio is None or da >= inizio) and (fine is None or a - timedelta(days=1) <= fine)]
+        cur.execute("SELECT to_regclass('backup_eliminazioni') IS NOT NULL")
+        registro_backup = cur.fetchone()[0]
+    conn.commit()
+
+    eliminate = 0
+    for nome, da, a in mesi:
+        for tentativo in range(PARTIZIONI_TENTATIVI):
+            try:
+                with conn.cursor() as cur:
+                    righe = elimina_mese(cur, nome, da, a, registro_backup)
+                conn.commit()
+                break
+            except (psycopg.errors.LockNotAvailable, psycopg.errors.DeadlockDetected):
+                conn.rollback()
+                logging.info(f"Partizione {nome} occupata, nuovo tentativo ({tentativo + 1}/{PARTIZIONI_TENTATIVI})")
+                time.sleep(1)
+        else:
+            raise RuntimeError(f"Impossibile ottenere il lock per eliminare {nome}: riprovare più tardi")
+        eliminate += righe
+        logging.info(f"Partizione {nome} eliminata ({righe} visite)")
+    return eliminate
+
+def crea_struttura(cur):
+    cur.execute(f"CREATE SEQUENCE {NUOVA}_id_seq AS integer")
+    cur.execute(f"CREATE TABLE {NUOVA} (LIKE visite INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (data_visita)")
+    cur.execute(f"ALTER TABLE {NUOVA} ALTER COLUMN id SET DEFAULT nextval('{NUOVA}_id_seq')")
+    cur.execute(f"ALTER SEQUENCE {NUOVA}_id_seq OWNED BY {NUOVA}.id")
+    cur.execute(f"ALTER TABLE {NUOVA} ADD CONSTRAINT {NUOVA}_pkey PRIMARY KEY (id, data_visita)")
+
+    # Chiavi esterne con gli stessi nomi (i messaggi di errore dell'app li riconoscono)
+    cur.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = 'visite'::regclass AND contype = 'f'")
+    for nome, definizione in cur.fetchall():
+        cur.execute(f"ALTER TABLE {NUOVA} ADD CONSTRAINT {nome} {definizione}")
+
+    # Gli stessi indici, con il suffisso _p fino allo scambio; quelli unici con data_visita
+    cur.execute("""
+        SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid), i.indisunique
+        FROM pg_index i WHERE i.indrelid = 'visite'::regclass AND NOT i.indisprimary
+    """)
+    for nome, definizione, unico in cur.fetchall():
+        trovati = re.match(r'CREATE (UNIQUE )?INDEX \S+ ON \S+ (USING \w+) \((.*?)\)( WHERE .*)?$', definizione)
+        colonne = trovati.group(3)
+        if unico and 'data_visita' not in colonne:
+            colonne += ', data_visita'
+        cur.execute(f"CREATE {trovati.group(1) or ''}INDEX {nome}_p ON {NUOVA} {trovati.group(2)} ({colonne}){trovati.group(4) or ''}")
+
+    # Un mese per ogni mese con visite, più quelli a venire
+    cur.execute("SELECT DISTINCT date_trunc('month', data_visita)::date FROM visite")
+    mesi = {riga[0] for riga in cur.fetchall()}
+    mese = date.today().replace(day=1)
+    for _ in range(PARTIZIONI_MESI_AVANTI + 1):
+        mesi.add(mese)
+        mese = mese_successivo(mese)
+    cur.execute(f"CREATE TABLE {PARTIZIONE_DEFAULT} PARTITION OF {NUOVA} DEFAULT")
+    for mese in sorted(mesi):
+        crea_partizione(cur, mese, NUOVA)
+    cur.execute(SINCRONIZZA)
+    return len(mesi)
+
+def copia_righe(conn, lotto, progresso):
+    with conn.cursor() as cur:
+        cur.execute("SELECT COALESCE(max(id), 0) FROM visite")
+        massimo = cur.fetchone()[0]
+    conn.commit()
+    ultimo = 0
+    while ultimo < massimo:
+        with conn.cursor() as cur:
+            cur.execute(COPIA_LOTTO, (ultimo, ultimo + lotto))
+        conn.commit()
+        ultimo += lotto
+        progresso(f"copiate le visite fino all'id {min(ultimo, massimo)} di {massimo}")
+
+# Scambio dei nomi: la vecchia visite viene eliminata e la nuova prende il suo posto,
+# con i trigger, i nomi degli indici e la sequenza degli id della vecchia
+def scambia(cur):
+    cur.execute("SELECT set_config('lock_timeout', %s, true)", (PARTIZIONI_LOCK_TIMEOUT,))
+    cur.execute(f"LOCK TABLE visite, {NUOVA} IN ACCESS EXCLUSIVE MODE")
+    cur.execute("""
+        SELECT pg_get_triggerdef(oid) FROM pg_trigger
+        WHERE tgrelid = 'visite'::regclass AND NOT tgisinternal
+          AND tgname NOT IN ('visite_sincronizza', 'visite_sincronizza_truncate')
+    """)
+    trigger = [riga[0] for riga in cur.fetchall()]
+    cur.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = 'visite'::regclass AND NOT indisprimary")
+    indici = [riga[0] for riga in cur.fetchall()]
+    cur.execute("""
+        SELECT GREATEST(COALESCE(max(id), 0), COALESCE(pg_sequence_last_value(pg_get_serial_sequence('visite', 'id')::regclass), 0))
+        FROM visite
+    """)
+    ultimo_id = cur.fetchone()[0]
+    if ultimo_id:
+        cur.execute(f"SELECT setval('{NUOVA}_id_seq', %s)", (ultimo_id,))
+
+    cur.execute("DROP TABLE visite")
+    cur.execute("DROP FUNCTION visite_sincronizza_partizionata()")
+    cur.execute(f"ALTER TABLE {NUOVA} RENAME TO visite")
+    cur.execute(f"ALTER TABLE visite RENAME CONSTRAINT {NUOVA}_pkey TO visite_pkey")
+    cur.execute(f"ALTER SEQUENCE {NUOVA}_id_seq RENAME TO visite_id_seq")
+    for nome in indici:
+        cur.execute(f"ALTER INDEX {nome}_p RENAME TO {nome}")
+    for definizione in trigger:
+        cur.execute(definizione)
+
+# Migrazione online di visite a tabella partizionata. Si può interrompere e
+# rilanciare: la struttura già creata viene riusata e la copia è idempotente.
+def migra(conn, lotto=PARTIZIONI_LOTTO_COPIA, progresso=logging.info):
+    if partizionata(conn):
+        conn.rollback()
+        progresso("visite è già partizionata")
+        return
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (NUOVA,))
+        ripresa = cur.fetchone()[0]
+        if not ripresa:
+            mesi = crea_struttura(cur)
+    conn.commit()
+    progresso("migrazione ripresa" if ripresa else f"creata {NUOVA} con {mesi} partizioni mensili")
+
+    copia_righe(conn, lotto, progresso)
+
+    # In una sola istruzione i due conteggi vedono lo stesso snapshot
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT (SELECT count(*) FROM visite), (SELECT count(*) FROM {NUOVA})")
+        vecchie, nuove = cur.fetchone()
+    conn.commit()
+    if vecchie != nuove:
+        raise RuntimeError(f"Copia incompleta: {vecchie} visite, {nuove} nella tabella partizionata")
+
+    for tentativo in range(PARTIZIONI_TENTATIVI):
+        try:
+            with conn.cursor() as cur:
+                scambia(cur)
+            conn.commit()
+            break
+        except psycopg.errors.LockNotAvailable:
+            conn.rollback()
+            progresso(f"visite occupata, nuovo tentativo di scambio ({tentativo + 1}/{PARTIZIONI_TENTATIVI})")
+            time.sleep(1)
+    else:
+        raise RuntimeError("Impossibile ottenere il lock su visite per lo scambio: riprovare più tardi")
+    conn.execute("ANALYZE visite")
+    conn.commit()
+    progresso(f"visite partizionata ({nuove} visite)")
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    parser = argparse.ArgumentParser(description="Partizionamento mensile della tabella visite")
+    comandi = parser.add_subparsers(dest='comando', required=True)
+    migrazione = comandi.add_parser('migra', help="converte visite in tabella partizionata senza fermare l'app")
+    migrazione.add_argument('--lotto', type=int, default=PARTIZIONI_LOTTO_COPIA)
+    comandi.add_parser('crea', help="crea le partizioni dei prossimi mesi")
+    comandi.add_parser('elenco', help="partizioni con limiti e righe stimate")
+    args = parser.parse_args()
+
+    if args.comando == 'crea':
+        print(crea_partizioni_future())
+        return
+    conn = get_db_connection()
+    try:
+        if args.comando == 'migra':
+            migra(conn, args.lotto)
+        else:
+            with conn.cursor() as cur:
+                for nome, da, a, righe in elenco_partizioni(cur):
+                    limiti = f"{da} - {a - timedelta(days=1)}" if da else "default"
+                    print(f"{nome:<20} {limiti:<24} {righe:>10} righe (stima)")
+            conn.rollback()
+    finally:
+        release_db_connection(conn)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import os
+import time
+import socket
+import logging
+import argparse
+import threading
+from datetime import datetime
+import psycopg
+import pytz
+from dotenv import load_dotenv
+from db import get_db_connection, release_db_connection
+from backup_incrementale import esegui_backup_incrementale
+from esportazione import scrivi_backup, nuovo_file_backup, BACKUP_DIR
+from partizioni import crea_partizioni_future
+
+# Lavori pianificati (il backup notturno e le partizioni dei prossimi mesi), eseguiti una sola volta per quanti
+# worker gunicorn e macchine ci siano.
+#
+# Ogni processo che chiama avvia_pianificatore() prova a prendere un advisory lock
+# di sessione con una connessione del pool: chi ci riesce la tiene e avvia lo
+# scheduler, gli altri la restituiscono, riprovano ogni PIANIFICATORE_CONTROLLO
+# secondi e subentrano se la connessione del primo cade. In più ogni esecuzione si registra in job_storico
+# (migrazione 7) con la coppia unica (lavoro, minuto previsto): anche durante un
+# passaggio di consegne lo stesso appuntamento non viene eseguito due volte.
+#
+# PIANIFICATORE_MODALITA:
+#   worker      lo scheduler gira in uno dei worker web (predefinito)
+#   separato    i worker non pianificano nulla; va avviato "python pianificatore.py avvia"
+#   disattivato nessun lavoro pianificato
+
+PIANIFICATORE_MODALITA = os.getenv('PIANIFICATORE_MODALITA', 'worker')
+PIANIFICATORE_CONTROLLO = int(os.getenv('PIANIFICATORE_CONTROLLO', 30))
+# Attesa prima del primo tentativo nei worker, per non rallentarne l'avvio
+PIANIFICATORE_RITARDO = float(os.getenv('PIANIFICATORE_RITARDO', 5))
+LOCK_PIANIFICATORE = 72150002
+
+# Backup automatico: "completo" scrive ogni notte il CSV a sezioni, "incrementale"
+# scrive solo le modifiche dall'ultimo backup (vedi backup_incrementale.py)
+BACKUP_MODALITA = os.getenv('BACKUP_MODALITA', 'completo')
+
+def backup_automatico():
+    logging.info(f"Inizio backup automatico alle: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    for attempt in range(3):
+        conn = None
+        cur = None
+        try:
+            conn = get_db_connection()
+            if BACKUP_MODALITA == 'incrementale':
+                voce = esegui_backup_incrementale(conn)
+                logging.info(f"Backup creato: {voce['cartella']}")
+                return voce['cartella']
+            cur = conn.cursor()
+            filename = scrivi_backup(cur, nuovo_file_backup())
+            logging.info(f"Backup creato: {filename}")
+
+            now = datetime.now()
+            for file in os.listdir(BACKUP_DIR):
+                file_path = os.path.join(BACKUP_DIR, file)
+                if os.path.isfile(file_path):
+                    file_time = datetime.fromtimestamp(os.path.getmtime(file_path))
+                    if (now - file_time).days > 7:
+                        os.remove(file_path)
+                        logging.info(f"Eliminato backup vecchio: {file}")
+            return f"{filename} ({os.path.getsize(filename)} byte)"
+        except psycopg.OperationalError as e:
+            logging.error(f"Tentativo {attempt + 1} fallito: {e}")
+            if attempt == 2:
+                raise
+            time.sleep(5)
+        finally:
+            if cur:
+                cur.close()
+            if conn:
+                release_db_connection(conn)
+
+# Nome, funzione e pianificazione (argomenti di add_job) di ogni lavoro
+LAVORI = [
+    ('backup_automatico', backup_automatico, {'trigger': 'cron', 'hour': 2, 'minute': 0}),
+    ('partizioni_future', crea_partizioni_future, {'trigger': 'cron', 'hour': 3, 'minute': 0}),
+]
+
+def nodo():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+# Registra l'esecuzione in job_storico e la esegue solo se nessun altro processo
+# l'ha già registrata per lo stesso minuto. Il valore restituito dal lavoro (o
+# l'errore) finisce in dettagli, con la durata.
+def esegui_registrato(nome, funzione):
+    pianificata = datetime.now(pytz.timezone('Europe/Rome')).replace(second=0, microsecond=0)
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO job_storico (lavoro, pianificata, nodo) VALUES (%s, %s, %s)
+                ON CONFLICT (lavoro, pianificata) DO NOTHING
+                RETURNING id
+            """, (nome, pianificata, nodo()))
+            riga = cur.fetchone()
+        conn.commit()
+    except psycopg.Error as e:
+        logging.error(f"Lavoro {nome} non eseguito: impossibile registrarlo ({e})")
+        return
+    finally:
+        if conn:
+            release_db_connection(conn)
+    if riga is None:
+        logging.info(f"Lavoro {nome} delle {pianificata:%H:%M} già eseguito da un altro processo")
+        return
+
+    inizio = time.monotonic()
+    esito, dettagli = 'completato', None
+    try:
+        dettagli = funzione()
+    except Exception as e:
+        esito, dettagli = 'errore', str(e)
+        logging.exception(f"Lavoro {nome} fallito")
+    durata_ms = int((time.monotonic() - inizio) * 1000)
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        conn.execute("""
+            UPDATE job_storico SET fine = now(), durata_ms = %s, esito = %s, dettagli = %s WHERE id = %s
+        """, (durata_ms, esito, None if dettagli is None else str(dettagli), riga[0]))
+        conn.commit()
+    except psycopg.Error as e:
+        logging.error(f"Esito del lavoro {nome} non registrato: {e}")
+    finally:
+        if conn:
+            release_db_connection(conn)
+    logging.info(f"Lavoro {nome}: {esito} in {durata_ms} ms")
+
+# apscheduler viene importato solo dal processo che diventa leader
+def crea_scheduler():
+    from apscheduler.schedulers.background import BackgroundScheduler
+    scheduler = BackgroundScheduler(timezone="Europe/Rome")
+    for nome, funzione, pianificazione in LAVORI:
+        scheduler.add_job(esegui_registrato, args=(nome, funzione), id=nome, coalesce=True, **pianificazione)
+    return scheduler
+
+_guida = None
+_guida_lock = threading.Lock()
+_leader = threading.Event()
+
+def e_leader():
+    return _leader.is_set()
+
+# Prova il lock ogni PIANIFICATORE_CONTROLLO secondi con una connessione del pool,
+# restituita subito se il lock è di un altro processo. Il leader invece la tiene
+# finché guida lo scheduler: solo un processo alla volta ha una connessione fuori
+# dal pool per il lock (vedi db.py).
+def guida(fermo, ritardo=0):
+    fermo.wait(ritardo)
+    while not fermo.is_set():
+        conn = None
+        try:
+            conn = get_db_connection()
+            preso = conn.execute("SELECT pg_try_advisory_lock(%s)", (LOCK_PIANIFICATORE,)).fetchone()[0]
+            conn.commit()
+            if preso:
+                logging.info(f"Pianificatore attivo in {nodo()}")
+                scheduler = crea_scheduler()
+                scheduler.start()
+                _leader.set()
+                try:
+                    while not fermo.wait(PIANIFICATORE_CONTROLLO):
+                        conn.execute("SELECT 1")
+                        conn.commit()
+                finally:
+                    _leader.clear()
+                    scheduler.shutdown(wait=False)
+                conn.execute("SELECT pg_advisory_unlock(%s)", (LOCK_PIANIFICATORE,))
+                conn.commit()
+        except psycopg.Error as e:
+            logging.error(f"Pianificatore: connessione persa ({e})")
+            # Chiusa, perché non torni nel pool con il lock ancora preso
+            if conn:
+                conn.close()
+        finally:
+            if conn:
+                release_db_connection(conn)
+        fermo.wait(PIANIFICATORE_CONTROLLO)
+
+# Chiamata da app.py all'import, quindi una volta per worker
+def avvia_pianificatore():
+    global _guida
+    if PIANIFICATORE_MODALITA != 'worker' or _guida is not None:
+        return
+    with _guida_lock:
+        if _guida is None:
+            _guida = threading.Thread(target=guida, args=(threading.Event(), PIANIFICATORE_RITARDO), name='pianificatore', daemon=True)
+            _guida.start()
+
+def storico(conn, limite=20):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT lavoro, pianificata, nodo, inizio, fine, durata_ms, esito, dettagli
+            FROM job_storico ORDER BY inizio DESC LIMIT %s
+        """, (limite,))
+        colonne = [c.name for c in cur.description]
+        return [dict(zip(colonne, riga)) for riga in cur.fetchall()]
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    parser = argparse.ArgumentParser(description="Lavori pianificati")
+    comandi = parser.add_subparsers(dest='comando', required=True)
+    comandi.add_parser('avvia', help="esegue il pianificatore in primo piano (PIANIFICATORE_MODALITA=separato)")
+    esegui = comandi.add_parser('esegui', help="esegue subito un lavoro, registrandolo nello storico")
+    esegui.add_argument('lavoro', choices=[nome for nome, _, _ in LAVORI])
+    elenco = comandi.add_parser('storico', help="ultime esecuzioni con durata ed esito")
+    elenco.add_argument('--limite', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.comando == 'avvia':
+        fermo = threading.Event()
+        try:
+            guida(fermo)
+        except KeyboardInterrupt:
+            fermo.set()
+    elif args.comando == 'esegui':
+        funzioni = {nome: funzione for nome, funzione, _ in LAVORI}
+        esegui_registrato(args.lavoro, funzioni[args.lavoro])
+    else:
+        conn = get_db_connection()
+        try:
+            for voce in storico(conn, args.limite):
+                durata = f"{voce['durata_ms'] / 1000:.1f} s" if voce['durata_ms'] is not None else '-'
+                print(f"{voce['inizio']:%Y-%m-%d %H:%M:%S}  {voce['lavoro']:<20} {voce['esito']:<10} {durata:>9}  "
+                      f"{voce['nodo']}  {voce['dettagli'] or ''}")
+        finally:
+            release_db_connection(conn)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import logging
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+from db import get_db_connection, release_db_connection
+from cache import invalida_liste
+from query_visite import filtro_visite
+from partizioni import partizionata, elimina_mesi
+
+# Eliminazione delle visite a lotti e svuotamento completo, usati da /clean e
+# /clean_volontari come lavori in background (vedi jobs.py).
+#
+# Un unico DELETE su centinaia di migliaia di righe è una sola transazione lunga:
+# tiene i lock delle righe fino al commit (su volontari e assistiti blocca anche i
+# controlli di chiave esterna degli inserimenti dal modulo), impedisce al vacuum
+# di recuperare spazio, scrive tutto il WAL in un colpo e passa ai trigger delle
+# statistiche e dei backup incrementali tabelle di transizione enormi. Qui le
+# visite filtrate vengono eliminate a lotti di PULIZIA_LOTTO righe in ordine di id,
+# con un commit e una breve pausa dopo ogni lotto. Quando si elimina tutto basta
+# TRUNCATE, che non legge le righe: i trigger di TRUNCATE tengono aggiornate le
+# statistiche giornaliere, la versione dei dati e i backup incrementali. Con visite
+# partizionata (partizioni.py) i mesi interi del filtro vengono eliminati togliendo
+# le loro partizioni e solo i giorni ai bordi passano dai lotti.
+
+PULIZIA_LOTTO = int(os.getenv('PULIZIA_LOTTO', 5000))
+PULIZIA_PAUSA = float(os.getenv('PULIZIA_PAUSA', 0.05))
+# TRUNCATE aspetta che finiscano le transazioni in corso sulla tabella e nel
+# frattempo blocca tutte le altre: oltre questa attesa rinuncia con un errore
+PULIZIA_LOCK_TIMEOUT = os.getenv('PULIZIA_LOCK_TIMEOUT', '5s')
+
+# Gli id del lotto passano come array: l'eliminazione usa la chiave primaria
+# invece di un hash join sull'intera tabella
+ELIMINA_LOTTO = """
+    WITH lotto AS (
+        SELECT v.id FROM visite v{where} AND v.id > %s ORDER BY v.id LIMIT %s
+    ), eliminate AS (
+        DELETE FROM visite WHERE id = ANY(ARRAY(SELECT id FROM lotto)) RETURNING id
+    )
+    SELECT (SELECT count(*) FROM eliminate), (SELECT max(id) FROM lotto)
+"""
+
+def svuota(conn, tabelle):
+    with conn.cursor() as cur:
+        cur.execute("SELECT set_config('lock_timeout', %s, true)", (PULIZIA_LOCK_TIMEOUT,))
+        cur.execute(f"TRUNCATE {', '.join(tabelle)}")
+        elenchi = [tabella for tabella in tabelle if tabella in ('volontari', 'assistiti')]
+        if elenchi:
+            invalida_liste(cur, *elenchi)
+    conn.commit()
+
+# Elimina le visite del filtro (where, params di filtro_visite) e restituisce quante
+# sono state eliminate. Senza filtri svuota la tabella.
+def elimina_visite(conn, filtro, progresso=None, lotto=PULIZIA_LOTTO):
+    where, params = filtro
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM visite v" + where, params)
+        totale = cur.fetchone()[0]
+    conn.commit()
+    if progresso:
+        progresso(0, totale)
+    if not params:
+        svuota(conn, ['visite'])
+        if progresso:
+            progresso(totale, totale)
+        return totale
+
+    eliminate, ultimo = 0, 0
+    query = ELIMINA_LOTTO.format(where=where)
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(query, list(params) + [ultimo, lotto])
+            contate, massimo = cur.fetchone()
+        conn.commit()
+        if massimo is None:
+            break
+        eliminate += contate
+        ultimo = massimo
+        if progresso:
+            progresso(eliminate, totale)
+        time.sleep(PULIZIA_PAUSA)
+    return eliminate
+
+# Lavoro per jobs.avvia_lavoro: filtri None svuota visite, volontari e assistiti.
+# Il file prodotto è il riepilogo in JSON.
+def lavoro_pulizia(filtri, percorso, progresso):
+    inizio = time.monotonic()
+    conn = get_db_connection()
+    try:
+        if filtri is None:
+            svuota(conn, ['visite', 'volontari', 'assistiti'])
+            eliminate = None
+        else:
+            tolte = 0
+            if (filtri['data_inizio'] or filtri['data_fine']) and not filtri['volontario_email'] and partizionata(conn):
+                tolte = elimina_mesi(conn, filtri['data_inizio'], filtri['data_fine'])
+            filtro = filtro_visite(filtri['volontario_email'], filtri['data_inizio'], filtri['data_fine'])
+            eliminate = tolte + elimina_visite(conn, filtro, lambda fatti, totale: progresso(tolte + fatti, tolte + totale))
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+    durata = round(time.monotonic() - inizio, 2)
+    logging.info(f"Pulizia {filtri or 'completa'}: {eliminate if eliminate is not None else 'tutte le'} visite eliminate in {durata} s")
+    with open(percorso, 'w', encoding='utf-8') as f:
+        json.dump({'filtri': filtri, 'eliminate': eliminate, 'durata': durata}, f)
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    parser = argparse.ArgumentParser(description="Elimina visite a lotti o svuota il database")
+    parser.add_argument('--volontario-email', default='')
+    parser.add_argument('--data-inizio', default='', help="AAAA-MM-GG")
+    parser.add_argument('--data-fine', default='', help="AAAA-MM-GG, compresa")
+    parser.add_argument('--tutto', action='store_true', help="svuota visite, volontari e assistiti")
+    args = parser.parse_args()
+    for data in (args.data_inizio, args.data_fine):
+        if data:
+            datetime.strptime(data, '%Y-%m-%d')
+
+    conn = get_db_connection()
+    try:
+        if args.tutto:
+            svuota(conn, ['visite', 'volontari', 'assistiti'])
+            print("Visite, volontari e assistiti eliminati")
+        else:
+            data_fine = f"{args.data_fine} 23:59:59" if args.data_fine else ''
+            filtro = filtro_visite(args.volontario_email, args.data_inizio, data_fine)
+            eliminate = elimina_visite(conn, filtro, lambda fatti, totale: print(f"{fatti}/{totale} visite eliminate"))
+            print(f"Eliminate {eliminate} visite")
+    finally:
+        release_db_connection(conn)
+
+if __name__ == '__main__':
+    main()
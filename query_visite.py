@@ -0,0 +1,139 @@
+from collections import namedtuple
+from datetime import datetime
+from psycopg.rows import args_row
+from cache import CANALE_LISTE
+
+# Query delle visite con volontario e assistito: join, filtri e ordinamenti usati da
+# report, PDF, CSV, backup e pulizia sono definiti solo qui.
+
+# Una riga del report; essendo una namedtuple non ha __dict__ e resta indicizzabile
+Visita = namedtuple('Visita', [
+    'volontario_email', 'assistito_nome', 'accoglienza', 'data_visita', 'necessita', 'cosa_migliorare',
+    'cognome', 'nome', 'citta', 'id',
+])
+
+FROM_VISITE = """
+    FROM visite v
+    JOIN volontari vol ON v.volontario_email = vol.email
+    JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
+"""
+
+SELECT_VISITE = """
+    SELECT v.volontario_email, v.assistito_nome, v.accoglienza, v.data_visita, v.necessita, v.cosa_migliorare,
+           vol.cognome, vol.nome, ass.citta, v.id
+""" + FROM_VISITE
+
+# Colonne ordinabili: espressione SQL e campo corrispondente di Visita
+ORDINAMENTI = {
+    'data': ('v.data_visita', 'data_visita'),
+    'volontario': ('vol.cognome', 'cognome'),
+    'assistito': ('v.assistito_nome', 'assistito_nome'),
+    'citta': ('ass.citta', 'citta'),
+    'accoglienza': ('v.accoglienza', 'accoglienza'),
+}
+
+# Filtro comune alle query sulle visite (alias "v" per la tabella visite)
+def filtro_visite(volontario_email, data_inizio, data_fine):
+    where = " WHERE 1=1"
+    params = []
+    if volontario_email:
+        where += " AND v.volontario_email = %s"
+        params.append(volontario_email)
+    if data_inizio:
+        where += " AND v.data_visita >= %s"
+        params.append(data_inizio)
+    if data_fine:
+        where += " AND v.data_visita <= %s"
+        params.append(data_fine)
+    return where, params
+
+# Query e parametri per le visite filtrate, ordinate per (colonna, id).
+# cursore è la coppia (valore, id) dell'ultima riga già letta (paginazione a cursore).
+def query_visite(filtro, ordina='data', crescente=True, cursore=None, limite=None):
+    where, params = filtro
+    espressione = ORDINAMENTI[ordina][0]
+    query = SELECT_VISITE + where
+    params = list(params)
+    if cursore:
+        query += f" AND ({espressione}, v.id) {'>' if crescente else '<'} (%s, %s)"
+        params.extend(cursore)
+    ordine = 'ASC' if crescente else 'DESC'
+    query += f" ORDER BY {espressione} {ordine}, v.id {ordine}"
+    if limite is not None:
+        query += " LIMIT %s"
+        params.append(limite)
+    return query, params
+
+# Tutte le visite in una lista. La query è preparata sul server: le connessioni del
+# pool restano aperte, quindi le varianti usate spesso vengono pianificate una volta sola.
+def leggi_visite(conn, filtro, **opzioni):
+    query, params = query_visite(filtro, **opzioni)
+    with conn.cursor(row_factory=args_row(Visita)) as cur:
+        cur.execute(query, params, prepare=True)
+        return cur.fetchall()
+
+# Le visite una alla volta da un cursore lato server, letto a blocchi: la memoria
+# usata non dipende dal numero di righe. Va consumato dentro una transazione.
+def itera_visite(conn, filtro, blocco=2000, **opzioni):
+    query, params = query_visite(filtro, **opzioni)
+    with conn.cursor(name='itera_visite', row_factory=args_row(Visita)) as cur:
+        cur.itersize = blocco
+        cur.execute(query, params)
+        yield from cur
+
+# Inserimento di una visita dal modulo in un'unica istruzione: il volontario viene
+# creato se manca (e se il modulo ne riporta cognome e nome), poi la visita.
+# Con ON CONFLICT due primi invii contemporanei per la stessa email non falliscono:
+# il secondo aspetta il commit del primo e ne usa la riga. Se il volontario non
+# esiste e non è stato creato, la chiave esterna VOLONTARIO_MANCANTE rifiuta la visita.
+# La notifica di cache.py parte solo quando il volontario è nuovo.
+INSERISCI_VISITA = """
+    WITH nuovo AS (
+        INSERT INTO volontari (email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione)
+        SELECT %(volontario_email)s, %(volontario_cognome)s, %(volontario_nome)s,
+               %(telefono)s, %(competenze)s, %(disponibilita)s, now()
+        WHERE coalesce(%(volontario_cognome)s, '') <> '' AND coalesce(%(volontario_nome)s, '') <> ''
+        ON CONFLICT (email) DO NOTHING
+        RETURNING email
+    ), avviso AS (
+        SELECT pg_notify(%(canale)s, 'volontari') FROM nuovo
+    )
+    INSERT INTO visite (volontario_email, assistito_nome, accoglienza, data_visita, necessita, cosa_migliorare)
+    VALUES (%(volontario_email)s, %(assistito_nome)s, %(accoglienza)s, %(data_visita)s, %(necessita)s, %(cosa_migliorare)s)
+    RETURNING id, (SELECT count(*) FROM avviso) > 0 AS volontario_nuovo
+"""
+
+VOLONTARIO_MANCANTE = 'visite_volontario_email_fkey'
+
+# Visite di un assistito, controllate prima di eliminarlo
+CONTA_VISITE_ASSISTITO = "SELECT COUNT(*) FROM visite WHERE assistito_nome = %s"
+
+CAMPI_MODULO_VISITA = [
+    'volontario_email', 'volontario_cognome', 'volontario_nome', 'telefono', 'competenze', 'disponibilita',
+    'assistito_nome', 'accoglienza', 'data_visita', 'necessita', 'cosa_migliorare',
+]
+
+# Parametri di INSERISCI_VISITA dai campi del modulo (request.form o un dizionario)
+def parametri_visita(modulo):
+    parametri = {campo: modulo.get(campo) for campo in CAMPI_MODULO_VISITA}
+    parametri['canale'] = CANALE_LISTE
+    return parametri
+
+# Controlli del modulo delle visite, comuni alla route Flask e ad asgi.py:
+# restituisce il messaggio di errore, None se la visita si può inserire
+def errore_modulo_visita(modulo):
+    if (not modulo.get('volontario_email') or not modulo.get('assistito_nome')
+            or not modulo.get('accoglienza') or not modulo.get('data_visita')):
+        return "Email, assistito, accoglienza e data visita sono obbligatori."
+    # data_visita è di tipo DATE: una data malformata farebbe fallire l'inserimento
+    try:
+        datetime.strptime(modulo['data_visita'], '%Y-%m-%d')
+    except ValueError:
+        return "Data visita non valida."
+    return None
+
+# Messaggio per una visita rifiutata dalle chiavi esterne
+def messaggio_chiave_mancante(e):
+    if e.diag.constraint_name == VOLONTARIO_MANCANTE:
+        return "Cognome e nome sono obbligatori per un nuovo volontario."
+    return "Assistito non trovato."
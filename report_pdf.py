@@ -0,0 +1,184 @@
+from datetime import datetime
+from functools import lru_cache
+from reportlab import rl_config
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.utils import simpleSplit
+from reportlab.pdfgen import canvas
+from db import get_db_connection, release_db_connection
+from query_visite import filtro_visite, itera_visite
+from statistiche import statistiche_giornaliere
+
+# Generazione del PDF del report, eseguita come lavoro in background (vedi jobs.py).
+#
+# Le visite sono impaginate in tabella, una riga per visita. Il testo viene spezzato
+# e misurato prima di disegnare la riga, così l'altezza è nota in anticipo e il
+# testo di ogni pagina è un solo blocco: niente Table di platypus, che su decine di
+# migliaia di righe spende la maggior parte del tempo a calcolare stili e celle.
+#
+# Le visite arrivano in streaming dal database, ma reportlab tiene in memoria il
+# contenuto di tutte le pagine finite e scrive il file solo in save(): la memoria
+# cresce con il report, circa 0,7 KB per visita (vedi benchmark_pdf.py).
+
+# Flussi delle pagine compressi senza la codifica ASCII85, che li allunga di un
+# quarto e senza l'estensione C di reportlab è la parte più lenta del salvataggio.
+# report_pdf è l'unico uso di reportlab nell'app.
+rl_config.useA85 = 0
+
+PAGINA = landscape(A4)
+MARGINE = 28
+FONT = 'Helvetica'
+FONT_GRASSETTO = 'Helvetica-Bold'
+CORPO = 7.5
+INTERLINEA = 9
+PADDING = 3
+SFONDO_ALTERNATO = colors.HexColor('#f4f6f8')
+PROGRESSO_OGNI = 500
+
+# Titolo e larghezza (in punti) di ogni colonna; la somma è la larghezza utile della pagina
+COLONNE = [
+    ('Data', 62),
+    ('Volontario', 150),
+    ('Assistito', 90),
+    ('Città', 80),
+    ('Accoglienza', 56),
+    ('Necessità', 174),
+    ('Miglioramenti', 174),
+]
+
+# Nomi, assistiti e città si ripetono molto: la misura del testo viene riusata
+@lru_cache(maxsize=4096)
+def a_capo(testo, larghezza):
+    return simpleSplit(testo, FONT, CORPO, larghezza - 2 * PADDING) or ['']
+
+def celle_visita(visita):
+    valori = (
+        str(visita.data_visita)[:16],
+        f"{visita.nome} {visita.cognome} ({visita.volontario_email})",
+        visita.assistito_nome,
+        visita.citta or '',
+        visita.accoglienza or '',
+        visita.necessita or 'Nessuna',
+        visita.cosa_migliorare or 'Nessuno',
+    )
+    return [a_capo(valore, larghezza) for valore, (_, larghezza) in zip(valori, COLONNE)]
+
+def descrivi_filtri(filtri):
+    parti = []
+    if filtri.get('volontario_email'):
+        parti.append(f"volontario {filtri['volontario_email']}")
+    if filtri.get('data_inizio'):
+        parti.append(f"dal {filtri['data_inizio']}")
+    if filtri.get('data_fine'):
+        parti.append(f"al {filtri['data_fine'][:10]}")
+    return ', '.join(parti) or 'tutte le visite'
+
+class ReportPdf:
+    def __init__(self, filename, sottotitolo):
+        self.pdf = canvas.Canvas(filename, pagesize=PAGINA)
+        self.pdf.setTitle("Report Visite")
+        self.pdf.setAuthor("Scheda Volontari")
+        self.sottotitolo = sottotitolo
+        self.pagina = 0
+        self.y = 0
+        self.testo = None
+
+    # Il testo delle righe di una pagina è un unico oggetto, scritto dopo gli sfondi
+    def chiudi_pagina(self):
+        if self.testo:
+            self.pdf.drawText(self.testo)
+            self.testo = None
+
+    def nuova_pagina(self):
+        if self.pagina:
+            self.chiudi_pagina()
+            self.pdf.showPage()
+        self.pagina += 1
+        larghezza, altezza = PAGINA
+        self.pdf.setFont(FONT_GRASSETTO, 12)
+        self.pdf.drawString(MARGINE, altezza - MARGINE, "Report Visite")
+        self.pdf.setFont(FONT, 8)
+        self.pdf.drawString(MARGINE, altezza - MARGINE - 12, self.sottotitolo)
+        self.pdf.drawRightString(larghezza - MARGINE, altezza - MARGINE, f"Pagina {self.pagina}")
+        self.y = altezza - MARGINE - 30
+
+    def intestazione_colonne(self):
+        self.pdf.setFont(FONT_GRASSETTO, CORPO)
+        x = MARGINE
+        for nome, larghezza in COLONNE:
+            self.pdf.drawString(x + PADDING, self.y, nome)
+            x += larghezza
+        self.pdf.setLineWidth(0.5)
+        self.pdf.line(MARGINE, self.y - 3, PAGINA[0] - MARGINE, self.y - 3)
+        self.y -= 3 + INTERLINEA
+
+    # Riepilogo in testa al report: totale, accoglienza e visite per città su più colonne
+    def statistiche(self, statistiche):
+        voci = [("Totale visite", statistiche['totale_visite'])]
+        voci += [(f"Accoglienza {accoglienza}", totale) for accoglienza, totale in statistiche['accoglienza'].items()]
+        per_citta = sorted(statistiche['visite_per_citta'].items(), key=lambda c: (-c[1], c[0] or ''))
+        voci += [(f"Visite a {citta}", totale) for citta, totale in per_citta]
+        righe_per_colonna = 8
+        alto = self.y
+        for i, (etichetta, totale) in enumerate(voci):
+            colonna, riga = divmod(i, righe_per_colonna)
+            if colonna and riga == 0 and MARGINE + (colonna + 1) * 200 > PAGINA[0] - MARGINE:
+                break
+            x = MARGINE + colonna * 200
+            y = alto - riga * (INTERLINEA + 2)
+            self.pdf.setFont(FONT_GRASSETTO if i == 0 else FONT, CORPO + 1)
+            self.pdf.drawString(x, y, str(etichetta)[:38])
+            self.pdf.drawRightString(x + 180, y, str(totale))
+        self.y = alto - min(len(voci), righe_per_colonna) * (INTERLINEA + 2) - 12
+
+    def riga(self, celle, indice):
+        altezza = max(len(linee) for linee in celle) * INTERLINEA + 4
+        if self.y - altezza < MARGINE:
+            self.nuova_pagina()
+            self.intestazione_colonne()
+        if indice % 2:
+            self.pdf.setFillColor(SFONDO_ALTERNATO)
+            self.pdf.rect(MARGINE, self.y - altezza + INTERLINEA, PAGINA[0] - 2 * MARGINE, altezza, stroke=0, fill=1)
+            self.pdf.setFillColor(colors.black)
+        if self.testo is None:
+            self.testo = self.pdf.beginText()
+            self.testo.setFont(FONT, CORPO, INTERLINEA)
+        x = MARGINE
+        for linee, (_, larghezza) in zip(celle, COLONNE):
+            self.testo.setTextOrigin(x + PADDING, self.y - 2)
+            self.testo.textLines(linee, trim=0)
+            x += larghezza
+        self.y -= altezza
+
+    def salva(self):
+        self.chiudi_pagina()
+        self.pdf.save()
+
+# Scrive il PDF in filename; visite può essere un iteratore, progresso(fatti)
+# viene chiamato man mano
+def disegna_pdf(visite, statistiche, filename, progresso, filtri=None):
+    generato = datetime.now().strftime('%d/%m/%Y %H:%M')
+    report = ReportPdf(filename, f"{descrivi_filtri(filtri or {})} - generato il {generato}")
+    report.nuova_pagina()
+    report.statistiche(statistiche)
+    report.intestazione_colonne()
+    for i, visita in enumerate(visite, 1):
+        report.riga(celle_visita(visita), i)
+        if i % PROGRESSO_OGNI == 0:
+            progresso(i)
+    report.salva()
+
+# Funzione del lavoro: scrive in filename il PDF delle visite filtrate, lette in
+# streaming. Statistiche e righe vengono dallo stesso snapshot.
+def genera_report_pdf(filtri, filename, progresso):
+    filtro = filtro_visite(filtri['volontario_email'], filtri['data_inizio'], filtri['data_fine'])
+    conn = get_db_connection()
+    try:
+        conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        with conn.cursor() as cur:
+            statistiche = statistiche_giornaliere(cur, filtri['volontario_email'], filtri['data_inizio'], filtri['data_fine'])
+        progresso(0, statistiche['totale_visite'])
+        disegna_pdf(itera_visite(conn, filtro, ordina='data'), statistiche, filename, progresso, filtri)
+    finally:
+        release_db_connection(conn)
+    progresso(statistiche['totale_visite'])
@@ -0,0 +1,154 @@
+import os
+import bisect
+import logging
+import threading
+import psycopg
+from db import get_db_connection, release_db_connection
+from cache import lista
+
+# Ricerca di volontari e assistiti per i campi con suggerimenti (/api/cerca).
+#
+# I moduli non contengono più gli elenchi completi: mentre si scrive il browser
+# chiede a /api/cerca le prime RICERCA_LIMITE voci, quindi peso e tempo di
+# rendering delle pagine non crescono con il numero di volontari e assistiti.
+#
+# Con l'estensione pg_trgm (migrazione 9) la ricerca è nel database: ogni parola
+# cercata può comparire in qualunque punto di cognome, nome ed email (o della sigla
+# dell'assistito) e gli indici GIN a trigrammi evitano la scansione delle tabelle.
+# Le parole più corte di un trigramma non possono usare l'indice GIN: si cercano
+# solo come inizio di cognome, nome o email (o della sigla), con gli indici per
+# prefisso della migrazione 13, anche senza pg_trgm.
+# Se pg_trgm non è installabile, o il database non risponde, si cerca per prefisso
+# di parola in un indice in memoria costruito sugli elenchi di cache.py, che le
+# modifiche a volontari e assistiti invalidano già in tutti i worker.
+
+RICERCA_LIMITE = int(os.getenv('RICERCA_LIMITE', 20))
+LUNGHEZZA_TRIGRAMMA = 3
+
+# Colonne restituite, espressione dell'indice a trigrammi e colonne dei prefissi
+RICERCHE = {
+    'volontari': {
+        'query': "SELECT email, cognome, nome FROM volontari",
+        'testo': "lower(cognome || ' ' || nome || ' ' || email)",
+        'prefissi': ['lower(cognome)', 'lower(nome)', 'lower(email)'],
+        'ordine': "cognome, nome",
+        'indice': 'volontari_ricerca_idx',
+    },
+    'assistiti': {
+        'query': "SELECT nome_sigla, citta FROM assistiti",
+        'testo': "lower(nome_sigla)",
+        'prefissi': ['lower(nome_sigla)'],
+        'ordine': "nome_sigla",
+        'indice': 'assistiti_ricerca_idx',
+    },
+}
+
+_trigrammi = None
+_indici = {}
+_lock = threading.Lock()
+
+def voce(tipo, riga):
+    if tipo == 'volontari':
+        return {'valore': riga[0], 'etichetta': f"{riga[2]} {riga[1]}"}
+    return {'valore': riga[0], 'etichetta': f"{riga[0]} ({riga[1]})"}
+
+def motivo_like(parola):
+    return parola.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# Gli indici a trigrammi esistono solo se la migrazione 9 ha potuto installare pg_trgm
+def trigrammi_disponibili(cur):
+    global _trigrammi
+    if _trigrammi is None:
+        cur.execute("SELECT bool_and(to_regclass(nome) IS NOT NULL) FROM unnest(%s::text[]) AS nome",
+                    ([ricerca['indice'] for ricerca in RICERCHE.values()],))
+        _trigrammi = cur.fetchone()[0]
+        if not _trigrammi:
+            logging.info("Indici a trigrammi assenti: la ricerca usa l'indice in memoria")
+    return _trigrammi
+
+def brevi(parole):
+    return all(len(parola) < LUNGHEZZA_TRIGRAMMA for parola in parole)
+
+# Ogni parola deve comparire nel testo, le parole brevi all'inizio di un campo.
+# Con almeno una parola lunga prima le voci in cui la prima parola è l'inizio di
+# un campo, poi le più simili; con sole parole brevi tutte le voci trovate
+# iniziano così e restano nell'ordine degli elenchi, senza calcolare similarity().
+def cerca_nel_database(cur, tipo, parole, limite):
+    ricerca = RICERCHE[tipo]
+    inizia = ' OR '.join(f"{colonna} LIKE %s" for colonna in ricerca['prefissi'])
+    condizioni = []
+    params = []
+    for parola in parole:
+        if len(parola) < LUNGHEZZA_TRIGRAMMA:
+            condizioni.append(f"({inizia})")
+            params += [f"{motivo_like(parola)}%"] * len(ricerca['prefissi'])
+        else:
+            condizioni.append(f"{ricerca['testo']} LIKE %s")
+            params.append(f"%{motivo_like(parola)}%")
+    ordine = ricerca['ordine']
+    if not brevi(parole):
+        ordine = f"({inizia}) DESC, similarity({ricerca['testo']}, %s) DESC, {ordine}"
+        params += [f"{motivo_like(parole[0])}%"] * len(ricerca['prefissi']) + [' '.join(parole)]
+    cur.execute(f"{ricerca['query']} WHERE {' AND '.join(condizioni) or 'TRUE'} ORDER BY {ordine} LIMIT %s", params + [limite])
+    return cur.fetchall()
+
+def parole_riga(tipo, riga):
+    parole = set()
+    for campo in (riga[:3] if tipo == 'volontari' else riga[:1]):
+        testo = (campo or '').lower()
+        parole.add(testo)
+        parole.update(testo.split())
+    return parole
+
+# Coppie (parola, posizione nell'elenco) ordinate, ricostruite quando cache.py
+# restituisce un elenco nuovo
+def indice_prefissi(tipo):
+    righe = lista(tipo)
+    with _lock:
+        voce_indice = _indici.get(tipo)
+        if voce_indice and voce_indice[0] is righe:
+            return righe, voce_indice[1]
+    indice = sorted((parola, i) for i, riga in enumerate(righe) for parola in parole_riga(tipo, riga))
+    with _lock:
+        _indici[tipo] = (righe, indice)
+    return righe, indice
+
+# La prima parola si cerca nell'indice, le altre devono essere l'inizio di una
+# parola della stessa voce. I risultati restano nell'ordine degli elenchi.
+def cerca_in_memoria(tipo, parole, limite):
+    righe, indice = indice_prefissi(tipo)
+    if not parole:
+        return list(righe[:limite])
+    trovate = set()
+    for posizione in range(bisect.bisect_left(indice, (parole[0],)), len(indice)):
+        parola, i = indice[posizione]
+        if not parola.startswith(parole[0]):
+            break
+        trovate.add(i)
+    risultati = []
+    for i in sorted(trovate):
+        parole_voce = parole_riga(tipo, righe[i])
+        if all(any(p.startswith(cercata) for p in parole_voce) for cercata in parole[1:]):
+            risultati.append(righe[i])
+            if len(risultati) == limite:
+                break
+    return risultati
+
+def cerca(tipo, testo, limite=RICERCA_LIMITE):
+    parole = testo.lower().split()
+    if _trigrammi is not False or brevi(parole):
+        conn = None
+        cur = None
+        try:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            if brevi(parole) or trigrammi_disponibili(cur):
+                return [voce(tipo, riga) for riga in cerca_nel_database(cur, tipo, parole, limite)]
+        except psycopg.OperationalError as e:
+            logging.warning(f"Ricerca nel database non riuscita, uso l'indice in memoria: {e}")
+        finally:
+            if cur:
+                cur.close()
+            if conn:
+                release_db_connection(conn)
+    return [voce(tipo, riga) for riga in cerca_in_memoria(tipo, parole, limite)]
@@ -0,0 +1,87 @@
+import os
+import csv
+import logging
+import itertools
+from operator import itemgetter
+from cache import invalida_liste
+
+# Ripristino di un backup a sezioni: il file viene letto in streaming, ogni
+# sezione finisce con COPY FROM STDIN in una tabella temporanea e solo alla
+# fine le tabelle reali vengono sostituite, in un'unica transazione breve.
+
+PROGRESSO_OGNI = 10000
+
+# Tabella temporanea, colonne della tabella reale e righe minime attese nel CSV
+SEZIONI = {
+    '--- Assistiti ---': ('ripristino_assistiti', 'assistiti', ['nome_sigla', 'citta'], 2),
+    '--- Volontari ---': ('ripristino_volontari', 'volontari', ['email', 'cognome', 'nome', 'telefono', 'competenze', 'disponibilita', 'data_iscrizione'], 7),
+    '--- Visite ---': ('ripristino_visite', 'visite', ['volontario_email', 'assistito_nome', 'accoglienza', 'data_visita', 'necessita', 'cosa_migliorare'], 9),
+}
+INTESTAZIONI = {'Volontario Email', 'Email', 'Nome Sigla'}
+
+def valori_riga(sezione, row):
+    if sezione == '--- Visite ---':
+        return (row[0], row[3], row[5], row[6], row[7] or None, row[8] or None)
+    if sezione == '--- Volontari ---':
+        return (row[0], row[1], row[2], row[3] or None, row[4] or None, row[5] or None, row[6] or None)
+    return (row[0], row[1])
+
+def crea_tabelle_temporanee(cur):
+    for temporanea, tabella, colonne, _ in SEZIONI.values():
+        cur.execute(f"CREATE TEMP TABLE {temporanea} ON COMMIT DROP AS SELECT {', '.join(colonne)} FROM {tabella} WITH NO DATA")
+
+# Righe valide del file, etichettate con la sezione a cui appartengono
+def righe_backup(f):
+    sezione = None
+    for row in csv.reader(f):
+        if not row or not any(row):
+            continue
+        if row[0].startswith('---'):
+            sezione = row[0] if row[0] in SEZIONI else None
+            continue
+        if not sezione or row[0] in INTESTAZIONI or len(row) < SEZIONI[sezione][3]:
+            continue
+        yield sezione, valori_riga(sezione, row)
+
+def carica_sezioni(cur, file_path, progresso):
+    conteggi = {}
+    with open(file_path, 'r', encoding='utf-8-sig', newline='') as f:
+        for sezione, righe in itertools.groupby(righe_backup(f), key=itemgetter(0)):
+            temporanea, _, colonne, _ = SEZIONI[sezione]
+            caricate = conteggi.get(sezione, 0)
+            with cur.copy(f"COPY {temporanea} ({', '.join(colonne)}) FROM STDIN") as copy:
+                for _, valori in righe:
+                    copy.write_row(valori)
+                    caricate += 1
+                    if caricate % PROGRESSO_OGNI == 0:
+                        progresso(sezione, caricate)
+            conteggi[sezione] = caricate
+    return conteggi
+
+def sostituisci_tabelle(cur):
+    cur.execute("TRUNCATE visite, volontari, assistiti")
+    for temporanea, tabella, colonne, _ in SEZIONI.values():
+        elenco = ', '.join(colonne)
+        cur.execute(f"INSERT INTO {tabella} ({elenco}) SELECT {elenco} FROM {temporanea}")
+
+def registra_progresso(sezione, righe):
+    logging.info(f"Ripristino {sezione.strip('- ')}: {righe} righe caricate")
+
+# Ripristina il file di backup e restituisce il numero di righe per sezione.
+# In caso di errore la transazione viene annullata e i dati attuali restano intatti.
+def ripristina_backup(conn, file_path, progresso=registra_progresso):
+    with conn.cursor() as cur:
+        try:
+            if os.path.getsize(file_path) == 0:
+                raise ValueError("Il file CSV è vuoto.")
+            crea_tabelle_temporanee(cur)
+            conteggi = carica_sezioni(cur, file_path, progresso)
+            for sezione, righe in conteggi.items():
+                progresso(sezione, righe)
+            sostituisci_tabelle(cur)
+            invalida_liste(cur, 'volontari', 'assistiti')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return conteggi
@@ -0,0 +1,81 @@
+import os
+import random
+import argparse
+from datetime import date, datetime, timedelta
+import psycopg
+from dotenv import load_dotenv
+from migrazioni import applica_migrazioni
+
+# Popola un database PostgreSQL di prova con volontari, assistiti e visite casuali.
+# Non usare sul database di produzione: con --reset svuota tutte le tabelle.
+
+CITTA = ['Milano', 'Torino', 'Roma', 'Napoli', 'Bologna', 'Firenze', 'Genova', 'Bari', 'Palermo', 'Verona']
+COGNOMI = ['Rossi', 'Bianchi', 'Romano', 'Colombo', 'Ricci', 'Marino', 'Greco', 'Bruno', 'Gallo', 'Conti']
+NOMI = ['Mario', 'Giulia', 'Luca', 'Francesca', 'Marco', 'Sara', 'Paolo', 'Anna', 'Andrea', 'Chiara']
+ACCOGLIENZA = ['Buona', 'Buona', 'Buona', 'Media', 'Media', 'Scarsa']
+NECESSITA = ['Supporto logistico', 'Compagnia', 'Aiuto con la spesa', 'Supporto psicologico', '']
+MIGLIORAMENTI = ['Migliorare comunicazione', 'Tempi di risposta', 'Niente', '']
+
+def crea_schema(conn):
+    applica_migrazioni(conn)
+
+def svuota(conn):
+    conn.execute("TRUNCATE visite, volontari, assistiti RESTART IDENTITY")
+    conn.commit()
+
+# Oltre le dieci città con nome se ne aggiungono di numerate
+def elenco_citta(n_citta):
+    return (CITTA + [f"Città {i}" for i in range(len(CITTA) + 1, n_citta + 1)])[:n_citta]
+
+# A parità di seme e di fino_al i dati generati sono sempre gli stessi
+def popola(conn, n_volontari=2000, n_assistiti=500, n_visite=300000, anni=3, seme=42, n_citta=len(CITTA), fino_al=None):
+    rnd = random.Random(seme)
+    oggi = fino_al or date.today()
+    giorni = anni * 365
+    citta = elenco_citta(n_citta)
+    iscrizione = datetime.now().astimezone()
+
+    email = [f"volontario{i}@example.com" for i in range(n_volontari)]
+    sigle = [f"ASS{i:05d}" for i in range(n_assistiti)]
+
+    with conn.cursor() as cur:
+        with cur.copy("COPY volontari (email, cognome, nome, telefono, competenze, disponibilita, data_iscrizione) FROM STDIN") as copy:
+            for i, e in enumerate(email):
+                copy.write_row((e, rnd.choice(COGNOMI), rnd.choice(NOMI), f"333{i:07d}", None, None, iscrizione))
+        with cur.copy("COPY assistiti (nome_sigla, citta) FROM STDIN") as copy:
+            for s in sigle:
+                copy.write_row((s, rnd.choice(citta)))
+        with cur.copy("COPY visite (volontario_email, assistito_nome, accoglienza, data_visita, necessita, cosa_migliorare) FROM STDIN") as copy:
+            for _ in range(n_visite):
+                data_visita = oggi - timedelta(days=rnd.randrange(giorni))
+                copy.write_row((rnd.choice(email), rnd.choice(sigle), rnd.choice(ACCOGLIENZA),
+                                data_visita.isoformat(), rnd.choice(NECESSITA), rnd.choice(MIGLIORAMENTI)))
+    conn.commit()
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Popola un database di prova")
+    parser.add_argument('--database-url', default=os.getenv('SEED_DATABASE_URL'))
+    parser.add_argument('--volontari', type=int, default=2000)
+    parser.add_argument('--assistiti', type=int, default=500)
+    parser.add_argument('--visite', type=int, default=300000)
+    parser.add_argument('--anni', type=int, default=3)
+    parser.add_argument('--seme', type=int, default=42)
+    parser.add_argument('--citta', type=int, default=len(CITTA))
+    parser.add_argument('--fino-al', type=date.fromisoformat, default=None,
+                        help="data dell'ultima visita possibile (AAAA-MM-GG, predefinita oggi)")
+    parser.add_argument('--reset', action='store_true', help="svuota le tabelle prima di popolarle")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("specificare --database-url o SEED_DATABASE_URL")
+
+    with psycopg.connect(args.database_url) as conn:
+        crea_schema(conn)
+        if args.reset:
+            svuota(conn)
+        popola(conn, args.volontari, args.assistiti, args.visite, args.anni, args.seme, args.citta, args.fino_al)
+        conn.execute("ANALYZE")
+    print(f"Inseriti {args.volontari} volontari, {args.assistiti} assistiti, {args.visite} visite")
+
+if __name__ == '__main__':
+    main()
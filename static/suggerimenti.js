@@ -0,0 +1,47 @@
+// Suggerimenti per i campi volontario e assistito: mentre si scrive chiede a
+// /api/cerca le voci corrispondenti e le mette nella datalist del campo, così le
+// pagine non contengono gli elenchi completi. Le risposte arrivate dopo una
+// richiesta più recente vengono ignorate. dopoRisultati, se c'è, riceve il testo
+// cercato e i risultati (null se la ricerca non è riuscita).
+function collegaSuggerimenti(campo, tipo, url, dopoRisultati) {
+    const elenco = document.getElementById(campo.getAttribute('list'));
+    let attesa = null;
+    let ultima = 0;
+
+    function chiedi() {
+        const richiesta = ++ultima;
+        const testo = campo.value.trim();
+        fetch(`${url}?tipo=${tipo}&q=${encodeURIComponent(testo)}`)
+            .then(risposta => {
+                if (!risposta.ok) {
+                    throw new Error(risposta.status);
+                }
+                return risposta.json();
+            })
+            .then(dati => {
+                if (richiesta !== ultima) {
+                    return;
+                }
+                elenco.replaceChildren(...dati.risultati.map(voce => {
+                    const opzione = document.createElement('option');
+                    opzione.value = voce.valore;
+                    opzione.textContent = voce.etichetta;
+                    return opzione;
+                }));
+                if (dopoRisultati) {
+                    dopoRisultati(testo, dati.risultati);
+                }
+            })
+            .catch(() => {
+                if (richiesta === ultima && dopoRisultati) {
+                    dopoRisultati(testo, null);
+                }
+            });
+    }
+
+    campo.addEventListener('input', () => {
+        clearTimeout(attesa);
+        attesa = setTimeout(chiedi, 150);
+    });
+    campo.addEventListener('focus', chiedi, {once: true});
+}
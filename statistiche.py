@@ -0,0 +1,170 @@
+import os
+import sys
+import argparse
+from collections import Counter
+import psycopg
+from dotenv import load_dotenv
+
+def statistiche_vuote():
+    return {'totale_visite': 0, 'accoglienza': {'Buona': 0, 'Media': 0, 'Scarsa': 0}, 'visite_per_citta': {}}
+
+# Totale, accoglienza e città in un'unica scansione grazie ai GROUPING SETS
+def calcola_statistiche(cur, where, params):
+    cur.execute("""
+        SELECT v.accoglienza, ass.citta, COUNT(*), GROUPING(v.accoglienza), GROUPING(ass.citta)
+        FROM visite v
+        JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
+    """ + where + """
+        GROUP BY GROUPING SETS ((), (v.accoglienza), (ass.citta))
+    """, params)
+    return statistiche_da_gruppi(cur.fetchall())
+
+def statistiche_da_gruppi(gruppi):
+    statistiche = statistiche_vuote()
+    for accoglienza, citta, totale, senza_accoglienza, senza_citta in gruppi:
+        if senza_accoglienza and senza_citta:
+            statistiche['totale_visite'] = totale or 0
+        elif senza_citta:
+            statistiche['accoglienza'][accoglienza] = totale
+        else:
+            statistiche['visite_per_citta'][citta] = totale
+    return statistiche
+
+# Filtro di query_visite.filtro_visite applicato a statistiche_giornaliere (alias "s")
+def filtro_statistiche(volontario_email, data_inizio, data_fine):
+    where = " WHERE 1=1"
+    params = []
+    if volontario_email:
+        where += " AND s.volontario_email = %s"
+        params.append(volontario_email)
+    if data_inizio:
+        where += " AND s.giorno >= %s"
+        params.append(data_inizio)
+    if data_fine:
+        where += " AND s.giorno <= %s"
+        params.append(data_fine)
+    return where, params
+
+# Stesse statistiche di calcola_statistiche sommando i conteggi giornalieri
+# (tabella aggiornata dai trigger della migrazione 4) invece di leggere le visite
+def statistiche_giornaliere(cur, volontario_email, data_inizio, data_fine):
+    where, params = filtro_statistiche(volontario_email, data_inizio, data_fine)
+    cur.execute("""
+        SELECT s.accoglienza, s.citta, SUM(s.visite), GROUPING(s.accoglienza), GROUPING(s.citta)
+        FROM statistiche_giornaliere s
+    """ + where + """
+        GROUP BY GROUPING SETS ((), (s.accoglienza), (s.citta))
+    """, params)
+    return statistiche_da_gruppi(cur.fetchall())
+
+# Stesse statistiche ricavate dalle righe del report (Visita di query_visite)
+def statistiche_da_righe(visite):
+    statistiche = statistiche_vuote()
+    statistiche['totale_visite'] = len(visite)
+    statistiche['accoglienza'].update(Counter(visita.accoglienza for visita in visite))
+    statistiche['visite_per_citta'] = dict(Counter(visita.citta for visita in visite))
+    return statistiche
+
+QUERY_CONTEGGI_VISITE = """
+    SELECT v.data_visita, v.volontario_email, a.citta, v.accoglienza, COUNT(*)
+    FROM visite v JOIN assistiti a ON a.nome_sigla = v.assistito_nome
+    GROUP BY 1, 2, 3, 4
+"""
+
+# Ricalcola da zero la tabella statistiche_giornaliere. Il lock blocca le scritture
+# sulle visite fino al commit, così nessun trigger lavora su una tabella a metà.
+def ricostruisci_statistiche(conn):
+    with conn.cursor() as cur:
+        cur.execute("LOCK TABLE visite, assistiti IN SHARE MODE")
+        cur.execute("DELETE FROM statistiche_giornaliere")
+        cur.execute("INSERT INTO statistiche_giornaliere (giorno, volontario_email, citta, accoglienza, visite)" + QUERY_CONTEGGI_VISITE)
+        righe = cur.rowcount
+    conn.commit()
+    return righe
+
+# Confronta statistiche_giornaliere con i conteggi calcolati dalle visite e
+# restituisce le chiavi che differiscono con i due valori
+def verifica_statistiche(conn):
+    with conn.cursor() as cur:
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cur.execute("""
+            SELECT giorno, volontario_email, citta, accoglienza, COALESCE(r.visite, 0), COALESCE(s.visite, 0)
+            FROM (""" + QUERY_CONTEGGI_VISITE + """) AS r (giorno, volontario_email, citta, accoglienza, visite)
+            FULL JOIN statistiche_giornaliere s USING (giorno, volontario_email, citta, accoglienza)
+            WHERE r.visite IS DISTINCT FROM s.visite
+            ORDER BY giorno, volontario_email, citta, accoglienza
+        """)
+        differenze = cur.fetchall()
+    conn.rollback()
+    return differenze
+
+QUERY_RIEPILOGO_VOLONTARI = """
+    SELECT volontario_email, COUNT(*), COUNT(DISTINCT assistito_nome), MAX(data_visita),
+           (SELECT jsonb_object_agg(c.accoglienza, c.visite)
+            FROM (SELECT accoglienza, COUNT(*) AS visite FROM visite
+                  WHERE volontario_email = v.volontario_email GROUP BY 1) c)
+    FROM visite v
+    GROUP BY volontario_email
+"""
+
+# Ricalcola da zero il riepilogo dei volontari (migrazione 8), con lo stesso lock
+# di ricostruisci_statistiche
+def ricostruisci_riepilogo(conn):
+    with conn.cursor() as cur:
+        cur.execute("LOCK TABLE visite IN SHARE MODE")
+        cur.execute("DELETE FROM riepilogo_volontari_assistiti")
+        cur.execute("DELETE FROM riepilogo_volontari")
+        cur.execute("""
+            INSERT INTO riepilogo_volontari_assistiti (volontario_email, assistito_nome, accoglienza, visite)
+            SELECT volontario_email, assistito_nome, accoglienza, COUNT(*) FROM visite GROUP BY 1, 2, 3
+        """)
+        cur.execute("INSERT INTO riepilogo_volontari (volontario_email, visite, assistiti, ultima_visita, accoglienza)" + QUERY_RIEPILOGO_VOLONTARI)
+        righe = cur.rowcount
+    conn.commit()
+    return righe
+
+# Volontari il cui riepilogo differisce da quello calcolato dalle visite, con i due valori
+def verifica_riepilogo(conn):
+    with conn.cursor() as cur:
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cur.execute("""
+            SELECT volontario_email, (r.visite, r.assistiti, r.ultima_visita, r.accoglienza)::text,
+                   (s.visite, s.assistiti, s.ultima_visita, s.accoglienza)::text
+            FROM (""" + QUERY_RIEPILOGO_VOLONTARI + """) AS r (volontario_email, visite, assistiti, ultima_visita, accoglienza)
+            FULL JOIN riepilogo_volontari s USING (volontario_email)
+            WHERE (r.visite, r.assistiti, r.ultima_visita, r.accoglienza) IS DISTINCT FROM (s.visite, s.assistiti, s.ultima_visita, s.accoglienza)
+            ORDER BY volontario_email
+        """)
+        differenze = cur.fetchall()
+    conn.rollback()
+    return differenze
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Statistiche giornaliere e riepilogo dei volontari precalcolati")
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'))
+    comandi = parser.add_subparsers(dest='comando', required=True)
+    comandi.add_parser('ricostruisci', help="ricalcola le tabelle dalle visite")
+    comandi.add_parser('verifica', help="confronta le tabelle con le visite")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("specificare --database-url o DATABASE_URL")
+
+    with psycopg.connect(args.database_url) as conn:
+        if args.comando == 'ricostruisci':
+            print(f"Statistiche ricostruite: {ricostruisci_statistiche(conn)} righe")
+            print(f"Riepilogo dei volontari ricostruito: {ricostruisci_riepilogo(conn)} volontari")
+        else:
+            differenze = verifica_statistiche(conn)
+            for giorno, email, citta, accoglienza, visite, registrate in differenze[:50]:
+                print(f"{giorno} {email} {citta} {accoglienza}: {visite} visite, {registrate} nelle statistiche")
+            differenze_riepilogo = verifica_riepilogo(conn)
+            for email, calcolato, registrato in differenze_riepilogo[:50]:
+                print(f"{email}: {calcolato} dalle visite, {registrato} nel riepilogo")
+            if differenze or differenze_riepilogo:
+                print(f"{len(differenze) + len(differenze_riepilogo)} differenze: eseguire 'python statistiche.py ricostruisci'")
+                sys.exit(1)
+            print("Statistiche e riepilogo coerenti con le visite")
+
+if __name__ == '__main__':
+    main()
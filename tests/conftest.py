@@ -0,0 +1,96 @@
+import os
+import sys
+import pytest
+import psycopg
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# I test girano su un database PostgreSQL vero, indicato da TEST_DATABASE_URL.
+# Lo schema public viene cancellato e ricreato, quindi deve essere un database
+# usa e getta. Senza la variabile, o se il database non risponde, i test vengono
+# saltati.
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+ADMIN_PASSWORD = 'password-dei-test'
+
+# app.py legge la configurazione all'import: niente pianificatore né ascolto
+# delle notifiche durante i test
+if TEST_DATABASE_URL:
+    os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+os.environ['ADMIN_PASSWORD'] = ADMIN_PASSWORD
+os.environ.setdefault('SECRET_KEY', 'chiave-dei-test')
+os.environ['PIANIFICATORE_MODALITA'] = 'disattivato'
+os.environ['CACHE_LISTEN'] = '0'
+
+from seed_dati import crea_schema
+
+@pytest.fixture(scope='session')
+def database_url():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL non definita")
+    try:
+        conn = psycopg.connect(TEST_DATABASE_URL, autocommit=True)
+    except psycopg.OperationalError as e:
+        pytest.skip(f"Database di test non raggiungibile: {e}")
+    with conn:
+        conn.execute("DROP SCHEMA public CASCADE")
+        conn.execute("CREATE SCHEMA public")
+    with psycopg.connect(TEST_DATABASE_URL) as conn:
+        crea_schema(conn)
+    return TEST_DATABASE_URL
+
+# Apre connessioni al database di test, chiuse alla fine del test
+@pytest.fixture
+def connetti(database_url):
+    aperte = []
+    def apri():
+        conn = psycopg.connect(database_url, options='-c TimeZone=Europe/Rome')
+        aperte.append(conn)
+        return conn
+    yield apri
+    for conn in aperte:
+        conn.close()
+
+# Connessione su tabelle vuote
+@pytest.fixture
+def conn(connetti):
+    conn = connetti()
+    conn.execute("TRUNCATE visite, volontari, assistiti")
+    conn.commit()
+    return conn
+
+# Volontari e assistiti di base, già committati
+@pytest.fixture
+def anagrafiche(conn):
+    conn.execute("""
+        INSERT INTO volontari (email, cognome, nome) VALUES
+            ('anna@example.org', 'Rossi', 'Anna'),
+            ('bruno@example.org', 'Bianchi', 'Bruno'),
+            ('carla@example.org', 'Verdi', 'Carla')
+    """)
+    conn.execute("""
+        INSERT INTO assistiti (nome_sigla, citta) VALUES
+            ('AB01', 'Torino'), ('CD02', 'Milano'), ('EF03', 'Torino'), ('GH04', 'Genova')
+    """)
+    conn.commit()
+    return conn
+
+# L'app Flask, importata da una cartella temporanea: log e backup scritti in
+# percorsi relativi non finiscono nel repository
+@pytest.fixture(scope='session')
+def app(database_url, tmp_path_factory):
+    cartella = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    try:
+        import app as modulo
+        modulo.app.testing = True
+        yield modulo.app
+    finally:
+        os.chdir(cartella)
+
+# Client già autenticato come amministratore
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    risposta = client.post('/admin_login', data={'password': ADMIN_PASSWORD})
+    assert risposta.status_code == 302
+    return client
@@ -0,0 +1,17 @@
+import backup_incrementale
+
+# Lo schema del registro arriva dalla migrazione: il backup controlla solo che ci sia
+def test_registro_creato_dalla_migrazione(anagrafiche, monkeypatch):
+    conn = anagrafiche
+    monkeypatch.setattr(backup_incrementale, '_schema_pronto', False)
+    backup_incrementale.assicura_schema(conn)
+    conn.execute("INSERT INTO visite (volontario_email, assistito_nome, accoglienza, data_visita) VALUES ('anna@example.org', 'AB01', 'Buona', '2025-04-01')")
+    conn.commit()
+    assert conn.execute("SELECT count(*) FROM visite WHERE backup_xid IS NOT NULL").fetchone() == (1,)
+    conn.execute("DELETE FROM visite")
+    conn.execute("DELETE FROM assistiti WHERE nome_sigla = 'GH04'")
+    conn.commit()
+    assert conn.execute("""
+        SELECT tabella, count(*) FROM backup_eliminazioni
+        WHERE backup_xid >= (SELECT min(backup_xid) FROM volontari) GROUP BY 1 ORDER BY 1
+    """).fetchall() == [('assistiti', 1), ('visite', 1)]
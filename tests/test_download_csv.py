@@ -0,0 +1,44 @@
+import time
+import psycopg
+import pytest
+from db import pool_stats
+
+# Il pool conta nella dimensione anche le connessioni che sta ancora aprendo:
+# si aspetta che siano pronte, una connessione non restituita resta in uso
+def connessioni_in_uso():
+    for _ in range(50):
+        if pool_stats()['in_uso'] == 0:
+            break
+        time.sleep(0.02)
+    return pool_stats()['in_uso']
+
+def errore_al_primo_blocco(errore):
+    def esporta(cur, where, params):
+        cur.execute("SELECT 1")
+        raise errore
+        yield b''
+    return esporta
+
+# Un errore sul primo blocco del COPY, di qualunque tipo, restituisce la
+# connessione al pool invece di lasciarla al generatore
+@pytest.mark.parametrize('errore, risposta', [
+    (psycopg.DataError("dati non validi"), 302),
+    (psycopg.ProgrammingError("query non valida"), 302),
+    (RuntimeError("errore inatteso"), 500),
+])
+def test_errore_sul_primo_blocco_restituisce_la_connessione(app, client, conn, monkeypatch, errore, risposta):
+    import app as modulo
+    monkeypatch.setattr(modulo, 'esporta_report_csv', errore_al_primo_blocco(errore))
+    monkeypatch.setattr(app, 'testing', False)
+    assert client.get('/download_csv').status_code == risposta
+    assert connessioni_in_uso() == 0
+
+def test_download_csv(client, anagrafiche):
+    anagrafiche.execute("INSERT INTO visite (volontario_email, assistito_nome, accoglienza, data_visita) VALUES ('anna@example.org', 'AB01', 'Buona', '2025-04-01')")
+    anagrafiche.commit()
+    risposta = client.get('/download_csv')
+    righe = risposta.get_data(as_text=True).splitlines()
+    risposta.close()
+    assert risposta.status_code == 200
+    assert len(righe) == 2 and 'anna@example.org' in righe[1]
+    assert connessioni_in_uso() == 0
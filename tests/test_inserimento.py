@@ -0,0 +1,77 @@
+import threading
+import pytest
+import psycopg
+from query_visite import INSERISCI_VISITA, parametri_visita, messaggio_chiave_mancante
+
+def modulo(**campi):
+    valori = {
+        'volontario_email': 'nuovo@example.org',
+        'volontario_cognome': 'Neri',
+        'volontario_nome': 'Dario',
+        'assistito_nome': 'AB01',
+        'accoglienza': 'Buona',
+        'data_visita': '2025-03-10',
+    }
+    valori.update(campi)
+    return parametri_visita(valori)
+
+def inserisci(conn, parametri):
+    with conn.cursor() as cur:
+        cur.execute(INSERISCI_VISITA, parametri)
+        return cur.fetchone()
+
+def test_crea_volontario_e_visita_insieme(anagrafiche):
+    conn = anagrafiche
+    id_visita, volontario_nuovo = inserisci(conn, modulo())
+    conn.commit()
+    assert volontario_nuovo
+    assert conn.execute("SELECT cognome, nome FROM volontari WHERE email = 'nuovo@example.org'").fetchone() == ('Neri', 'Dario')
+    assert conn.execute("SELECT volontario_email FROM visite WHERE id = %s", (id_visita,)).fetchone() == ('nuovo@example.org',)
+
+def test_volontario_esistente_non_viene_modificato(anagrafiche):
+    conn = anagrafiche
+    _, volontario_nuovo = inserisci(conn, modulo(volontario_email='anna@example.org', volontario_cognome='Altro'))
+    conn.commit()
+    assert not volontario_nuovo
+    assert conn.execute("SELECT cognome FROM volontari WHERE email = 'anna@example.org'").fetchone() == ('Rossi',)
+    assert conn.execute("SELECT count(*) FROM visite").fetchone() == (1,)
+
+def test_volontario_nuovo_senza_nome_rifiutato(anagrafiche):
+    conn = anagrafiche
+    with pytest.raises(psycopg.errors.ForeignKeyViolation) as errore:
+        inserisci(conn, modulo(volontario_cognome='', volontario_nome=''))
+    conn.rollback()
+    assert messaggio_chiave_mancante(errore.value) == "Cognome e nome sono obbligatori per un nuovo volontario."
+    assert conn.execute("SELECT count(*) FROM volontari WHERE email = 'nuovo@example.org'").fetchone() == (0,)
+
+# Due primi invii contemporanei per la stessa email: il secondo aspetta il commit
+# del primo, ne usa il volontario e nessuno dei due fallisce
+def test_primo_invio_contemporaneo(anagrafiche, connetti):
+    primo = anagrafiche
+    secondo = connetti()
+    risultato = {}
+
+    id_primo, nuovo_primo = inserisci(primo, modulo())
+
+    def invio_secondo():
+        try:
+            risultato['riga'] = inserisci(secondo, modulo(volontario_cognome='Neri', volontario_nome='D.', data_visita='2025-03-11'))
+            secondo.commit()
+        except psycopg.Error as e:
+            risultato['errore'] = e
+
+    thread = threading.Thread(target=invio_secondo)
+    thread.start()
+    # Il secondo resta bloccato sull'email finché il primo non fa commit
+    thread.join(0.5)
+    assert thread.is_alive()
+    primo.commit()
+    thread.join(10)
+    assert not thread.is_alive()
+
+    assert 'errore' not in risultato
+    id_secondo, nuovo_secondo = risultato['riga']
+    assert nuovo_primo and not nuovo_secondo
+    assert id_secondo != id_primo
+    assert primo.execute("SELECT nome FROM volontari WHERE email = 'nuovo@example.org'").fetchall() == [('Dario',)]
+    assert primo.execute("SELECT count(*) FROM visite WHERE volontario_email = 'nuovo@example.org'").fetchone() == (2,)
@@ -0,0 +1,59 @@
+import os
+import time
+import threading
+import pytest
+import jobs
+
+@pytest.fixture
+def cartella(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOB_DIR', str(tmp_path))
+    return tmp_path
+
+def nuovo_stato(cartella, job_id):
+    return {'id': job_id, 'tipo': 'prova', 'parametri': {}, 'stato': 'in_coda', 'fatti': 0, 'totale': None,
+            'creato': time.time(), 'file': str(cartella / f"{job_id}.txt")}
+
+# Un lavoro lento e senza avanzamenti resta "in_corso" e riutilizzabile finché gira
+def test_il_battito_tiene_fresco_lo_stato(cartella, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOB_BATTITO', 0.05)
+    monkeypatch.setattr(jobs, 'JOB_TIMEOUT_INATTIVITA', 0.2)
+    sblocca = threading.Event()
+
+    def lento(percorso, progresso):
+        sblocca.wait(5)
+        with open(percorso, 'w') as f:
+            f.write('fatto')
+
+    job_id = 'a' * 20
+    lavoro = threading.Thread(target=jobs.esegui, args=(job_id, nuovo_stato(cartella, job_id), lento))
+    lavoro.start()
+    time.sleep(0.5)
+    assert jobs.riutilizzabile(jobs.stato_lavoro(job_id))
+    sblocca.set()
+    lavoro.join(5)
+    stato = jobs.stato_lavoro(job_id)
+    assert stato['stato'] == 'completato'
+    assert (cartella / f"{job_id}.txt").read_text() == 'fatto'
+
+# Due esecuzioni dello stesso lavoro scrivono su file temporanei diversi e il
+# risultato finale è sempre un file intero
+def test_esecuzioni_contemporanee_non_condividono_il_file_temporaneo(cartella):
+    job_id = 'b' * 20
+    percorsi = []
+    entrambe = threading.Barrier(2)
+
+    def scrivi(percorso, progresso):
+        percorsi.append(percorso)
+        with open(percorso, 'w') as f:
+            f.write('inizio-')
+            entrambe.wait(5)
+            f.write('fine')
+
+    esecuzioni = [threading.Thread(target=jobs.esegui, args=(job_id, nuovo_stato(cartella, job_id), scrivi)) for _ in range(2)]
+    for esecuzione in esecuzioni:
+        esecuzione.start()
+    for esecuzione in esecuzioni:
+        esecuzione.join(5)
+    assert len(set(percorsi)) == 2
+    assert (cartella / f"{job_id}.txt").read_text() == 'inizio-fine'
+    assert not [nome for nome in os.listdir(cartella) if nome.endswith('.tmp')]
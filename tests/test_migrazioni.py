@@ -0,0 +1,11 @@
+from migrazioni import verifica_indici, stato_migrazioni
+
+def test_migrazioni_applicate(conn):
+    assert all(applicata for _, _, applicata in stato_migrazioni(conn))
+
+# Le query controllate sono quelle costruite dall'app: se una cambia forma e non
+# può più usare il suo indice, il controllo lo segnala
+def test_query_usano_gli_indici(anagrafiche):
+    risultati = verifica_indici(anagrafiche)
+    assert {nome for nome, _, _ in risultati} >= {"report, prima pagina", "pulizia per volontario, primo lotto"}
+    assert [(nome, nodi) for nome, ok, nodi in risultati if not ok] == []
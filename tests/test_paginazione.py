@@ -0,0 +1,83 @@
+import re
+import html
+import itertools
+import pytest
+
+# Chiave di ordinamento del report per ogni colonna; a parità decide l'id
+ORDINAMENTI = {
+    'data': lambda visita: visita['data_visita'],
+    'volontario': lambda visita: visita['cognome'],
+    'assistito': lambda visita: visita['assistito_nome'],
+    'citta': lambda visita: visita['citta'],
+    'accoglienza': lambda visita: visita['accoglienza'],
+}
+
+# Visite con molti valori ripetuti, così l'id deve decidere l'ordine tra righe
+# uguali. La necessità identifica ogni visita nella pagina.
+@pytest.fixture
+def visite(anagrafiche):
+    conn = anagrafiche
+    volontari = ['anna@example.org', 'bruno@example.org', 'carla@example.org']
+    assistiti = ['AB01', 'CD02', 'EF03', 'GH04']
+    accoglienze = ['Buona', 'Media', 'Scarsa']
+    with conn.cursor() as cur:
+        cur.executemany(
+            "INSERT INTO visite (volontario_email, assistito_nome, accoglienza, data_visita, necessita) VALUES (%s, %s, %s, %s, %s)",
+            [(volontari[i % 3], assistiti[i % 4], accoglienze[i % 3], f"2025-01-{1 + i % 5:02d}", f"visita-{i:02d}") for i in range(37)],
+        )
+        cur.execute("""
+            SELECT v.id, v.necessita, v.volontario_email, v.data_visita::text, vol.cognome, v.assistito_nome, ass.citta, v.accoglienza
+            FROM visite v
+            JOIN volontari vol ON v.volontario_email = vol.email
+            JOIN assistiti ass ON v.assistito_nome = ass.nome_sigla
+        """)
+        colonne = [colonna.name for colonna in cur.description]
+        righe = [dict(zip(colonne, riga)) for riga in cur.fetchall()]
+    conn.commit()
+    return righe
+
+def ordinate(visite, ordina, verso):
+    chiave = ORDINAMENTI[ordina]
+    return [visita['necessita'] for visita in sorted(visite, key=lambda visita: (chiave(visita), visita['id']), reverse=verso == 'desc')]
+
+def collegamento(testo, cursore):
+    trovato = re.search(rf'href="(/report\?[^"]*\b{cursore}=[^"]*)"', testo)
+    return html.unescape(trovato.group(1)) if trovato else None
+
+# Visite della pagina e collegamenti alla successiva e alla precedente
+def leggi(client, url):
+    risposta = client.get(url)
+    assert risposta.status_code == 200
+    testo = risposta.get_data(as_text=True)
+    return re.findall(r'<td>(visita-\d+)</td>', testo), collegamento(testo, 'dopo'), collegamento(testo, 'prima')
+
+def scorri(client, url):
+    pagine = []
+    while url:
+        # Un cursore che non avanza rileggerebbe le stesse pagine all'infinito
+        assert len(pagine) < 20
+        righe, successiva, _ = leggi(client, url)
+        pagine.append((url, righe))
+        url = successiva
+    return pagine
+
+@pytest.mark.parametrize('ordina, verso', list(itertools.product(ORDINAMENTI, ['asc', 'desc'])))
+def test_pagine_coprono_tutte_le_visite_senza_ripetizioni(client, visite, ordina, verso):
+    pagine = scorri(client, f'/report?ordina={ordina}&verso={verso}&per_pagina=10')
+    assert [len(righe) for _, righe in pagine] == [10, 10, 10, 7]
+    assert [visita for _, righe in pagine for visita in righe] == ordinate(visite, ordina, verso)
+
+    # Tornando indietro dall'ultima pagina si ritrovano le stesse pagine
+    _, _, precedente = leggi(client, pagine[-1][0])
+    indietro = []
+    while precedente:
+        righe, _, precedente = leggi(client, precedente)
+        indietro.append(righe)
+    assert indietro == [righe for _, righe in pagine[-2::-1]]
+
+def test_pagine_con_filtro(client, visite):
+    pagine = scorri(client, '/report?volontario_email=anna@example.org&data_inizio=2025-01-02&data_fine=2025-01-04&ordina=data&verso=desc&per_pagina=2')
+    filtrate = [visita for visita in visite
+                if visita['volontario_email'] == 'anna@example.org' and '2025-01-02' <= visita['data_visita'] <= '2025-01-04']
+    assert len(pagine) > 1
+    assert [visita for _, righe in pagine for visita in righe] == ordinate(filtrate, 'data', 'desc')
@@ -0,0 +1,69 @@
+import pytest
+import cache
+import ricerca
+
+def indici_usati(piano):
+    indici = {piano['Index Name']} if 'Index Name' in piano else set()
+    for figlio in piano.get('Plans', []):
+        indici |= indici_usati(figlio)
+    return indici
+
+# Indici letti dalla query di cerca_nel_database, senza scansioni sequenziali
+def piano(conn, tipo, parole):
+    eseguite = []
+    class Cursore:
+        def execute(self, query, params):
+            eseguite.append((query, params))
+        def fetchall(self):
+            return []
+    ricerca.cerca_nel_database(Cursore(), tipo, parole, 20)
+    query, params = eseguite[0]
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL enable_seqscan = off")
+        cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+        indici = indici_usati(cur.fetchone()[0][0]['Plan'])
+    conn.rollback()
+    return query, indici
+
+def trigrammi(conn):
+    presente = conn.execute("SELECT EXISTS (SELECT FROM pg_extension WHERE extname = 'pg_trgm')").fetchone()[0]
+    conn.rollback()
+    return presente
+
+# Le parole brevi cercano l'inizio di un campo: "an" trova Anna ma non Bianchi
+def test_parole_brevi_per_prefisso(anagrafiche):
+    with anagrafiche.cursor() as cur:
+        trovati = ricerca.cerca_nel_database(cur, 'volontari', ['an'], 20)
+    assert [riga[0] for riga in trovati] == ['anna@example.org']
+    query, indici = piano(anagrafiche, 'volontari', ['an'])
+    assert 'similarity' not in query
+    assert {'volontari_cognome_prefisso_idx', 'volontari_nome_prefisso_idx', 'volontari_email_prefisso_idx'} <= indici
+    _, indici = piano(anagrafiche, 'assistiti', ['ab'])
+    assert indici == {'assistiti_prefisso_idx'}
+
+# Le parole lunghe possono comparire in qualunque punto e usano l'indice a trigrammi
+def test_parole_lunghe_con_trigrammi(anagrafiche):
+    if not trigrammi(anagrafiche):
+        pytest.skip("pg_trgm non installata")
+    with anagrafiche.cursor() as cur:
+        trovati = ricerca.cerca_nel_database(cur, 'volontari', ['ianc'], 20)
+    assert [riga[0] for riga in trovati] == ['bruno@example.org']
+    query, indici = piano(anagrafiche, 'volontari', ['ianc', 'br'])
+    assert 'similarity' in query
+    assert 'volontari_ricerca_idx' in indici
+
+# cerca() usa il database per le parole brevi anche senza pg_trgm; per le lunghe
+# solo con i trigrammi, altrimenti l'indice in memoria
+def test_percorsi_di_cerca(anagrafiche, monkeypatch):
+    monkeypatch.setattr(ricerca, '_trigrammi', None)
+    cache.scarta()
+    percorsi = []
+    nel_database, in_memoria = ricerca.cerca_nel_database, ricerca.cerca_in_memoria
+    monkeypatch.setattr(ricerca, 'cerca_nel_database', lambda *a: percorsi.append('database') or nel_database(*a))
+    monkeypatch.setattr(ricerca, 'cerca_in_memoria', lambda *a: percorsi.append('memoria') or in_memoria(*a))
+
+    assert [v['valore'] for v in ricerca.cerca('volontari', 'An')] == ['anna@example.org']
+    assert percorsi == ['database']
+    percorsi.clear()
+    assert [v['valore'] for v in ricerca.cerca('volontari', 'bianchi')] == ['bruno@example.org']
+    assert percorsi == ['database' if trigrammi(anagrafiche) else 'memoria']
@@ -0,0 +1,71 @@
+import pytest
+import psycopg
+from esportazione import scrivi_backup
+from ripristino import ripristina_backup
+
+CONTENUTO = "SELECT (SELECT count(*) FROM visite), (SELECT count(*) FROM volontari), (SELECT count(*) FROM assistiti)"
+VISITE = "SELECT volontario_email, assistito_nome, accoglienza, data_visita, necessita FROM visite ORDER BY data_visita"
+
+def nessun_progresso(sezione, righe):
+    pass
+
+@pytest.fixture
+def dati(anagrafiche):
+    conn = anagrafiche
+    conn.execute("""
+        INSERT INTO visite (volontario_email, assistito_nome, accoglienza, data_visita, necessita)
+        VALUES ('anna@example.org', 'AB01', 'Buona', '2025-04-01', 'spesa'),
+               ('bruno@example.org', 'CD02', 'Media', '2025-04-02', NULL),
+               ('carla@example.org', 'GH04', 'Scarsa', '2025-04-03', 'farmaci, "urgenti"')
+    """)
+    conn.commit()
+    return conn
+
+def test_ripristino_di_un_backup(dati, tmp_path):
+    conn = dati
+    file_backup = str(tmp_path / 'backup.csv')
+    with conn.cursor() as cur:
+        scrivi_backup(cur, file_backup)
+    prima = conn.execute(VISITE).fetchall()
+    conn.execute("DELETE FROM visite WHERE accoglienza = 'Buona'")
+    conn.commit()
+
+    conteggi = ripristina_backup(conn, file_backup, progresso=nessun_progresso)
+
+    assert conteggi == {'--- Visite ---': 3, '--- Volontari ---': 3, '--- Assistiti ---': 4}
+    assert conn.execute(VISITE).fetchall() == prima
+
+# Un backup che fallisce a metà (qui una visita di un assistito che non c'è)
+# viene annullato per intero: i dati attuali restano come prima
+def test_ripristino_fallito_lascia_i_dati_intatti(dati, tmp_path):
+    conn = dati
+    file_backup = tmp_path / 'backup.csv'
+    file_backup.write_text(
+        "--- Assistiti ---\n"
+        "Nome Sigla,Città\n"
+        "XY09,Roma\n"
+        "--- Volontari ---\n"
+        "Email,Cognome,Nome,Telefono,Competenze,Disponibilità,Data Iscrizione\n"
+        "dora@example.org,Gialli,Dora,,,,\n"
+        "--- Visite ---\n"
+        "Volontario Email,Cognome,Nome,Assistito,Città,Accoglienza,Data Visita,Necessità,Cosa Migliorare\n"
+        "dora@example.org,Gialli,Dora,ZZ99,Roma,Buona,2025-05-01,,\n",
+        encoding='utf-8',
+    )
+    prima = conn.execute(VISITE).fetchall()
+    conn.commit()
+
+    with pytest.raises(psycopg.errors.ForeignKeyViolation):
+        ripristina_backup(conn, str(file_backup), progresso=nessun_progresso)
+
+    assert conn.execute(CONTENUTO).fetchone() == (3, 3, 4)
+    assert conn.execute(VISITE).fetchall() == prima
+    assert conn.execute("SELECT count(*) FROM volontari WHERE email = 'dora@example.org'").fetchone() == (0,)
+
+def test_ripristino_file_vuoto(dati, tmp_path):
+    conn = dati
+    file_backup = tmp_path / 'vuoto.csv'
+    file_backup.write_bytes(b'')
+    with pytest.raises(ValueError):
+        ripristina_backup(conn, str(file_backup), progresso=nessun_progresso)
+    assert conn.execute(CONTENUTO).fetchone() == (3, 3, 4)
@@ -0,0 +1,85 @@
+import pytest
+from statistiche import (
+    calcola_statistiche, statistiche_giornaliere, filtro_statistiche,
+    verifica_statistiche, ricostruisci_statistiche, verifica_riepilogo, ricostruisci_riepilogo,
+)
+from query_visite import filtro_visite
+
+# Inserimenti, modifiche e cancellazioni di più righe per istruzione, anche di
+# righe che cambiano volontario, giorno o città: dopo ogni passo le tabelle
+# mantenute dai trigger (statistiche giornaliere e riepilogo dei volontari)
+# devono coincidere con quelle ricalcolate dalle visite
+PASSI = [
+    """INSERT INTO visite (volontario_email, assistito_nome, accoglienza, data_visita)
+       SELECT (ARRAY['anna@example.org', 'bruno@example.org', 'carla@example.org'])[1 + i % 3],
+              (ARRAY['AB01', 'CD02', 'EF03', 'GH04'])[1 + i % 4],
+              (ARRAY['Buona', 'Media', 'Scarsa'])[1 + i % 3],
+              DATE '2025-02-01' + i % 10
+       FROM generate_series(1, 200) AS i""",
+    "UPDATE visite SET accoglienza = 'Scarsa' WHERE data_visita = DATE '2025-02-03'",
+    "UPDATE visite SET data_visita = data_visita + 30 WHERE id % 7 = 0",
+    "UPDATE visite SET volontario_email = 'carla@example.org', assistito_nome = 'CD02' WHERE volontario_email = 'anna@example.org' AND id % 2 = 0",
+    "UPDATE assistiti SET citta = 'Asti' WHERE nome_sigla = 'EF03'",
+    "DELETE FROM visite WHERE id % 5 = 0",
+    "DELETE FROM visite WHERE volontario_email = 'bruno@example.org'",
+]
+
+def senza_zeri(statistiche):
+    statistiche['accoglienza'] = {chiave: valore for chiave, valore in statistiche['accoglienza'].items() if valore}
+    return statistiche
+
+def test_trigger_allineati_dopo_ogni_modifica(anagrafiche):
+    conn = anagrafiche
+    for passo in PASSI:
+        conn.execute(passo)
+        conn.commit()
+        assert verifica_statistiche(conn) == [], passo
+        assert verifica_riepilogo(conn) == [], passo
+
+def test_modifica_annullata_non_lascia_tracce(anagrafiche):
+    conn = anagrafiche
+    conn.execute(PASSI[0])
+    conn.commit()
+    conn.execute("DELETE FROM visite WHERE volontario_email = 'anna@example.org'")
+    conn.rollback()
+    assert verifica_statistiche(conn) == []
+    assert verifica_riepilogo(conn) == []
+
+def test_truncate_svuota_i_riepiloghi(anagrafiche):
+    conn = anagrafiche
+    conn.execute(PASSI[0])
+    conn.commit()
+    conn.execute("TRUNCATE visite")
+    conn.commit()
+    assert conn.execute("SELECT count(*) FROM statistiche_giornaliere").fetchone() == (0,)
+    assert conn.execute("SELECT count(*) FROM riepilogo_volontari").fetchone() == (0,)
+    assert conn.execute("SELECT count(*) FROM riepilogo_volontari_assistiti").fetchone() == (0,)
+
+@pytest.mark.parametrize('filtri', [
+    (None, None, None),
+    ('anna@example.org', None, None),
+    (None, '2025-02-03', '2025-02-07'),
+    ('carla@example.org', '2025-02-05', None),
+])
+def test_statistiche_giornaliere_come_le_visite(anagrafiche, filtri):
+    conn = anagrafiche
+    for passo in PASSI[:4]:
+        conn.execute(passo)
+    conn.commit()
+    with conn.cursor() as cur:
+        attese = calcola_statistiche(cur, *filtro_visite(*filtri))
+        assert senza_zeri(statistiche_giornaliere(cur, *filtri)) == senza_zeri(attese)
+    assert filtro_statistiche(*filtri)[1] == filtro_visite(*filtri)[1]
+
+def test_ricostruzione_ripara_i_riepiloghi(anagrafiche):
+    conn = anagrafiche
+    conn.execute(PASSI[0])
+    conn.execute("UPDATE statistiche_giornaliere SET visite = visite + 1 WHERE giorno = DATE '2025-02-01'")
+    conn.execute("DELETE FROM riepilogo_volontari WHERE volontario_email = 'anna@example.org'")
+    conn.commit()
+    assert verifica_statistiche(conn)
+    assert verifica_riepilogo(conn)
+    ricostruisci_statistiche(conn)
+    ricostruisci_riepilogo(conn)
+    assert verifica_statistiche(conn) == []
+    assert verifica_riepilogo(conn) == []